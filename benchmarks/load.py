@@ -0,0 +1,277 @@
+'''
+Load benchmark: checks against the fake target server, see benchmarks.target.
+
+By default checks are scheduled in memory (like timer mode) and results go to a stand-in sink.
+With a disposable database name, the real scheduler main loop runs with a local Postgres:
+    python -m benchmarks.load --urls 10000 --vhosts 200 --interval 5 --duration 30
+    python -m benchmarks.load --database benchdb --mode lease \\
+        --profile share=9,latency=uniform:5:50 --profile share=1,latency=exp:500,hangs=0.01
+
+Report is printed as JSON: checks/sec, checks by outcome, scheduling lag percentiles
+(estimated from check_start_lag_seconds histogram buckets), CPU time per check and
+peak RSS of the benchmark process; target server runs in a separate process.
+'''
+# pylint:disable=C0116
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from benchmarks import target
+from lib.checker import CheckResult, close_client, initialize_client
+from lib.config import load_config
+from lib.db import get_pool, initialize_pool
+from lib.dispatcher import Dispatcher
+from lib.limiter import OriginLimiter
+from lib.loopmon import close_monitor, initialize_monitor, new_event_loop
+from lib.matcher import close_matcher, initialize_matcher
+from lib.metrics import counter, histogram
+from lib.patterns import compile_pattern
+from lib.scheduler import main_loop
+from lib.timer import TimerQueue
+from lib.writer import ResultSink
+
+_SCHEMA = 'bench_load'
+_OUTCOMES = ('ok', 'error', 'http_error', 'content_mismatch')
+
+# metrics recorded by lib.dispatcher and lib.loopmon
+_lag = histogram('check_start_lag_seconds', 'Check start delay after its run time')
+_loop_lag = histogram('event_loop_lag_seconds', 'Delay of a callback scheduled by the loop monitor',
+                      buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                               1.0, 2.5))
+_checks = counter('checks_total', 'Finished checks by outcome', ('outcome',))
+
+
+class NullWriter(ResultSink):
+    '''
+    Stand-in result sink, counts results only
+    '''
+    def __init__(self):
+        self.results = 0
+
+    async def put(self, wl_id: int, start: float, end: float, result: CheckResult):
+        # pylint:disable=W0613
+        self.results += 1
+
+
+class Sample:
+    '''
+    Counters snapshot at the start of measurement
+    '''
+    def __init__(self):
+        self.time = time.perf_counter()
+        self.cpu = time.process_time()
+        self.lag = list(_lag.labels().counts)  # type:ignore
+        self.loop_lag = list(_loop_lag.labels().counts)  # type:ignore
+        self.checks = {o: _checks.labels(o).value for o in _OUTCOMES}  # type:ignore
+
+    def report(self) -> dict[str, Any]:
+        elapsed = time.perf_counter() - self.time
+        cpu = time.process_time() - self.cpu
+        outcomes = {o: int(_checks.labels(o).value - v)  # type:ignore
+                    for o, v in self.checks.items()}
+        checks = sum(outcomes.values())
+        lag = [a - b for a, b in zip(_lag.labels().counts, self.lag)]  # type:ignore
+        loop_lag = [a - b for a, b in zip(_loop_lag.labels().counts,  # type:ignore
+                                          self.loop_lag)]
+        return {
+            'duration': round(elapsed, 3),
+            'checks': checks,
+            'checks_per_sec': round(checks / elapsed, 1),
+            'outcomes': outcomes,
+            'lag_ms': {
+                f'p{round(q * 100)}': _percentile(_lag.buckets, lag, q)
+                for q in (0.5, 0.9, 0.95, 0.99)
+            },
+            'loop_lag_ms': {
+                f'p{round(q * 100)}': _percentile(_loop_lag.buckets, loop_lag, q)
+                for q in (0.5, 0.99)
+            },
+            'cpu_per_check_ms': round(cpu / max(checks, 1) * 1000, 3),
+            'cpu_utilization': round(cpu / elapsed, 3),
+            # kilobytes on Linux
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+
+def _percentile(bounds: tuple[float, ...], counts: list[int], q: float) -> Optional[float]:
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if i == len(bounds):
+                # +Inf bucket
+                return bounds[-1] * 1000
+            lower = bounds[i - 1] if i else 0.0
+            return round((lower + (bounds[i] - lower) * (rank - seen) / count) * 1000, 3)
+        seen += count
+    return None
+
+
+def _urls(opts: argparse.Namespace) -> list[str]:
+    scheme = 'https' if opts.tls_cert else 'http'
+    return [f'{scheme}://{target.vhost_address(i % opts.vhosts)}:{opts.port}/{i}'
+            for i in range(opts.urls)]
+
+
+def _wait_server(opts: argparse.Namespace, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((target.vhost_address(0), opts.port), 1.0):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+async def bench_sink(opts: argparse.Namespace, config: dict[str, Any]) -> dict[str, Any]:
+    writer = NullWriter()
+    dispatcher = Dispatcher(writer, opts.concurrency,  # type:ignore
+                            limiter=OriginLimiter(opts.origin_concurrency))
+    dispatcher.start()
+
+    content_rx = compile_pattern(opts.content_rx) if opts.content_rx else None
+    queue = TimerQueue()
+    now = time.time()
+    rnd = random.Random(opts.seed)
+    for id, url in enumerate(_urls(opts)):  # pylint:disable=W0622
+        queue.schedule(id, now + rnd.uniform(0, opts.interval),
+                       {'id': id, 'url': url, 'content_rx': content_rx,
+                        'reuse_connection': opts.reuse, 'timeout': opts.timeout})
+
+    async def schedule():
+        while True:
+            # dispatcher waits for run time itself
+            for key, run_at, params in queue.pop_due(time.time() + config['interval']):
+                dispatcher.submit(dict(params, run_at=run_at))
+                queue.schedule(key, run_at + opts.interval, params)
+            await asyncio.sleep(config['interval'])
+
+    scheduler = asyncio.create_task(schedule())
+    try:
+        await asyncio.sleep(opts.warmup)
+        sample = Sample()
+        await asyncio.sleep(opts.duration)
+        report = sample.report()
+    finally:
+        scheduler.cancel()
+        await dispatcher.close()
+    return report
+
+
+async def bench_database(opts: argparse.Namespace, config: dict[str, Any]) -> dict[str, Any]:
+    script = (Path(__file__).parent.parent / 'db/structure.sql').read_text()
+    async with get_pool().acquire() as conn:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {_SCHEMA} CASCADE; CREATE SCHEMA {_SCHEMA}')
+        await conn.execute(script)
+        await conn.copy_records_to_table(
+            'watchlist', columns=('url', 'interval', 'content_rx', 'reuse_connection'),
+            records=[(url, int(opts.interval), opts.content_rx, opts.reuse)
+                     for url in _urls(opts)]
+        )
+
+    scheduler = asyncio.create_task(main_loop(config))
+    try:
+        await asyncio.sleep(opts.warmup)
+        sample = Sample()
+        await asyncio.sleep(opts.duration)
+        report = sample.report()
+    finally:
+        scheduler.cancel()
+        await asyncio.gather(scheduler, return_exceptions=True)
+        async with get_pool().acquire() as conn:
+            await conn.execute(f'DROP SCHEMA {_SCHEMA} CASCADE')
+    return report
+
+
+async def _run(opts: argparse.Namespace, config: dict[str, Any]) -> dict[str, Any]:
+    initialize_client(**config.get('http', {}))
+    initialize_matcher(**config.get('match', {}))
+    initialize_monitor(asyncio.get_running_loop(), interval=0.01, slow_callback=0.1)
+    try:
+        if opts.database:
+            await initialize_pool(**config['db'])
+            return await bench_database(opts, config['scheduler'])
+        return await bench_sink(opts, config['scheduler'])
+    finally:
+        close_monitor()
+        await close_client()
+        await close_matcher()
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+    target.add_arguments(args)
+    args.add_argument('--urls', type=int, default=10000)
+    args.add_argument('--interval', type=float, default=5.0, help='check interval, seconds')
+    args.add_argument('--duration', type=float, default=30.0, help='seconds')
+    args.add_argument('--warmup', type=float, default=5.0, help='seconds')
+    args.add_argument('--concurrency', type=int, default=500)
+    args.add_argument('--origin-concurrency', type=int, default=0)
+    args.add_argument('--timeout', type=float, default=5.0, help='check read timeout')
+    args.add_argument('--content-rx', help='content regex, target bodies end with '
+                      + target.BODY_MARKER.decode())
+    args.add_argument('--reuse', action='store_true', help='reuse kept-alive connections')
+    args.add_argument('--database', help='disposable database, runs scheduler main loop')
+    args.add_argument('--mode', default='timer', choices=('poll', 'timer', 'lease'),
+                      help='scheduler mode with --database')
+    args.add_argument('--spool', help='results spool directory with --database')
+    args.add_argument('--uvloop', action='store_true', help='run on uvloop')
+    opts = args.parse_args()
+
+    config = load_config()
+    config['scheduler'].update(mode=opts.mode, interval=min(opts.interval, 1.0),
+                               max_concurrency=opts.concurrency,
+                               origin_concurrency=opts.origin_concurrency,
+                               claim_limit=opts.urls, spool_dir=opts.spool or '')
+    if opts.database:
+        config['db'].update(database=opts.database, server_settings={'search_path': _SCHEMA},
+                            min_size=1, max_size=10)
+    if opts.tls_cert:
+        # self-signed target certificate is trusted by the checker
+        os.environ['SSL_CERT_FILE'] = opts.tls_cert
+
+    profiles = target.assign_profiles(opts.vhosts, opts.profiles or [target.TargetProfile()])
+    server = multiprocessing.get_context('spawn').Process(
+        target=target.run, args=(profiles, opts.port, opts.seed, opts.tls_cert, opts.tls_key),
+        daemon=True
+    )
+    server.start()
+    try:
+        _wait_server(opts)
+        with asyncio.Runner(loop_factory=lambda: new_event_loop(opts.uvloop)) as runner:
+            report = runner.run(_run(opts, config))
+    finally:
+        server.terminate()
+        server.join()
+
+    print(json.dumps({
+        'mode': opts.mode if opts.database else 'sink',
+        'urls': opts.urls,
+        'vhosts': opts.vhosts,
+        'interval': opts.interval,
+        'concurrency': opts.concurrency,
+        'reuse': opts.reuse,
+        'tls': bool(opts.tls_cert),
+        'spool': bool(opts.database and opts.spool),
+        'uvloop': opts.uvloop,
+        'profiles': [vars(p) for p in opts.profiles or [target.TargetProfile()]],
+        **report,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+'''
+Lease mode scale-out benchmark: checks/sec by number of scheduler processes.
+
+Watchlist of `--urls` records pointing to a local HTTP server is checked every second
+by 1..N processes, needs a disposable database:
+    python -m benchmarks.scaleout --database benchdb --processes 1 2 4
+'''
+# pylint:disable=C0116
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from pathlib import Path
+from typing import Any
+
+from lib.checker import initialize_client
+from lib.config import load_config
+from lib.db import get_pool, initialize_pool
+from lib.scheduler import main_loop
+
+_SCHEMA = 'bench_scaleout'
+_RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok'
+
+
+def _serve(port: int):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(_RESPONSE)
+        await writer.drain()
+        writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def _schedule(config: dict[str, Any]):
+    async def run():
+        await initialize_pool(**config['db'])
+        initialize_client()
+        await main_loop(config['scheduler'])
+
+    asyncio.run(run())
+
+
+async def _setup(db: dict[str, Any], urls: int, port: int):
+    await initialize_pool(**db)
+    script = (Path(__file__).parent.parent / 'db/structure.sql').read_text()
+    async with get_pool().acquire() as conn:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {_SCHEMA} CASCADE; CREATE SCHEMA {_SCHEMA}')
+        await conn.execute(script)
+        await conn.copy_records_to_table(
+            'watchlist', columns=('url', 'interval'),
+            records=[(f'http://127.0.0.1:{port}/{id}', 1) for id in range(urls)]
+        )
+
+
+async def _reset():
+    async with get_pool().acquire() as conn:
+        await conn.execute('TRUNCATE check_log')
+        await conn.execute('UPDATE watchlist SET last_start = NULL, '
+                           'lease_owner = NULL, lease_until = NULL')
+
+
+async def _count(since: float, until: float) -> int:
+    async with get_pool().acquire() as conn:
+        return await conn.fetchval(
+            'SELECT count(*) FROM check_log '
+            'WHERE "start" >= to_timestamp($1) AND "start" < to_timestamp($2)',
+            since, until
+        )
+
+
+async def _drop():
+    async with get_pool().acquire() as conn:
+        await conn.execute(f'DROP SCHEMA {_SCHEMA} CASCADE')
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument('--database', required=True, help='disposable database')
+    args.add_argument('--urls', type=int, default=5000)
+    args.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    args.add_argument('--concurrency', type=int, default=100, help='per process')
+    args.add_argument('--duration', type=float, default=20.0, help='seconds')
+    args.add_argument('--warmup', type=float, default=5.0, help='seconds')
+    args.add_argument('--port', type=int, default=18080)
+    opts = args.parse_args()
+
+    config = load_config()
+    config['db'].update(database=opts.database, server_settings={'search_path': _SCHEMA},
+                        min_size=1, max_size=10)
+    config['scheduler'].update(mode='lease', interval=1, max_concurrency=opts.concurrency,
+                               claim_limit=opts.urls)
+
+    # spawned processes don't inherit DB pool of this one
+    mp = multiprocessing.get_context('spawn')
+    server = mp.Process(target=_serve, args=(opts.port,), daemon=True)
+    server.start()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(_setup(config['db'], opts.urls, opts.port))
+
+    report = []
+    try:
+        for processes in opts.processes:
+            loop.run_until_complete(_reset())
+            workers = [mp.Process(target=_schedule, args=(config,))
+                       for _ in range(processes)]
+            for worker in workers:
+                worker.start()
+
+            time.sleep(opts.warmup)
+            since = time.time()
+            time.sleep(opts.duration)
+            until = time.time()
+
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
+
+            checks = loop.run_until_complete(_count(since, until))
+            report.append({
+                'processes': processes,
+                'checks': checks,
+                'checks_per_sec': round(checks / (until - since), 1),
+            })
+            report[-1]['speedup'] = round(
+                report[-1]['checks_per_sec'] / max(report[0]['checks_per_sec'], 1e-9), 2
+            )
+    finally:
+        loop.run_until_complete(_drop())
+        server.terminate()
+
+    print(json.dumps({'urls': opts.urls, 'results': report}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+'''
+Scheduler modes benchmark: CPU spent per tick to pick due records.
+
+Timer mode is measured in memory. Poll mode runs the real watchlist query,
+so it's measured only when a disposable database name is given:
+    python -m benchmarks.scheduler --urls 100000 --database benchdb
+Client CPU doesn't include the query cost in Postgres, so for poll mode server execution time
+and buffers accessed are also reported, from EXPLAIN (ANALYZE, BUFFERS) of the same query
+run once more per tick (ANALYZE timing adds some overhead).
+'''
+# pylint:disable=C0116
+import argparse
+import asyncio
+import json
+import random
+from datetime import datetime, timezone
+from pathlib import Path
+from statistics import mean, quantiles
+from time import perf_counter, process_time, time
+
+from lib.config import load_config
+from lib.db import get_pool, initialize_pool
+from lib.scheduler import WATCHLIST_POLL_QUERY
+from lib.timer import TimerQueue
+
+_SCHEMA = 'bench_scheduler'
+
+
+def _summary(cpu: list[float], wall: list[float], checks: int) -> dict:
+    return {
+        'ticks': len(cpu),
+        'checks': checks,
+        'cpu_per_tick_ms': round(mean(cpu) * 1000, 3),
+        'cpu_per_tick_p95_ms': round(quantiles(cpu, n=20)[-1] * 1000, 3),
+        'wall_per_tick_ms': round(mean(wall) * 1000, 3),
+        'cpu_per_check_us': round(sum(cpu) / max(checks, 1) * 1e6, 3),
+    }
+
+
+def _intervals(urls: int, tick: float) -> list[int]:
+    rnd = random.Random(urls)
+    return [rnd.randint(int(tick), 300) for _ in range(urls)]
+
+
+def bench_timer(urls: int, ticks: int, tick: float) -> dict:
+    queue = TimerQueue()
+    now = time()
+    for id, period in enumerate(_intervals(urls, tick)):  # pylint:disable=W0622
+        queue.schedule(id, now + random.uniform(0, period), (period, {'id': id}))
+
+    cpu, wall, checks = [], [], 0
+    for _ in range(ticks):
+        now += tick
+        cpu0, wall0 = process_time(), perf_counter()
+        for key, run_at, item in queue.pop_due(now):
+            queue.schedule(key, run_at + item[0], item)
+            checks += 1
+        cpu.append(process_time() - cpu0)
+        wall.append(perf_counter() - wall0)
+
+    return _summary(cpu, wall, checks)
+
+
+async def bench_poll(urls: int, ticks: int, tick: float, database: str) -> dict:
+    config = load_config()['db']
+    config['database'] = database
+    config['server_settings'] = {'search_path': _SCHEMA}
+    await initialize_pool(**config)
+
+    script = (Path(__file__).parent.parent / 'db/structure.sql').read_text()
+    async with get_pool().acquire() as conn:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {_SCHEMA} CASCADE; CREATE SCHEMA {_SCHEMA}')
+        await conn.execute(script)
+        now = time()
+        await conn.copy_records_to_table(
+            'watchlist', columns=('url', 'interval', 'last_start'),
+            records=[
+                (f'http://host{id}.test/', period,
+                 # naive UTC, as written by lib.writer
+                 datetime.fromtimestamp(now - random.uniform(0, period),
+                                        timezone.utc).replace(tzinfo=None))
+                for id, period in enumerate(_intervals(urls, tick))  # pylint:disable=W0622
+            ]
+        )
+        await conn.execute('ANALYZE watchlist')
+
+        fetch = await conn.prepare(WATCHLIST_POLL_QUERY)
+        explain = await conn.prepare(
+            f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {WATCHLIST_POLL_QUERY}'
+        )
+        cpu, wall, checks = [], [], 0
+        server, buffers = [], []
+        try:
+            for _ in range(ticks):
+                now += tick
+                cpu0, wall0 = process_time(), perf_counter()
+                async with conn.transaction():
+                    records = [r async for r in fetch.cursor(now + tick)]
+                cpu.append(process_time() - cpu0)
+                wall.append(perf_counter() - wall0)
+                checks += len(records)
+
+                plan = json.loads(await explain.fetchval(now + tick))[0]
+                server.append((plan['Planning Time'] + plan['Execution Time']) / 1000)
+                buffers.append(plan['Plan']['Shared Hit Blocks']
+                               + plan['Plan']['Shared Read Blocks'])
+
+                # writer part, not measured
+                await conn.execute(
+                    'UPDATE watchlist SET last_start = to_timestamp(v.run_at) '
+                    'FROM unnest($1::int[], $2::int[]) v(id, run_at) WHERE watchlist.id = v.id',
+                    [r['id'] for r in records], [r['run_at'] or int(now) for r in records]
+                )
+        finally:
+            await conn.execute(f'DROP SCHEMA {_SCHEMA} CASCADE')
+
+    return {
+        **_summary(cpu, wall, checks),
+        'server_per_tick_ms': round(mean(server) * 1000, 3),
+        'server_per_tick_p95_ms': round(quantiles(server, n=20)[-1] * 1000, 3),
+        'buffers_per_tick': round(mean(buffers), 1),
+    }
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+    args.add_argument('--urls', type=int, default=100000)
+    args.add_argument('--ticks', type=int, default=60)
+    args.add_argument('--tick', type=float, default=5.0, help='tick interval, seconds')
+    args.add_argument('--database', help='disposable database for poll mode')
+    opts = args.parse_args()
+
+    report = {'urls': opts.urls, 'timer': bench_timer(opts.urls, opts.ticks, opts.tick)}
+    if opts.database:
+        report['poll'] = asyncio.run(bench_poll(opts.urls, opts.ticks, opts.tick, opts.database))
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+'''
+Fake target server for load tests: a single asyncio process serving many virtual hosts.
+
+Virtual hosts are loopback addresses 127.1.1.1, 127.1.1.2, ... listening on the same port,
+so each one is a separate origin for the checker without DNS setup.
+Every virtual host gets a profile: latency distribution, body size, error, drop and hang rates.
+Profiles are given as comma separated key=value lists, `share` is a relative number of hosts:
+    python -m benchmarks.target --vhosts 100 \\
+        --profile share=9,latency=uniform:5:50,body=2048 \\
+        --profile share=1,latency=exp:500,errors=0.1,hangs=0.01
+
+Latency is one of `fixed:MS`, `uniform:MIN_MS:MAX_MS`, `exp:MEAN_MS`, `lognormal:MEDIAN_MS:SIGMA`.
+TLS is served with --tls-cert/--tls-key files, certificate must be valid for virtual host
+addresses, i.e. have `subjectAltName=IP:127.1.1.1,IP:127.1.1.2,...`.
+'''
+# pylint:disable=C0116
+import argparse
+import asyncio
+import math
+import random
+import ssl
+from dataclasses import dataclass
+from typing import Optional
+
+# marker at the end of response body, to be matched by content regex
+BODY_MARKER = b'<!-- ok -->'
+
+_REASONS = {200: b'OK', 500: b'Internal Server Error', 503: b'Service Unavailable'}
+
+
+@dataclass
+class TargetProfile:  # pylint:disable=C0115
+    # relative number of virtual hosts with this profile
+    share: float = 1.0
+    # response headers delay, see module docstring
+    latency: str = 'fixed:0'
+    # response body size, bytes
+    body: int = 1024
+    # share of responses with HTTP status 500/503
+    errors: float = 0.0
+    # share of connections closed without response
+    drops: float = 0.0
+    # share of requests never answered
+    hangs: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> 'TargetProfile':
+        '''
+        Profile from "key=value,..." string
+        '''
+        profile = cls()
+        for item in filter(None, spec.split(',')):
+            key, value = item.split('=', 1)
+            if key not in cls.__dataclass_fields__:  # pylint:disable=E1101
+                raise ValueError(f'Unknown profile option {key!r}')
+            kind = type(getattr(profile, key))
+            setattr(profile, key, kind(value))
+        profile.delay(random.Random())  # validate latency
+        return profile
+
+    def delay(self, rnd: random.Random) -> float:
+        '''
+        Random response delay, seconds
+        '''
+        kind, *args = self.latency.split(':')
+        params = [float(a) for a in args]
+        if kind == 'fixed':
+            ms = params[0]
+        elif kind == 'uniform':
+            ms = rnd.uniform(params[0], params[1])
+        elif kind == 'exp':
+            ms = rnd.expovariate(1 / params[0]) if params[0] else 0
+        elif kind == 'lognormal':
+            ms = rnd.lognormvariate(math.log(params[0]), params[1])
+        else:
+            raise ValueError(f'Unknown latency distribution {kind!r}')
+        return ms / 1000
+
+
+def vhost_address(index: int) -> str:
+    '''
+    Loopback address of the virtual host
+    '''
+    return f'127.{1 + index // 254 % 254}.{1 + index // 64516}.{1 + index % 254}'
+
+
+def assign_profiles(vhosts: int, profiles: list[TargetProfile]) -> list[TargetProfile]:
+    '''
+    Profiles of virtual hosts, proportionally to profile shares
+    '''
+    total = sum(p.share for p in profiles)
+    assigned: list[TargetProfile] = []
+    for profile in profiles:
+        assigned.extend([profile] * round(vhosts * profile.share / total))
+    # rounding leftovers
+    while len(assigned) < vhosts:
+        assigned.append(profiles[-1])
+    return assigned[:vhosts]
+
+
+class TargetServer:
+    '''
+    HTTP/1.1 server with keep-alive, behaviour is chosen by the local address of connection
+    '''
+    def __init__(self, profiles: list[TargetProfile], seed: int = 0):
+        self._profiles = {vhost_address(i): p for i, p in enumerate(profiles)}
+        self._bodies: dict[int, bytes] = {}
+        self._rnd = random.Random(seed)
+
+    def _body(self, size: int) -> bytes:
+        body = self._bodies.get(size)
+        if body is None:
+            padding = b'x' * max(size - len(BODY_MARKER), 0)
+            body = self._bodies[size] = (padding + BODY_MARKER)[-size:] if size > 0 else b''
+        return body
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        profile = self._profiles.get(writer.get_extra_info('sockname')[0], TargetProfile())
+        rnd = self._rnd
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                keep_alive = b'connection: close' not in request.lower()
+
+                chance = rnd.random()
+                if chance < profile.drops:
+                    break
+                if chance < profile.drops + profile.hangs:
+                    # until client gives up
+                    await reader.read()
+                    break
+
+                delay = profile.delay(rnd)
+                if delay:
+                    await asyncio.sleep(delay)
+
+                status = rnd.choice((500, 503)) if rnd.random() < profile.errors else 200
+                body = self._body(profile.body)
+                writer.write(
+                    b'HTTP/1.1 %d %s\r\nContent-Type: text/html\r\nContent-Length: %d\r\n'
+                    b'Connection: %s\r\n\r\n' % (
+                        status, _REASONS[status], len(body),
+                        b'keep-alive' if keep_alive else b'close'
+                    )
+                )
+                writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(profiles: list[TargetProfile], port: int, seed: int = 0,
+                tls_cert: Optional[str] = None, tls_key: Optional[str] = None):
+    '''
+    Serve virtual hosts forever
+    '''
+    sslctx = None
+    if tls_cert:
+        sslctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        sslctx.load_cert_chain(tls_cert, tls_key)
+
+    target = TargetServer(profiles, seed)
+    hosts = [vhost_address(i) for i in range(len(profiles))]
+    server = await asyncio.start_server(target.handle, hosts, port, ssl=sslctx, backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+def run(profiles: list[TargetProfile], port: int, seed: int = 0,
+        tls_cert: Optional[str] = None, tls_key: Optional[str] = None):
+    '''
+    Process entry point
+    '''
+    try:
+        asyncio.run(serve(profiles, port, seed, tls_cert, tls_key))
+    except KeyboardInterrupt:
+        pass
+
+
+def add_arguments(args: argparse.ArgumentParser):
+    '''
+    Target server options, shared with the load benchmark
+    '''
+    args.add_argument('--vhosts', type=int, default=100, help='number of virtual hosts')
+    args.add_argument('--profile', type=TargetProfile.parse, action='append', dest='profiles',
+                      help='virtual hosts profile, may be repeated')
+    args.add_argument('--port', type=int, default=18443)
+    args.add_argument('--seed', type=int, default=0, help='random seed')
+    args.add_argument('--tls-cert', help='certificate file, enables TLS')
+    args.add_argument('--tls-key', help='private key file')
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(args)
+    opts = args.parse_args()
+
+    profiles = assign_profiles(opts.vhosts, opts.profiles or [TargetProfile()])
+    print(f'Serving {opts.vhosts} virtual hosts '
+          f'{vhost_address(0)}..{vhost_address(opts.vhosts - 1)}:{opts.port}')
+    run(profiles, opts.port, opts.seed, opts.tls_cert, opts.tls_key)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,28 @@
 # import asyncio
 import argparse
 import asyncio
+import csv
+import json
 import logging
 import re
-from typing import Optional
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Optional, TextIO
 from urllib.parse import urlparse
 
+from lib.checker import PROBE_MODES
+from lib.compact import LEGACY_TABLE, compact_check_log
 from lib.config import load_config
 from lib.db import initialize_pool, get_pool
+from lib.export import EXPORTERS, FORMATS, RUN_EXPORTS, CountingOutput, export_query
+from lib.importer import IMPORT_COLUMNS, ImportSummary, apply_import
+from lib.partitions import PARTITIONS_QUERY
+from lib.rollup import ROLLUP_COLUMNS, Rollup
 
 
-def _get_arguments(config):
+def _get_validators(config) -> dict[str, Callable]:
     def interval(value):
         m = config['scheduler']['interval']
         if not m <= int(value) <= 300:  # not more than 300 sec
@@ -35,11 +47,73 @@ def _get_arguments(config):
             raise ValueError(e.msg) from e
         return value.strip()
 
+    return {'interval': interval, 'url': url, 'regex': regex}
+
+
+def _get_arguments(config):
+    validators = _get_validators(config)
+    interval, url, regex = validators['interval'], validators['url'], validators['regex']
+
+    def timestamp(value):
+        value = datetime.fromisoformat(value)
+        if value.tzinfo:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def ids(value):
+        return [int(i) for i in value.split(',')]
+
     arguments = argparse.ArgumentParser(description='Simple CLI for URL checker service')
     action = arguments.add_subparsers(dest='action', required=True)
 
     action.add_parser('list', help='list urls')
 
+    action.add_parser('partitions', help='show check log partitions')
+
+    act_cmp = action.add_parser('compact', help='convert check log to compact layout')
+    act_cmp.add_argument(
+        '--drop', help=f'Drop converted table, it\'s kept as {LEGACY_TABLE} by default',
+        action='store_true'
+    )
+
+    act_sts = action.add_parser('stats', help='show url check statistics')
+    act_sts.add_argument('id', help='Record ID', type=int)
+    act_sts.add_argument(
+        '--since', help='Range start, ISO format UTC; default is 24 hours ago', type=timestamp
+    )
+    act_sts.add_argument(
+        '--until', help='Range end, ISO format UTC; default is now', type=timestamp
+    )
+
+    act_exp = action.add_parser('export', help='export check log')
+    act_exp.add_argument('--id', help='Record IDs, comma separated', type=ids, dest='ids')
+    act_exp.add_argument('--since', help='Range start, ISO format UTC', type=timestamp)
+    act_exp.add_argument('--until', help='Range end, ISO format UTC', type=timestamp)
+    act_exp.add_argument(
+        '--failures', help='Failed checks only: errors, HTTP status >= 400, content mismatch',
+        action='store_true'
+    )
+    act_exp.add_argument(
+        '-r', '--runs', help='Check runs of "runs" log mode are expanded into checks having '
+        'average timings, or checks are summarized as runs; default is expand',
+        choices=RUN_EXPORTS, default='expand'
+    )
+    act_exp.add_argument('-f', '--format', help='Output format', choices=FORMATS, default='csv')
+    act_exp.add_argument('-o', '--output', help='Output file, default is stdout')
+
+    for name, help in (('import', 'add or update urls from file'),
+                       ('sync', 'add, update or disable urls to match the file')):
+        act_imp = action.add_parser(name, help=help)
+        act_imp.add_argument(
+            'file', help='CSV file with header or JSON lines, default is stdin', nargs='?',
+            type=argparse.FileType('r'), default=sys.stdin
+        )
+        act_imp.add_argument(
+            '-f', '--format', help='File format, default is guessed by file extension',
+            choices=('csv', 'jsonl')
+        )
+        act_imp.set_defaults(validators=validators)
+
     act_shw = action.add_parser('show', help='show url details')
     act_shw.add_argument('id', help='Record ID', type=int)
 
@@ -53,6 +127,23 @@ def _get_arguments(config):
     act_add.add_argument(
         'content_rx', help='Content check regex', nargs='?', type=regex, metavar='regex'
     )
+    act_add.add_argument(
+        '-k', '--keep-alive', help='Reuse kept-alive connection instead of a new one',
+        action='store_true', dest='reuse_connection'
+    )
+    act_add.add_argument(
+        '-b', '--max-body-bytes', help='Response body size limit', type=int
+    )
+    act_add.add_argument(
+        '-o', '--origin-concurrency', help='Concurrent checks limit for url origin', type=int
+    )
+    act_add.add_argument(
+        '-p', '--probe', help='Request made by checks, default is get', choices=PROBE_MODES
+    )
+    act_add.add_argument(
+        '-P', '--priority', help='Check priority under overload, default is 0', type=int,
+        default=0
+    )
 
     act_rem = action.add_parser('remove', help='remove url')
     act_rem.add_argument('id', help='Record ID', type=int)
@@ -78,6 +169,29 @@ def _get_arguments(config):
         const=False,
         dest='content_rx',
     )
+    act_upd_ka = act_upd.add_mutually_exclusive_group()
+    act_upd_ka.set_defaults(reuse_connection=None)
+    act_upd_ka.add_argument(
+        '-k', '--keep-alive', help='Reuse kept-alive connection',
+        action='store_true', dest='reuse_connection'
+    )
+    act_upd_ka.add_argument(
+        '-K', '--new-connection', help='Use a new connection for each check',
+        action='store_false', dest='reuse_connection'
+    )
+    act_upd.add_argument(
+        '-b', '--max-body-bytes', help='Set response body size limit', type=int
+    )
+    act_upd.add_argument(
+        '-o', '--origin-concurrency', help='Set concurrent checks limit for url origin',
+        type=int
+    )
+    act_upd.add_argument(
+        '-p', '--probe', help='Set request made by checks', choices=PROBE_MODES
+    )
+    act_upd.add_argument(
+        '-P', '--priority', help='Set check priority under overload', type=int
+    )
     act_upd.add_argument(
         '-i',
         '--interval',
@@ -89,12 +203,16 @@ def _get_arguments(config):
 
 
 # region Actions
-async def action_add(url: str, interval: int, regex: Optional[str]):
+async def action_add(url: str, interval: int, content_rx: Optional[str],
+                     reuse_connection: bool, max_body_bytes: Optional[int],
+                     origin_concurrency: Optional[int], probe: Optional[str], priority: int):
     async with get_pool().acquire() as conn:
         new_id = await conn.fetchval(
-            'INSERT INTO watchlist (url, "interval", content_rx) '
-            'VALUES ($1, $2, $3) RETURNING id',
-            url, interval, regex,
+            'INSERT INTO watchlist (url, "interval", content_rx, reuse_connection, '
+            'max_body_bytes, origin_concurrency, probe, priority) '
+            'VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING id',
+            url, interval, content_rx, reuse_connection, max_body_bytes, origin_concurrency,
+            probe, priority,
         )
         print('Successfully created record with id =', new_id)
 
@@ -122,6 +240,10 @@ async def action_update(id: int, **kwargs):
         print('Nothing to update')
         return
 
+    # updated regex must be validated by scheduler again
+    if kwargs.get('content_rx') is not None:
+        updates.append('content_rx_error = NULL')
+
     async with get_pool().acquire() as conn:
         query = 'UPDATE watchlist SET ' + ', '.join(updates) + ' WHERE id = $1'
         ret = await conn.execute(query, *values)
@@ -129,10 +251,10 @@ async def action_update(id: int, **kwargs):
 
 
 async def action_list():
-    list_tpl = '{:>10} {:>1.1} {:>3.3} {:19.19} {:19.19} {:40.40} {:20.20}'
+    list_tpl = '{:>10} {:>1.1} {:>3.3} {:>1.1} {:19.19} {:40.40} {:20.20}'
     async with get_pool().acquire() as conn:
         data = await conn.fetch(
-            'SELECT id, enable, interval, last_start, url, content_rx '
+            'SELECT id, enable, interval, reuse_connection, last_start, url, content_rx '
             'FROM watchlist'
         )
         if not data:
@@ -147,7 +269,8 @@ async def action_list():
 async def action_show(id: int):
     async with get_pool().acquire() as conn:
         record = await conn.fetchrow(
-            'SELECT id, enable, interval, last_start, url, content_rx '
+            'SELECT id, enable, interval, reuse_connection, max_body_bytes, origin_concurrency, '
+            'probe, priority, last_start, cert_expires, url, content_rx, content_rx_error '
             'FROM watchlist WHERE id = $1', id
         )
         if not record:
@@ -155,6 +278,209 @@ async def action_show(id: int):
             return
         for field in record.items():
             print('{:>15}: {}'.format(*field))
+
+
+async def action_partitions():
+    list_tpl = '{:20.20} {:60.60} {:>10} {:>12}'
+    async with get_pool().acquire() as conn:
+        data = await conn.fetch(PARTITIONS_QUERY)
+        if not data:
+            print('No partitions')
+            return
+        print(list_tpl.format(*data[0].keys()))
+        print('-' * 105)
+        for record in data:
+            print(list_tpl.format(record['name'], record['bounds'], _size(record['size']),
+                                  max(record['rows'], 0)))
+        print('-' * 105)
+        print(list_tpl.format('total', '', _size(sum(r['size'] for r in data)),
+                              sum(max(r['rows'], 0) for r in data)))
+
+
+async def action_compact(drop: bool):
+    script = (Path(__file__).parent / 'db/structure.sql').read_text()
+    tm0 = time.monotonic()
+    async with get_pool().acquire() as conn:
+        report = await compact_check_log(conn, script, drop)
+    if report is None:
+        print('check_log has compact layout already')
+        return
+
+    print(f'Converted {report.rows} rows, {report.errors} error messages '
+          f'in {time.monotonic() - tm0:.1f}s')
+    for name, before, after in (
+        ('table', report.table_before, report.table_after),
+        ('indexes', report.indexes_before, report.indexes_after),
+        ('total', report.table_before + report.indexes_before,
+         report.table_after + report.indexes_after),
+    ):
+        print('{:>8}: {} -> {}, {:.1f} -> {:.1f} bytes per row'.format(
+            name, _size(before), _size(after), report.bytes_per_row(before),
+            report.bytes_per_row(after)
+        ))
+    if not drop:
+        print(f'Converted table is kept as {LEGACY_TABLE}')
+
+
+async def action_stats(id: int, since: Optional[datetime], until: Optional[datetime]):
+    until = until or datetime.now(timezone.utc).replace(tzinfo=None)
+    since = since or until - timedelta(days=1)
+
+    # whole hours from hourly rollups, edges from minute ones
+    hour_since = since.replace(minute=0, second=0, microsecond=0)
+    if hour_since < since:
+        hour_since += timedelta(hours=1)
+    hour_until = until.replace(minute=0, second=0, microsecond=0)
+    if hour_since >= hour_until:
+        hour_since = hour_until = until
+
+    columns = ', '.join(ROLLUP_COLUMNS)
+    async with get_pool().acquire() as conn:
+        data = await conn.fetch(
+            f'SELECT {columns} FROM check_stat_hour '
+            'WHERE wl_id = $1 AND bucket >= $4 AND bucket < $5 '
+            f'UNION ALL SELECT {columns} FROM check_stat_minute '
+            'WHERE wl_id = $1 AND (bucket >= $2 AND bucket < $4 OR bucket >= $5 AND bucket < $3)',
+            id, since.replace(second=0, microsecond=0), until, hour_since, hour_until
+        )
+
+    stats = Rollup()
+    for record in data:
+        stats.merge(Rollup(**record))
+
+    print('{:>16}: {} .. {}'.format('range', since, until))
+    print('{:>16}: {}'.format('checks', stats.checks))
+    if not stats.checks:
+        return
+    print('{:>16}: {:.3f}%'.format('uptime', 100 * (1 - stats.failures / stats.checks)))
+    print('{:>16}: {}'.format('failures', stats.failures))
+    print('{:>16}: {}'.format('content failures', stats.content_failures))
+    if not stats.timed:
+        return
+    for name in ('connect', 'ttfb', 'response'):
+        print('{:>16}: avg {:.1f}, min {}, max {}'.format(
+            name + ' ms', stats.average(name), getattr(stats, f'{name}_min'),
+            getattr(stats, f'{name}_max')
+        ))
+    print('{:>16}: p50 {:.0f}, p95 {:.0f}, p99 {:.0f}'.format(
+        'response ms', stats.percentile(0.5), stats.percentile(0.95), stats.percentile(0.99)
+    ))
+
+
+async def action_export(ids: Optional[list[int]], since: Optional[datetime],
+                        until: Optional[datetime], failures: bool, runs: str, format: str,
+                        output: Optional[str]):
+    if format == 'parquet' and not output:
+        sys.exit('Parquet export requires output file')
+
+    query, args = export_query(ids, since, until, failures, runs)
+    with open(output, 'wb') if output else open(sys.stdout.fileno(), 'wb', closefd=False) as fp:
+        out = CountingOutput(fp)
+        tm0 = time.monotonic()
+        async with get_pool().acquire() as conn:
+            rows = await EXPORTERS[format](conn, out, query, args)
+        elapsed = max(time.monotonic() - tm0, 1e-6)
+
+    print(f'Exported {rows} rows, {_size(out.size)} in {elapsed:.1f}s: '
+          f'{rows / elapsed:.0f} rows/s, {_size(out.size / elapsed)}/s', file=sys.stderr)
+
+
+_BOOLEANS = {'true': True, 't': True, 'yes': True, 'y': True, '1': True,
+             'false': False, 'f': False, 'no': False, 'n': False, '0': False}
+
+
+def _read_import(file: TextIO, format: Optional[str], validators: dict[str, Callable]
+                 ) -> tuple[list[str], list[tuple], int]:
+    '''
+    Read and validate import file, returns columns, rows and number of rejected rows
+    '''
+    def boolean(value):
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() not in _BOOLEANS:
+            raise ValueError(f'Invalid boolean {value!r}')
+        return _BOOLEANS[str(value).lower()]
+
+    def probe(value):
+        if value not in PROBE_MODES:
+            raise ValueError(f'Invalid probe {value!r}')
+        return value
+
+    converters = {
+        'url': validators['url'],
+        'interval': validators['interval'],
+        'content_rx': validators['regex'],
+        'enable': boolean,
+        'reuse_connection': boolean,
+        'max_body_bytes': int,
+        'origin_concurrency': int,
+        'probe': probe,
+        'priority': int,
+    }
+
+    if format is None:
+        format = 'jsonl' if file.name.endswith(('.jsonl', '.json')) else 'csv'
+    records = filter(str.strip, file) if format == 'jsonl' else csv.DictReader(file)
+
+    columns: list[str] = []
+    # rows by url, and their numbers
+    rows: dict[str, tuple] = {}
+    row_numbers: dict[str, int] = {}
+    rejected = 0
+    for i, record in enumerate(records, 1):
+        try:
+            if format == 'jsonl':
+                record = json.loads(record)
+            if not columns:
+                columns = [c for c in IMPORT_COLUMNS if c in record]
+                unknown = set(record) - set(columns)
+                if unknown:
+                    sys.exit(f'Unknown columns: {", ".join(map(str, unknown))}')
+                if 'url' not in columns or 'interval' not in columns:
+                    sys.exit('url and interval columns are required')
+            row = tuple(
+                converters[c](record[c]) if record.get(c) not in (None, '') else None
+                for c in columns
+            )
+            if row[0] is None or row[1] is None:
+                raise ValueError('url and interval are required')
+            if row[0] in rows:
+                raise ValueError(f'duplicate url of row {row_numbers[row[0]]}')
+        except (ValueError, TypeError) as e:
+            print(f'Row {i} rejected: {e}', file=sys.stderr)
+            rejected += 1
+            continue
+        rows[row[0]] = row
+        row_numbers[row[0]] = i
+
+    return columns, list(rows.values()), rejected
+
+
+async def action_import(file: TextIO, format: Optional[str], validators: dict[str, Callable],
+                        sync: bool = False):
+    columns, rows, rejected = _read_import(file, format, validators)
+    if rows:
+        async with get_pool().acquire() as conn:
+            summary = await apply_import(conn, columns, rows, sync)
+    else:
+        summary = ImportSummary()
+    summary.rejected = rejected
+    for url in summary.ambiguous:
+        print(f'Not imported, url matches several records: {url}', file=sys.stderr)
+    print(f'Inserted {summary.inserted}, updated {summary.updated}, '
+          f'disabled {summary.disabled}, rejected {summary.rejected} records')
+
+
+async def action_sync(**kwargs):
+    await action_import(sync=True, **kwargs)
+
+
+def _size(value: int) -> str:
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if value < 1024:
+            return f'{value:.0f} {unit}'
+        value /= 1024  # type:ignore
+    return f'{value:.0f} TB'
 # endregion
 
 
@@ -165,6 +491,12 @@ async def execute(action: str, **kwargs):
         'update': action_update,
         'list': action_list,
         'show': action_show,
+        'partitions': action_partitions,
+        'compact': action_compact,
+        'stats': action_stats,
+        'export': action_export,
+        'import': action_import,
+        'sync': action_sync,
     }[action](**kwargs)
 
 
@@ -175,5 +507,9 @@ if __name__ == '__main__':
     args = _get_arguments(config)
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(initialize_pool(**config['db']))
+    db = dict(config['db'])
+    if args.action == 'compact':
+        # conversion statements run as long as the table is large
+        db['command_timeout'] = None
+    loop.run_until_complete(initialize_pool(**db))
     loop.run_until_complete(execute(**vars(args)))
@@ -3,19 +3,222 @@ create table if not exists watchlist (
     enable boolean not null default true,
     url varchar(2048) not null,
     content_rx varchar(2048),
+    -- content_rx compilation error, such records are not checked
+    content_rx_error varchar,
     interval integer not null,
-    last_start timestamp
+    -- check using a kept-alive connection instead of a new one
+    reuse_connection boolean not null default false,
+    -- response body size limit, overrides global setting
+    max_body_bytes integer,
+    -- concurrent checks limit for the url origin, overrides global setting
+    origin_concurrency integer,
+    -- request made by checks, see lib/checker.py PROBE_MODES; NULL is get
+    probe varchar(16) constraint ck_watchlist_probe
+        check (probe in ('get', 'head', 'range', 'conditional')),
+    -- due checks of higher priority run first under overload, the lowest ones may be shed,
+    -- see lib/dispatcher.py OverloadPolicy
+    priority smallint not null default 0,
+    -- peer certificate expiration seen by the last TLS handshake
+    cert_expires timestamp,
+    last_start timestamp,
+    -- scheduler instance which claimed the record, see lease scheduler mode
+    lease_owner varchar,
+    lease_until timestamp
 );
 
+-- columns added since the first release, so applying this script upgrades existing tables
+alter table watchlist
+    add column if not exists content_rx_error varchar,
+    add column if not exists reuse_connection boolean not null default false,
+    add column if not exists max_body_bytes integer,
+    add column if not exists origin_concurrency integer,
+    add column if not exists probe varchar(16) constraint ck_watchlist_probe
+        check (probe in ('get', 'head', 'range', 'conditional')),
+    add column if not exists priority smallint not null default 0,
+    add column if not exists cert_expires timestamp,
+    add column if not exists lease_owner varchar,
+    add column if not exists lease_until timestamp;
+
+-- interned check error messages, ids are cached by writers, rows are never deleted
+create table if not exists check_error (
+    id serial primary key,
+    message varchar not null
+);
+
+-- messages may be longer than a btree index entry
+create unique index if not exists ux_check_error_message on check_error (md5(message));
+
+-- partitioned by month of "start", partitions are created and removed by the service,
+-- see lib/partitions.py
+-- columns are ordered by alignment, so rows have no padding; existing check_log is converted
+-- to this layout by "cli.py compact", see lib/compact.py
 create table if not exists check_log (
-    wl_id int constraint fk_watchlist references watchlist (id) on delete cascade,
     "start" timestamp not null,
-    "end" timestamp,
-    "connect" int,
+    wl_id int constraint fk_watchlist references watchlist (id) on delete cascade,
+    -- check duration (ms), check end is "start" + duration
+    duration int,
+    -- request phases since the check start, excluding DNS lookup (ms):
+    -- the first response byte, response complete
     ttfb int,
     response int,
+    -- check_error id of the error message, not a foreign key, so inserts don't look it up
+    error_id int,
+    -- response body bytes received
+    bytes_received int,
+    status_code smallint,
+    -- durations of DNS lookup, TCP and TLS handshakes (ms), up to 32767
+    dns smallint,
+    tcp smallint,
+    tls smallint,
+    -- earlier request phases (ms), up to 32767: connection made, request sent
+    "connect" smallint,
+    sent smallint,
+    content_check boolean,
+    -- connection was reused, so "connect" is 0
+    reused boolean,
+    -- content check was decided before the end of response body
+    early_match boolean,
+    -- response body was read up to max_body_bytes only
+    truncated boolean,
+    -- TLS session was resumed, NULL when no TLS connection is made
+    tls_resumed boolean,
+    -- request made, see watchlist.probe
+    probe varchar(16),
+    constraint pk_check_log primary key (wl_id, "start")
+) partition by range ("start");
+
+-- columns added to check_log of the first release layout, which is kept as is otherwise
+alter table check_log
+    add column if not exists dns smallint,
+    add column if not exists tcp smallint,
+    add column if not exists tls smallint,
+    add column if not exists sent smallint,
+    add column if not exists reused boolean,
+    add column if not exists early_match boolean,
+    add column if not exists truncated boolean,
+    add column if not exists tls_resumed boolean,
+    add column if not exists probe varchar(16),
+    add column if not exists bytes_received int;
+
+-- rows not fitting monthly partitions, and check_log in the result record layout,
+-- with check end and error message; made once check_log is converted by "cli.py compact"
+do $$
+begin
+    if exists (select from pg_partitioned_table where partrelid = 'check_log'::regclass)
+            and exists (select from pg_attribute
+                        where attrelid = 'check_log'::regclass and attname = 'error_id') then
+        create table if not exists check_log_default partition of check_log default;
+
+        create or replace view check_log_view as
+        select wl_id, "start", "start" + duration * interval '1 millisecond' as "end", dns,
+            "connect", ttfb, response, status_code, content_check,
+            (select message from check_error e where e.id = l.error_id) as error_message,
+            reused, early_match, truncated, tcp, tls, sent, probe, bytes_received, tls_resumed
+        from check_log l;
+    end if;
+end
+$$;
+
+-- consecutive checks of the same outcome merged, written instead of check_log
+-- in "runs" log mode, see lib/runs.py
+create table if not exists check_run (
+    wl_id int not null references watchlist (id) on delete cascade,
+    first_start timestamp not null,
+    last_start timestamp not null,
+    last_end timestamp,
+    checks int not null,
     status_code int,
     content_check boolean,
     error_message varchar,
-    constraint pk_check_log primary key (wl_id, "start")
+    -- checks having timings (ms), use for averages
+    timed int not null,
+    connect_min int,
+    connect_max int,
+    connect_sum bigint not null,
+    ttfb_min int,
+    ttfb_max int,
+    ttfb_sum bigint not null,
+    response_min int,
+    response_max int,
+    response_sum bigint not null,
+    primary key (wl_id, first_start)
+);
+
+-- check runs not made by overload policy, explaining gaps of check_log, see lib/dispatcher.py
+create table if not exists check_skip (
+    wl_id int not null references watchlist (id) on delete cascade,
+    -- scheduled time of the first skipped run
+    run_at timestamp not null,
+    runs int not null,
+    -- "coalesced" into a later check, or "shed" under overload
+    reason varchar(16) not null
+);
+
+create index if not exists ix_check_skip on check_skip (wl_id, run_at);
+
+-- check results aggregated per minute and per hour, maintained by the writer
+create table if not exists check_stat_minute (
+    wl_id int not null references watchlist (id) on delete cascade,
+    bucket timestamp not null,
+    checks int not null,
+    failures int not null,
+    content_failures int not null,
+    timed int not null,
+    connect_min int,
+    connect_max int,
+    connect_sum bigint not null,
+    ttfb_min int,
+    ttfb_max int,
+    ttfb_sum bigint not null,
+    response_min int,
+    response_max int,
+    response_sum bigint not null,
+    -- response time histogram, see lib/rollup.py HISTOGRAM_BOUNDS
+    histogram int[] not null,
+    primary key (wl_id, bucket)
+);
+
+create table if not exists check_stat_hour (
+    wl_id int not null references watchlist (id) on delete cascade,
+    bucket timestamp not null,
+    checks int not null,
+    failures int not null,
+    content_failures int not null,
+    timed int not null,
+    connect_min int,
+    connect_max int,
+    connect_sum bigint not null,
+    ttfb_min int,
+    ttfb_max int,
+    ttfb_sum bigint not null,
+    response_min int,
+    response_max int,
+    response_sum bigint not null,
+    -- response time histogram, see lib/rollup.py HISTOGRAM_BOUNDS
+    histogram int[] not null,
+    primary key (wl_id, bucket)
 );
+
+-- element-wise sum of histograms
+create or replace function hist_add(a int[], b int[]) returns int[]
+language sql immutable as $$
+    select array_agg(coalesce(x, 0) + coalesce(y, 0) order by i)
+    from unnest(a, b) with ordinality as h(x, y, i)
+$$;
+
+-- notify timer scheduler about watchlist changes, payload is "<operation>:<id>"
+-- NOTE: scheduling fields (last_start) are not watched
+create or replace function watchlist_notify() returns trigger language plpgsql as $$
+begin
+    perform pg_notify('watchlist_changed', tg_op || ':' || coalesce(new.id, old.id));
+    return null;
+end
+$$;
+
+drop trigger if exists watchlist_changed on watchlist;
+create trigger watchlist_changed
+    after insert or delete
+    or update of enable, url, content_rx, content_rx_error, interval, reuse_connection,
+        max_body_bytes, origin_concurrency, probe, priority
+    on watchlist
+    for each row execute function watchlist_notify();
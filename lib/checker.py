@@ -1,69 +1,358 @@
 '''
 Response checking and timing routines
 '''
+import codecs
 import logging
 import re
+from collections import OrderedDict
+from contextlib import nullcontext
 from time import perf_counter_ns
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Union
 import httpx
 
+from lib.matcher import SearchError, search
+from lib.metrics import histogram
+from lib.network import ConnectionTimings, Transport, connection_timings, initialize_tls
+from lib.patterns import compile_pattern
+
 
 @dataclass
 class CheckResult:  # pylint:disable=C0115
+    # durations of DNS lookup, TCP and TLS handshakes (ms), see lib.network.ConnectionTimings
+    dns: Optional[int] = None
+    tcp: Optional[int] = None
+    tls: Optional[int] = None
+    # request phases since the check start, excluding DNS lookup (ms):
+    # connection made, request sent, the first response byte, response complete
     connection: Optional[int] = None
+    sent: Optional[int] = None
     ttfb: Optional[int] = None
     response: Optional[int] = None
     status_code: Optional[int] = None
     content_check: Optional[bool] = None
     error_message: Optional[str] = None
+    # connection was taken from the shared client pool
+    reused: Optional[bool] = None
+    # content check was decided before the end of response body
+    early_match: Optional[bool] = None
+    # response body was read up to `max_body_bytes` only
+    truncated: Optional[bool] = None
+    # request made, see PROBE_MODES, and response body bytes received
+    probe: Optional[str] = None
+    bytes_received: Optional[int] = None
+    # TLS session was resumed, peer certificate expiration (unix time);
+    # set when a TLS connection is made by the check
+    tls_resumed: Optional[bool] = None
+    cert_expires: Optional[float] = None
+
+
+# - `get` downloads the body
+# - `head` requests headers only, unless content is checked;
+#   falls back to `get` when server doesn't support HEAD
+# - `range` requests the first `range_bytes` or `max_body_bytes` bytes of the body
+# - `conditional` sends ETag and Last-Modified validators of the previous response,
+#   content check result of which is reused when the body is not modified
+PROBE_MODES = ('get', 'head', 'range', 'conditional')
+# HEAD response statuses making the url checked with GET
+_HEAD_UNSUPPORTED = (405, 501)
+
+
+@dataclass
+class ProbeState:  # pylint:disable=C0115
+    # validators of the last full response and its content check
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_rx: Optional[str] = None
+    content_check: Optional[bool] = None
+    # server doesn't support HEAD requests
+    no_head: bool = False
 
 
 _logger = logging.getLogger(__name__)
 
-async def check_url(url: str, content_re: Optional[str] = None,
-                    timeout: float = 5.0, connect_timeout: float = 10.0) -> CheckResult:
+_phases = histogram('check_phase_seconds', 'Check timings by phase', ('phase',))
+_phase_dns = _phases.labels('dns')
+_phase_tcp = _phases.labels('tcp')
+_phase_tls = _phases.labels('tls')
+_phase_connect = _phases.labels('connect')
+_phase_sent = _phases.labels('sent')
+_phase_ttfb = _phases.labels('ttfb')
+_phase_response = _phases.labels('response')
+
+_client: httpx.AsyncClient = None # type:ignore
+
+# response body streaming parameters, see initialize_client()
+_max_body_bytes = 10485760
+_chunk_size = 65536
+_match_window = 65536
+# probe modes parameters
+_range_bytes = 1024
+_probe_states: OrderedDict[str, ProbeState] = OrderedDict()
+_probe_cache_size = 100000
+
+
+def initialize_client(max_connections: int = 1000, max_keepalive_connections: int = 100,
+                      keepalive_expiry: float = 30.0, http2: bool = True,
+                      max_body_bytes: int = 10485760, chunk_size: int = 65536,
+                      match_window: int = 65536, range_bytes: int = 1024,
+                      probe_cache_size: int = 100000, tls_resumption: bool = False,
+                      tls_session_cache_size: int = 10000):
     '''
-    Main URL checking worker routine
+    Initialize long-lived HTTP client shared by checks reusing connections,
+    response body streaming, probe modes and TLS session resumption parameters
+    '''
+    global _client, _max_body_bytes, _chunk_size, _match_window  # pylint:disable=W0603
+    global _range_bytes, _probe_cache_size  # pylint:disable=W0603
+
+    _max_body_bytes = max_body_bytes
+    _chunk_size = chunk_size
+    _match_window = match_window
+    _range_bytes = range_bytes
+    _probe_cache_size = probe_cache_size
+    initialize_tls(tls_resumption, tls_session_cache_size)
+
+    if _client:
+        return
+
+    _client = httpx.AsyncClient(follow_redirects=False,
+                                transport=Transport(http2, httpx.Limits(
+                                    max_connections=max_connections,
+                                    max_keepalive_connections=max_keepalive_connections,
+                                    keepalive_expiry=keepalive_expiry,
+                                )))
+
+
+async def close_client():
+    '''
+    Close shared HTTP client and all its connections
+    '''
+    global _client  # pylint:disable=W0603
+
+    if _client:
+        await _client.aclose()
+        _client = None # type:ignore
+
+
+def get_client():
+    '''
+    Shared HTTP client instance wrapper
+    '''
+    return _client
+
+
+async def check_url(url: str, content_re: Union[str, re.Pattern, None] = None,
+                    timeout: float = 5.0, connect_timeout: float = 10.0,
+                    reuse_connection: bool = False,
+                    max_body_bytes: Optional[int] = None,
+                    probe: Optional[str] = None) -> CheckResult:
+    '''
+    Main URL checking worker routine.
+    With `reuse_connection` request is sent using a warm connection from the shared client,
+    otherwise a new connection is made, so connect timings are measured.
+    Response body is streamed and matched against `content_re` chunk by chunk,
+    reading stops on the first match or after `max_body_bytes`.
+    `probe` mode defines the request made, see PROBE_MODES.
     '''
 
     result = CheckResult()
-    tm0 = 0
-
-    async def _trace_times(event_name, _):
-        nonlocal tm0
-
-        if event_name == 'connection.connect_tcp.started':
-            tm0 = perf_counter_ns()
-        elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete',
-                            'http2.send_connection_init.complete'):
-            result.connection = (perf_counter_ns() - tm0) // 1000000  # truncate to milliseconds
-        elif event_name in ('http2.receive_response_headers.started',
-                            'http11.receive_response_headers.started'):
-            # BUG this event doesn't represent data receive event, but begin wait for data
-            result.ttfb = (perf_counter_ns() - tm0) // 1000000  # truncate to milliseconds
-        elif event_name in ('http2.receive_response_body.complete',
-                            'http11.receive_response_body.complete'):
-            result.response = (perf_counter_ns() - tm0) // 1000000  # truncate to milliseconds
-
-    async with httpx.AsyncClient(http2=True,
-                                 follow_redirects=False,
-                                 timeout=httpx.Timeout(timeout,
-                                                         connect=connect_timeout)) as client:
+
+    pattern = None
+    if isinstance(content_re, re.Pattern):
+        pattern = content_re
+    elif content_re:
         try:
-            response = await client.get(url, extensions={'trace': _trace_times})
-            result.status_code = response.status_code
+            pattern = compile_pattern(content_re)
+        except re.error as e:
+            _logger.error('Invalid content_re (%r): %s', content_re, e)
+            result.error_message = str(e)
 
-            if content_re:
-                try:
-                    result.content_check = bool(re.search(content_re, response.text,
-                                                            re.MULTILINE | re.DOTALL))
-                except re.error as e:
-                    _logger.error('Invalid content_re (%r): %s', content_re, e)
-                    result.error_message = str(e)
+    if max_body_bytes is None:
+        max_body_bytes = _max_body_bytes
+    headers = {}
+    state = _probe_states.get(url)
+    if state:
+        _probe_states.move_to_end(url)
+
+    result.probe = probe or 'get'
+    if result.probe == 'head' and (pattern or state and state.no_head):
+        # nothing to match in HEAD response
+        result.probe = 'get'
+    elif result.probe == 'range':
+        max_body_bytes = min(max_body_bytes, _range_bytes)
+        headers['Range'] = f'bytes=0-{max_body_bytes - 1}'
+    elif result.probe == 'conditional' and state \
+            and state.content_rx == (pattern.pattern if pattern else None):
+        if state.etag:
+            headers['If-None-Match'] = state.etag
+        if state.last_modified:
+            headers['If-Modified-Since'] = state.last_modified
+
+    timeouts = httpx.Timeout(timeout, connect=connect_timeout)
+    if reuse_connection and _client:
+        client_context = nullcontext(_client)
+    else:
+        client_context = httpx.AsyncClient(follow_redirects=False, transport=Transport())
+
+    timings = ConnectionTimings()
+    # timings of the request which made the connection, when it's not the last one
+    connection = None
+    async with client_context as client:
+        try:
+            await _request(client, url, headers, timeouts, pattern, max_body_bytes,
+                           result, state, timings)
+            if result.probe == 'head' and result.status_code in _HEAD_UNSUPPORTED:
+                _set_probe_state(url).no_head = True
+                result.probe = 'get'
+                head, timings = timings, ConnectionTimings()
+                await _request(client, url, headers, timeouts, pattern, max_body_bytes,
+                               result, state, timings)
+                if timings.tcp is None and head.tcp is not None:
+                    # GET reused the connection opened by HEAD of this check
+                    connection = head
+                    result.reused = False
         except httpx.TransportError as e:
             _logger.error('%r: %r', url, e)
             # exception may have an empty message
             result.error_message = str(e) or e.__class__.__name__
 
+    _set_timings(result, timings, connection)
+    for phase, value in ((_phase_dns, result.dns), (_phase_tcp, result.tcp),
+                         (_phase_tls, result.tls), (_phase_connect, result.connection),
+                         (_phase_sent, result.sent), (_phase_ttfb, result.ttfb),
+                         (_phase_response, result.response)):
+        if value is not None:
+            phase.observe(value / 1000)
+
     return result
+
+
+async def _request(client: httpx.AsyncClient, url: str, headers: dict[str, str],
+                   timeouts: httpx.Timeout, pattern: Optional[re.Pattern], max_body_bytes: int,
+                   result: CheckResult, state: Optional[ProbeState], timings: ConnectionTimings):
+    '''
+    Make probe request, fill result with response details and timings
+    '''
+    timings_token = connection_timings.set(timings)
+    try:
+        timings.start = perf_counter_ns()
+        async with client.stream('HEAD' if result.probe == 'head' else 'GET', url,
+                                 headers=headers, timeout=timeouts,
+                                 extensions={'trace': timings.trace}) as response:
+            # connection is made by lib.network.ResolvingBackend
+            result.reused = timings.tcp is None
+            result.status_code = response.status_code
+
+            if response.status_code == 304 and state:
+                # not modified, the previous body check stands
+                result.content_check = state.content_check if pattern else None
+                result.truncated = False
+            else:
+                await _read_body(response, pattern, result, max_body_bytes)
+                if result.probe == 'conditional' and response.status_code == 200:
+                    _save_validators(url, response, pattern, result)
+            # leaving the context closes the connection if body is not read completely
+            timings.end = perf_counter_ns()
+            result.bytes_received = response.num_bytes_downloaded
+    finally:
+        connection_timings.reset(timings_token)
+
+
+def _set_probe_state(url: str) -> ProbeState:
+    state = _probe_states.get(url)
+    if state is None:
+        state = _probe_states[url] = ProbeState()
+        while len(_probe_states) > _probe_cache_size:
+            _probe_states.popitem(last=False)
+    return state
+
+
+def _save_validators(url: str, response: httpx.Response, pattern: Optional[re.Pattern],
+                     result: CheckResult):
+    etag = response.headers.get('etag')
+    last_modified = response.headers.get('last-modified')
+    if not (etag or last_modified or url in _probe_states):
+        return
+    state = _set_probe_state(url)
+    state.etag = etag
+    state.last_modified = last_modified
+    state.content_rx = pattern.pattern if pattern else None
+    state.content_check = result.content_check
+
+
+def _set_timings(result: CheckResult, timings: ConnectionTimings,
+                 connection: Optional[ConnectionTimings] = None):
+    # connection phases are taken from `connection`, when it was made by a previous request
+    def ms(ns: Optional[int]) -> Optional[int]:
+        # truncate to milliseconds
+        return None if ns is None else ns // 1000000
+
+    connection = connection or timings
+    result.dns = ms(connection.dns)
+    result.tcp = ms(connection.tcp)
+    result.tls = ms(connection.tls)
+    result.tls_resumed = connection.tls_resumed
+    result.cert_expires = connection.cert_expires
+    if connection.tcp is not None:
+        result.connection = ms(connection.tcp + (connection.tls or 0))
+    elif result.reused:
+        result.connection = 0
+
+    # DNS lookup is excluded from request phases
+    origin = (timings.start or 0) + (timings.dns or 0)
+    result.sent = ms(timings.sent and timings.sent - origin)
+    result.ttfb = ms(timings.first_byte and timings.first_byte - origin)
+    result.response = ms(timings.end and timings.end - origin)
+
+
+async def _read_body(response: httpx.Response, pattern: Optional[re.Pattern],
+                     result: CheckResult, max_body_bytes: int):
+    '''
+    Stream response body, matching it against `pattern`.
+    A match may span chunks by at most `_match_window` characters.
+    Reading stops when the pattern can't be searched, see lib.matcher.
+    '''
+    try:
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    received = 0
+    result.truncated = False
+    text = ''
+    # 1 when the first character of text is kept from the previous search only as a context
+    # for `^` and lookbehinds, any match starting there was already checked
+    context = 0
+    async for chunk in response.aiter_bytes(_chunk_size):
+        if received + len(chunk) > max_body_bytes:
+            chunk = chunk[:max_body_bytes - received]
+            result.truncated = True
+        received += len(chunk)
+
+        if pattern:
+            text += decoder.decode(chunk)
+            try:
+                span = await search(pattern, text, context)
+            except SearchError as e:
+                result.error_message = str(e)
+                return
+            # a match touching the end of text may depend on data not received yet
+            if span and span[1] < len(text):
+                result.content_check = True
+                result.early_match = True
+                return
+            if len(text) > _match_window + 1:
+                text = text[-_match_window - 1:]
+                context = 1
+
+        if result.truncated:
+            break
+
+    if pattern:
+        text += decoder.decode(b'', True)
+        try:
+            result.content_check = bool(await search(pattern, text, context))
+        except SearchError as e:
+            result.error_message = str(e)
+            return
+        result.early_match = False
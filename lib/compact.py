@@ -0,0 +1,150 @@
+'''
+Conversion of existing check_log to the compact layout of db/structure.sql
+'''
+import logging
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional
+
+import asyncpg
+
+from lib.partitions import add_months, create_partition, partition_month
+from lib.writer import CHECK_LOG_COLUMNS, SMALLINT_MAX
+
+_logger = logging.getLogger(__name__)
+
+# converted check_log is renamed to
+LEGACY_TABLE = 'check_log_legacy'
+
+# compact check_log column -> legacy column it's made of and expression,
+# columns missing in legacy table are NULL
+_CONVERSIONS = {
+    'start': ('start', 'l."start"'),
+    'wl_id': ('wl_id', 'l.wl_id'),
+    'duration': ('end', 'round(extract(epoch from l."end" - l."start") * 1000)'),
+    'error_id': ('error_message', 'e.id'),
+    **{name: (name, f'l."{name}"')
+       for name in ('ttfb', 'response', 'bytes_received', 'status_code', 'content_check',
+                    'reused', 'early_match', 'truncated', 'tls_resumed', 'probe')},
+    **{name: (name, f'least(l."{name}", {SMALLINT_MAX})')
+       for name in ('dns', 'tcp', 'tls', 'connect', 'sent')},
+}
+
+# heap (with TOAST) and indexes size of a table and its partitions
+_SIZE_QUERY = '''
+SELECT coalesce(sum(pg_table_size(t.oid)), 0) AS "table",
+    coalesce(sum(pg_indexes_size(t.oid)), 0) AS indexes
+FROM (SELECT $1::regclass AS oid
+      UNION ALL SELECT inhrelid FROM pg_inherits WHERE inhparent = $1::regclass) t
+'''
+
+
+@dataclass
+class CompactReport:  # pylint:disable=C0115
+    rows: int = 0
+    # distinct error messages interned
+    errors: int = 0
+    table_before: int = 0
+    indexes_before: int = 0
+    table_after: int = 0
+    indexes_after: int = 0
+
+    def bytes_per_row(self, size: int) -> float:
+        '''
+        Size per converted row
+        '''
+        return size / self.rows if self.rows else 0.0
+
+
+async def _columns(conn: asyncpg.Connection, table: str) -> set[str]:
+    return {r['attname'] for r in await conn.fetch(
+        'SELECT attname FROM pg_attribute '
+        'WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped', table
+    )}
+
+
+async def _size(conn: asyncpg.Connection, table: str) -> tuple[int, int]:
+    size = await conn.fetchrow(_SIZE_QUERY, table)
+    return size['table'], size['indexes']
+
+
+async def _months(conn: asyncpg.Connection, partitions: list[str]) -> list[date]:
+    months = [m for m in map(partition_month, partitions) if m]
+    if partitions:
+        return months
+
+    # not partitioned, all months of its rows
+    first, last = await conn.fetchrow(
+        f'SELECT min("start")::date, max("start")::date FROM {LEGACY_TABLE}'
+    )
+    month = first and first.replace(day=1)
+    while month and month <= last:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+async def compact_check_log(conn: asyncpg.Connection, script: str, drop: bool = False
+                            ) -> Optional[CompactReport]:
+    '''
+    Convert check_log to the compact layout in a single transaction, returns None
+    when it's compact already. Legacy table (partitioned or not) is renamed to LEGACY_TABLE,
+    `script` (db/structure.sql) creates compact check_log, check_error and check_log_view,
+    partitions of the same months are made, and rows are copied interning error messages.
+    With `drop`, legacy table is dropped then, otherwise it's kept for verification.
+    NOTE: check_log is locked, service must be stopped
+    '''
+    if 'error_id' in await _columns(conn, 'check_log'):
+        return None
+
+    report = CompactReport()
+    async with conn.transaction():
+        report.table_before, report.indexes_before = await _size(conn, 'check_log')
+        partitions = [r['name'] for r in await conn.fetch(
+            'SELECT c.relname AS name FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            "WHERE i.inhparent = 'check_log'::regclass ORDER BY c.relname"
+        )]
+        legacy_columns = await _columns(conn, 'check_log')
+
+        # names of legacy table, its partitions and indexes are taken by the compact ones
+        await conn.execute(f'ALTER TABLE check_log RENAME TO {LEGACY_TABLE}')
+        await conn.execute(
+            f'ALTER INDEX IF EXISTS pk_check_log RENAME TO pk_{LEGACY_TABLE}'
+        )
+        legacy_partitions = [name.replace('check_log', LEGACY_TABLE, 1) for name in partitions]
+        for name, legacy in zip(partitions, legacy_partitions):
+            await conn.execute(f'ALTER TABLE {name} RENAME TO {legacy}')
+            await conn.execute(
+                f'ALTER INDEX IF EXISTS {name}_start_brin RENAME TO {legacy}_start_brin'
+            )
+
+        await conn.execute(script)
+        for month in await _months(conn, partitions):
+            _logger.info('Created partition %s', await create_partition(conn, month))
+
+        status = await conn.execute(
+            'INSERT INTO check_error (message) '
+            f'SELECT DISTINCT error_message FROM {LEGACY_TABLE} '
+            'WHERE error_message IS NOT NULL ORDER BY 1 ON CONFLICT DO NOTHING'
+        )
+        report.errors = int(status.split()[-1])
+
+        columns = ', '.join(f'"{c}"' for c in CHECK_LOG_COLUMNS)
+        values = ', '.join(
+            _CONVERSIONS[c][1] if _CONVERSIONS[c][0] in legacy_columns else 'NULL'
+            for c in CHECK_LOG_COLUMNS
+        )
+        for source in legacy_partitions or [LEGACY_TABLE]:
+            status = await conn.execute(
+                f'INSERT INTO check_log ({columns}) SELECT {values} FROM {source} l '
+                'LEFT JOIN check_error e '
+                'ON md5(e.message) = md5(l.error_message) AND e.message = l.error_message'
+            )
+            rows = int(status.split()[-1])
+            report.rows += rows
+            _logger.info('Converted %d rows of %s', rows, source)
+
+        report.table_after, report.indexes_after = await _size(conn, 'check_log')
+        if drop:
+            await conn.execute(f'DROP TABLE {LEGACY_TABLE}')
+    return report
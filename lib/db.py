@@ -25,6 +25,8 @@ async def initialize_pool(cafile: Optional[str] = None, **connect_kwargs):
         sslctx.verify_mode = ssl.CERT_NONE
 
     connect_kwargs['ssl'] = sslctx
+    # timestamps are written as naive UTC values (see lib.writer)
+    connect_kwargs.setdefault('server_settings', {}).setdefault('timezone', 'UTC')
 
     _pool = await asyncpg.create_pool(**connect_kwargs)  # type: ignore
 
@@ -0,0 +1,291 @@
+'''
+Checks dispatching: deadline ordered queue and worker pool
+'''
+import asyncio
+import logging
+import random
+import re
+from collections import Counter
+from dataclasses import dataclass
+from time import time
+from typing import Any, Callable, Optional
+from urllib.parse import urlsplit
+
+from lib.checker import check_url
+from lib.limiter import AdaptiveLimit, OriginLimiter
+from lib.metrics import counter, gauge, histogram
+from lib.resolver import get_resolver
+from lib.timer import TimerQueue
+from lib.writer import ResultSink
+
+_logger = logging.getLogger(__name__)
+
+_start_lag = histogram('check_start_lag_seconds', 'Check start delay after its run time')
+_in_flight = gauge('checks_in_flight', 'Checks running now')
+_pending = gauge('checks_pending', 'Checks waiting for their run time or a worker')
+_parked = gauge('checks_parked', 'Checks waiting for a free origin slot')
+_checks = counter('checks_total', 'Finished checks by outcome', ('outcome',))
+_outcomes = {outcome: _checks.labels(outcome)
+             for outcome in ('ok', 'error', 'http_error', 'content_mismatch')}
+_skipped = counter('checks_skipped_total', 'Check runs skipped by overload policy', ('reason',))
+_skips = {reason: _skipped.labels(reason) for reason in ('coalesced', 'shed')}
+
+# backlog of due checks is ranked again after this number of seconds,
+# or when ranked checks are taken
+RANK_INTERVAL = 0.1
+
+
+@dataclass
+class OverloadPolicy:  # pylint:disable=C0115
+    # checks of priority below this are shed when overloaded
+    shed_priority: int = 0
+    # overloaded when this number of due checks wait for workers, 0 - never
+    backlog: int = 1000
+    # or when the oldest of them is this number of seconds late, 0 - never
+    lag: float = 10.0
+
+
+def _missed(params: dict[str, Any], run_at: float, now: float) -> int:
+    # runs of the record scheduled after run_at, which are passed by now
+    interval = params.get('interval')
+    return int((now - run_at) // interval) if interval and now > run_at else 0
+
+
+class Dispatcher:
+    '''
+    Submitted checks wait in a queue ordered by run time, and are passed to
+    a fixed pool of worker coroutines when due.
+    A worker is busy only while performing the check and queueing its result.
+    Checks of an origin over its concurrency limit wait for the worker finishing
+    a check of the same origin, so they reuse its connection.
+    With `adaptive` limit, only workers within the current limit take checks.
+    With `overload` policy, due checks wait in a backlog holding a single run per record,
+    workers take them by priority, then by how overdue they are relative to their interval,
+    and low priority checks are shed when overloaded. Skipped runs are passed to `on_skip`
+    as record id, the first skipped run time, number of runs and reason.
+    '''
+    def __init__(self, writer: ResultSink, concurrency: int, jitter: float = 0.0,
+                 limiter: Optional[OriginLimiter] = None, per_ip: bool = False,
+                 adaptive: Optional[AdaptiveLimit] = None,
+                 overload: Optional[OverloadPolicy] = None,
+                 on_skip: Optional[Callable[[int, float, int, str], None]] = None):
+        self._writer = writer
+        self._concurrency = concurrency
+        self._adaptive = adaptive
+        self._jitter = jitter
+        self._limiter = limiter or OriginLimiter()
+        self._per_ip = per_ip
+        self._pending = TimerQueue()
+        # (run time, origin, check parameters)
+        self._ready: asyncio.Queue[tuple[float, str, dict[str, Any]]] = asyncio.Queue(concurrency)
+        self._wakeup = asyncio.Event()
+        self._tasks: set[asyncio.Task] = set()
+        self._overload = overload
+        self._on_skip = on_skip
+        # overload policy: due checks by record id, and their ranked snapshot, best last
+        self._backlog: dict[int, tuple[float, str, dict[str, Any]]] = {}
+        self._ranked: list[tuple[float, str, dict[str, Any]]] = []
+        self._ranked_at = 0.0
+        self._has_backlog = asyncio.Event()
+        # checks by record id queued for workers or run by them, until their results are queued
+        self._taken: Counter[int] = Counter()
+
+    def __len__(self):
+        return len(self._pending) + self._ready.qsize() + len(self._backlog)
+
+    @property
+    def limiter(self) -> OriginLimiter:  # pylint:disable=C0116
+        return self._limiter
+
+    def held(self) -> set[int]:
+        '''
+        Ids of records which checks are pending, wait for a worker or origin slot, or run
+        '''
+        # drop finished ones, counts are decremented only
+        self._taken = +self._taken
+        return {*self._pending, *self._backlog, *self._limiter.parked_ids(), *self._taken}
+
+    def start(self):
+        '''
+        Spawn releaser and worker coroutines
+        '''
+        _pending.set_function(self.__len__)
+        _parked.set_function(self._limiter.parked)
+        for coro in [self._release()] + [self._worker(i) for i in range(self._concurrency)]:
+            task = asyncio.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        '''
+        Stop all coroutines, pending checks are dropped
+        '''
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def submit(self, params: dict[str, Any]):
+        '''
+        Queue check to be run at `run_at`, other parameters are passed to check_url().
+        A pending check of the same record is replaced.
+        '''
+        now = time()
+        run_at: Optional[float] = params.pop('run_at', None)
+        if run_at is None or run_at < now - self._jitter:
+            # never ran or long overdue records are spread, not started all at once
+            run_at = now + random.uniform(0, self._jitter) if self._jitter else now
+
+        url = urlsplit(params['url'])
+        port = url.port or (443 if url.scheme == 'https' else 80)
+        origin = f'{url.scheme}://{url.hostname}:{port}'
+        if self._per_ip and url.hostname:
+            addresses = get_resolver().cached(url.hostname, port)
+            if addresses:
+                origin = addresses[0]
+
+        pending = self._pending.get(params['id'])
+        if pending and pending[1][0] == origin:
+            # replacing check keeps the rate slot reserved by the pending one
+            run_at = max(run_at, pending[0])
+        else:
+            run_at = self._limiter.reserve(origin, run_at)
+        self._pending.schedule(params['id'], run_at, (origin, params))
+        self._wakeup.set()
+
+        # resolve host ahead of the check
+        if url.hostname:
+            get_resolver().prefetch(url.hostname, port)
+
+    async def _release(self):
+        while True:
+            for _, run_at, (origin, params) in self._pending.pop_due(time()):
+                if self._overload:
+                    self._queue_due((run_at, origin, params))
+                    continue
+                # waits when all workers are busy
+                self._taken[params['id']] += 1
+                await self._ready.put((run_at, origin, params))
+
+            next_time = self._pending.next_time()
+            timeout = None if next_time is None else max(next_time - time(), 0)
+            self._wakeup.clear()
+            try:
+                async with asyncio.timeout(timeout):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+
+    async def _worker(self, index: int):
+        while True:
+            if self._adaptive:
+                await self._adaptive.admit(index)
+            job = await (self._take() if self._overload else self._ready.get())
+            origin = job[1]
+            if not self._limiter.acquire(origin, job, job[2].get('origin_concurrency'),
+                                         job[2]['id']):
+                # parked checks are held by limiter
+                self._taken[job[2]['id']] -= 1
+                continue
+
+            # run parked checks of the same origin, while there are any
+            while job:
+                run_at, _, params = job
+                now = time()
+                lag = now - run_at
+                if self._overload:
+                    missed = _missed(params, run_at, now)
+                    if missed:
+                        self._skip(params, run_at + params['interval'], missed, 'coalesced')
+                self._limiter.started(origin, lag)
+                _start_lag.observe(lag)
+                _in_flight.inc()
+                if self._adaptive:
+                    self._adaptive.started()
+                latency = None
+                try:
+                    latency = await self._execute(**params)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:  # pylint:disable=W0718
+                    _logger.exception('Check of %d failed: %r', params['id'], e)
+                finally:
+                    _in_flight.dec()
+                    if self._adaptive:
+                        self._adaptive.finished(latency)
+                    self._taken[params['id']] -= 1
+                    job = self._limiter.release(origin)
+                    if job:
+                        self._taken[job[2]['id']] += 1
+
+                # anyio may swallow cancellation requested while connecting,
+                # so the check completes, but the worker must stop anyway
+                if asyncio.current_task().cancelling():  # type:ignore
+                    raise asyncio.CancelledError()
+
+    def _queue_due(self, job: tuple[float, str, dict[str, Any]]):
+        previous = self._backlog.get(job[2]['id'])
+        if previous:
+            # run still waiting for a worker is merged into the later one
+            self._skip(previous[2], previous[0], 1, 'coalesced')
+        self._backlog[job[2]['id']] = job
+        self._has_backlog.set()
+
+    async def _take(self) -> tuple[float, str, dict[str, Any]]:
+        while True:
+            while not self._backlog:
+                self._has_backlog.clear()
+                await self._has_backlog.wait()
+
+            now = time()
+            if not self._ranked or now - self._ranked_at >= RANK_INTERVAL:
+                self._rank(now)
+            while self._ranked:
+                job = self._ranked.pop()
+                # skip checks taken by other workers or replaced by later runs
+                if self._backlog.get(job[2]['id']) is job:
+                    del self._backlog[job[2]['id']]
+                    self._taken[job[2]['id']] += 1
+                    return job
+
+    def _rank(self, now: float):
+        policy: OverloadPolicy = self._overload  # type:ignore
+        oldest = min(job[0] for job in self._backlog.values())
+        if (policy.backlog and len(self._backlog) >= policy.backlog
+                or policy.lag and now - oldest >= policy.lag):
+            for id, job in list(self._backlog.items()):  # pylint:disable=W0622
+                if (job[2].get('priority') or 0) < policy.shed_priority:
+                    del self._backlog[id]
+                    self._skip(job[2], job[0], 1 + _missed(job[2], job[0], now), 'shed')
+
+        self._ranked = sorted(self._backlog.values(), key=lambda job: (
+            job[2].get('priority') or 0, (now - job[0]) / (job[2].get('interval') or 1)
+        ))
+        self._ranked_at = now
+
+    def _skip(self, params: dict[str, Any], run_at: float, runs: int, reason: str):
+        _skips[reason].inc(runs)
+        if self._on_skip:
+            self._on_skip(params['id'], run_at, runs, reason)
+
+    async def _execute(self, id: int, url: str,  # pylint:disable=W0622
+                       content_rx: Optional[re.Pattern] = None,
+                       origin_concurrency: Optional[int] = None,
+                       interval: Optional[int] = None, priority: Optional[int] = None,
+                       **kwargs) -> float:
+        # pylint:disable=W0613
+        start_time = time()
+        result = await check_url(url, content_rx, **kwargs)
+        end_time = time()
+
+        if result.status_code is None:
+            _outcomes['error'].inc()
+        elif result.status_code >= 400:
+            _outcomes['http_error'].inc()
+        elif result.content_check is False:
+            _outcomes['content_mismatch'].inc()
+        else:
+            _outcomes['ok'].inc()
+
+        # results are saved in bulk, full writer queue holds the worker
+        await self._writer.put(id, start_time, end_time, result)
+        return end_time - start_time
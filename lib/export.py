@@ -0,0 +1,205 @@
+'''
+Streaming check_log and check_run export
+'''
+import json
+from datetime import datetime
+from typing import BinaryIO, Optional
+
+import asyncpg
+
+from lib.runs import RUN_COLUMNS
+from lib.writer import RESULT_COLUMNS
+
+# rows fetched by cursor at once
+CHUNK_SIZE = 10000
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+# check_run runs are exported as checks with evenly spread start and average timings,
+# or check_log rows are exported as runs of a single check
+RUN_EXPORTS = ('expand', 'summarize')
+
+_FAILURES = ('(error_message IS NOT NULL OR status_code IS NULL '
+             'OR status_code >= 400 OR content_check IS false)')
+
+# check_log_view columns of an expanded run, `i` is the check number
+_EXPANDED = {
+    'wl_id': 'wl_id',
+    'start': 'first_start + (last_start - first_start) * (i::float8 / greatest(checks - 1, 1))',
+    'end': 'CASE WHEN i = checks - 1 THEN last_end END',
+    'connect': '(connect_sum / nullif(timed, 0))::int',
+    'ttfb': '(ttfb_sum / nullif(timed, 0))::int',
+    'response': '(response_sum / nullif(timed, 0))::int',
+    'status_code': 'status_code',
+    'content_check': 'content_check',
+    'error_message': 'error_message',
+}
+
+# check_run columns of a check_log_view row
+_SUMMARIZED = {
+    'wl_id': 'wl_id',
+    'first_start': '"start"',
+    'last_start': '"start"',
+    'last_end': '"end"',
+    'checks': '1',
+    'status_code': 'status_code',
+    'content_check': 'content_check',
+    'error_message': 'error_message',
+    'timed': '(response IS NOT NULL)::int',
+    **{f'{name}_{agg}': f'CASE WHEN response IS NOT NULL THEN coalesce("{name}", 0) END'
+       for name in ('connect', 'ttfb', 'response') for agg in ('min', 'max')},
+    **{f'{name}_sum': f'CASE WHEN response IS NOT NULL THEN coalesce("{name}", 0) ELSE 0 END'
+       for name in ('connect', 'ttfb', 'response')},
+}
+
+# Postgres -> Parquet column types, see export_parquet()
+_PARQUET_TYPES = {
+    'bool': 'bool_',
+    'int2': 'int16',
+    'int4': 'int32',
+    'int8': 'int64',
+    'float8': 'float64',
+    'varchar': 'string',
+    'text': 'string',
+}
+
+
+class CountingOutput:
+    '''
+    Binary file wrapper counting written bytes
+    '''
+    def __init__(self, output: BinaryIO):
+        self.output = output
+        self.size = 0
+
+    def write(self, data: bytes) -> int:  # pylint:disable=C0116
+        self.size += len(data)
+        return self.output.write(data)
+
+    def tell(self) -> int:  # pylint:disable=C0116
+        # parquet writer asks for position
+        return self.size
+
+    def flush(self):  # pylint:disable=C0116
+        self.output.flush()
+
+    @property
+    def closed(self) -> bool:  # pylint:disable=C0116
+        return self.output.closed
+
+
+def _where(conditions: list[str]) -> str:
+    return ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+
+def export_query(ids: Optional[list[int]] = None, since: Optional[datetime] = None,
+                 until: Optional[datetime] = None, failures: bool = False,
+                 runs: str = 'expand') -> tuple[str, list]:
+    '''
+    Query of check_log rows along with check_run runs, and its arguments;
+    `runs` is either `expand` - check_log_view columns, or `summarize` - check_run columns
+    '''
+    conditions = []
+    run_conditions = []
+    args: list = []
+    if ids:
+        args.append(ids)
+        conditions.append(f'wl_id = any(${len(args)}::int[])')
+        run_conditions.append(f'wl_id = any(${len(args)}::int[])')
+    if since:
+        args.append(since)
+        conditions.append(f'"start" >= ${len(args)}')
+        run_conditions.append(f'last_start >= ${len(args)}')
+    if until:
+        args.append(until)
+        conditions.append(f'"start" < ${len(args)}')
+        run_conditions.append(f'first_start < ${len(args)}')
+    if failures:
+        conditions.append(_FAILURES)
+        run_conditions.append(_FAILURES)
+
+    if runs == 'summarize':
+        columns = ', '.join(c if _SUMMARIZED[c] == c else f'{_SUMMARIZED[c]} AS {c}'
+                            for c in RUN_COLUMNS)
+        return (
+            f'SELECT {columns} FROM check_log_view{_where(conditions)} '
+            f'UNION ALL SELECT {", ".join(RUN_COLUMNS)} FROM check_run{_where(run_conditions)} '
+            'ORDER BY wl_id, first_start'
+        ), args
+
+    columns = ', '.join(f'"{c}"' for c in RESULT_COLUMNS)
+    expanded = ', '.join(f'{e} AS "{c}"' for c, e in _EXPANDED.items())
+    # NULL type is resolved by UNION at the top level only
+    run_columns = ', '.join(f'"{c}"' if c in _EXPANDED else 'NULL' for c in RESULT_COLUMNS)
+    # NOTE: rows aren't streamed from an index: expanded runs have no order, so the server
+    # sorts them (or the whole union) before the first row is sent, spilling to disk
+    # past work_mem for long ranges; filter by time and wl_id to limit it
+    return (
+        f'SELECT {columns} FROM check_log_view{_where(conditions)} '
+        f'UNION ALL SELECT {run_columns} FROM (SELECT {expanded} '
+        f'FROM check_run, generate_series(0, checks - 1) i{_where(run_conditions)}) r'
+        f'{_where(conditions)} '
+        'ORDER BY wl_id, "start"'
+    ), args
+
+
+async def export_csv(conn: asyncpg.Connection, output: BinaryIO, query: str, args: list
+                     ) -> int:
+    '''
+    Stream query result as CSV with header using COPY, returns number of rows
+    '''
+    status = await conn.copy_from_query(query, *args, output=output,
+                                        format='csv', header=True)
+    return int(status.split()[-1])
+
+
+async def export_jsonl(conn: asyncpg.Connection, output: BinaryIO, query: str, args: list
+                       ) -> int:
+    '''
+    Stream query result as JSON lines using server-side cursor, returns number of rows
+    '''
+    rows = 0
+    async with conn.transaction():
+        async for record in conn.cursor(query, *args, prefetch=CHUNK_SIZE):
+            output.write(json.dumps(
+                {k: v.isoformat() if isinstance(v, datetime) else v for k, v in record.items()}
+            ).encode() + b'\n')
+            rows += 1
+    return rows
+
+
+async def export_parquet(conn: asyncpg.Connection, output: BinaryIO, query: str, args: list
+                         ) -> int:
+    '''
+    Stream query result as Parquet, a row group per CHUNK_SIZE rows, returns number of rows.
+    Requires pyarrow.
+    '''
+    # optional dependency
+    import pyarrow  # pylint:disable=C0415
+    import pyarrow.parquet  # pylint:disable=C0415
+
+    statement = await conn.prepare(query)
+    schema = pyarrow.schema([
+        (a.name, pyarrow.timestamp('us') if a.type.name == 'timestamp'
+         else getattr(pyarrow, _PARQUET_TYPES[a.type.name])())
+        for a in statement.get_attributes()
+    ])
+
+    rows = 0
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        async with conn.transaction():
+            cursor = await statement.cursor(*args)
+            while chunk := await cursor.fetch(CHUNK_SIZE):
+                writer.write_batch(pyarrow.record_batch(
+                    [[record[i] for record in chunk] for i in range(len(schema))],
+                    schema=schema
+                ))
+                rows += len(chunk)
+    return rows
+
+
+EXPORTERS = {
+    'csv': export_csv,
+    'jsonl': export_jsonl,
+    'parquet': export_parquet,
+}
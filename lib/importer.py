@@ -0,0 +1,109 @@
+'''
+Bulk watchlist import and sync
+'''
+from dataclasses import dataclass, field
+
+import asyncpg
+
+# importable watchlist columns and their types
+IMPORT_COLUMNS = {
+    'url': 'varchar',
+    'interval': 'integer',
+    'content_rx': 'varchar',
+    'enable': 'boolean',
+    'reuse_connection': 'boolean',
+    'max_body_bytes': 'integer',
+    'origin_concurrency': 'integer',
+    'probe': 'varchar',
+    'priority': 'smallint',
+}
+# not null columns: empty values keep the current value or get the default one
+_DEFAULTS = {
+    'enable': 'true',
+    'reuse_connection': 'false',
+    'priority': '0',
+}
+
+
+@dataclass
+class ImportSummary:  # pylint:disable=C0115
+    inserted: int = 0
+    updated: int = 0
+    disabled: int = 0
+    rejected: int = 0
+    # urls matching several records, which are not imported
+    ambiguous: list[str] = field(default_factory=list)
+
+
+def _count(status: str) -> int:
+    # command status, i.e. "UPDATE 10" or "INSERT 0 10"
+    return int(status.split()[-1])
+
+
+async def apply_import(conn: asyncpg.Connection, columns: list[str], rows: list[tuple],
+                       sync: bool = False) -> ImportSummary:
+    '''
+    Upsert rows into watchlist matching records by url, in a single transaction.
+    Only given columns of existing records are updated. Urls must be unique in rows;
+    urls matching several records are not imported, see ImportSummary.ambiguous.
+    With `sync`, records missing in rows are disabled, and given ones are enabled
+    unless `enable` column says otherwise.
+    '''
+    if sync and 'enable' not in columns:
+        columns = [*columns, 'enable']
+        rows = [(*row, True) for row in rows]
+
+    summary = ImportSummary()
+    quoted = [f'"{c}"' for c in columns]
+    async with conn.transaction():
+        await conn.execute(
+            'CREATE TEMP TABLE watchlist_import ('
+            + ', '.join(f'{q} {IMPORT_COLUMNS[c]}' for c, q in zip(columns, quoted))
+            + ') ON COMMIT DROP'
+        )
+        await conn.copy_records_to_table('watchlist_import', records=rows, columns=columns)
+        await conn.execute('ANALYZE watchlist_import')
+
+        # watchlist.url is not unique, such records are left as is
+        summary.ambiguous = [r['url'] for r in await conn.fetch(
+            'SELECT s.url FROM watchlist_import s JOIN watchlist w ON w.url = s.url '
+            'GROUP BY s.url HAVING count(*) > 1 ORDER BY s.url'
+        )]
+        if summary.ambiguous:
+            await conn.execute('DELETE FROM watchlist_import WHERE url = any($1::varchar[])',
+                               summary.ambiguous)
+
+        updates = [(c, q) for c, q in zip(columns, quoted) if c != 'url']
+        if updates:
+            values = [f'coalesce(s.{q}, w.{q})' if c in _DEFAULTS else f's.{q}'
+                      for c, q in updates]
+            assignments = [f'{q} = {v}' for (_, q), v in zip(updates, values)]
+            if 'content_rx' in columns:
+                # updated regex must be validated by scheduler again
+                assignments.append(
+                    'content_rx_error = CASE WHEN w.content_rx IS DISTINCT FROM s.content_rx '
+                    'THEN NULL ELSE w.content_rx_error END'
+                )
+            summary.updated = _count(await conn.execute(
+                f'UPDATE watchlist w SET {", ".join(assignments)} '
+                'FROM watchlist_import s WHERE w.url = s.url AND '
+                f'({", ".join("w." + q for _, q in updates)}) IS DISTINCT FROM '
+                f'({", ".join(values)})'
+            ))
+
+        inserts = [f'coalesce(s.{q}, {_DEFAULTS[c]})' if c in _DEFAULTS else f's.{q}'
+                   for c, q in zip(columns, quoted)]
+        summary.inserted = _count(await conn.execute(
+            f'INSERT INTO watchlist ({", ".join(quoted)}) '
+            f'SELECT {", ".join(inserts)} FROM watchlist_import s '
+            'WHERE NOT EXISTS (SELECT 1 FROM watchlist w WHERE w.url = s.url)'
+        ))
+
+        if sync:
+            summary.disabled = _count(await conn.execute(
+                'UPDATE watchlist w SET enable = false WHERE enable AND NOT EXISTS '
+                '(SELECT 1 FROM watchlist_import s WHERE s.url = w.url) '
+                'AND w.url <> ALL($1::varchar[])', summary.ambiguous
+            ))
+
+    return summary
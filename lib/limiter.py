@@ -0,0 +1,236 @@
+'''
+Per-origin concurrency and rate limits, adaptive concurrency limit
+'''
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Hashable, Optional
+
+from lib.metrics import counter, gauge
+
+_logger = logging.getLogger(__name__)
+
+_parks = counter('origin_parks_total', 'Checks parked over origin concurrency limit')
+_limit = gauge('concurrency_limit', 'Adaptive limit of concurrent checks')
+_baseline = gauge('check_latency_baseline_seconds', 'Long-term average check latency')
+_limit_changes = counter('concurrency_limit_changes_total', 'Adaptive limit changes by reason',
+                         ('reason',))
+_changes = {reason: _limit_changes.labels(reason)
+            for reason in ('loop_lag', 'pool_wait', 'latency', 'saturated')}
+
+
+@dataclass
+class OriginStats:  # pylint:disable=C0115
+    # checks running now
+    active: int = 0
+    # checks waiting for a free origin slot by job id, in parking order
+    parked: dict = field(default_factory=dict)
+    # started checks and their wait time from run time to start, seconds
+    checks: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+
+class OriginLimiter:
+    '''
+    Limits number of concurrent checks and check rate per origin (or any other key).
+    Checks over concurrency limit are parked, not holding a worker,
+    and passed to the worker which frees the origin slot.
+    '''
+    def __init__(self, concurrency: int = 0, rate: float = 0.0):
+        # 0 means unlimited
+        self.concurrency = concurrency
+        self.rate = rate
+        self._origins: dict[str, OriginStats] = {}
+        # earliest time of the next check of origin, when rate is limited
+        self._next_slot: dict[str, float] = {}
+        self._parked = 0
+
+    def reserve(self, key: str, run_at: float) -> float:
+        '''
+        Get the earliest run time not exceeding rate limit, and reserve it
+        '''
+        if not self.rate:
+            return run_at
+
+        run_at = max(run_at, self._next_slot.get(key, run_at))
+        self._next_slot[key] = run_at + 1 / self.rate
+        return run_at
+
+    def acquire(self, key: str, job: Any, limit: Optional[int] = None,
+                job_id: Optional[Hashable] = None) -> bool:
+        '''
+        Take origin slot, or park job until a slot is released.
+        `limit` overrides the default concurrency limit.
+        A parked job of the same `job_id` is replaced, keeping its place.
+        '''
+        origin = self._origins.get(key)
+        if origin is None:
+            origin = self._origins[key] = OriginStats()
+
+        limit = limit or self.concurrency
+        if limit and origin.active >= limit:
+            if job_id is None:
+                job_id = id(job)
+            if job_id not in origin.parked:
+                self._parked += 1
+                _parks.inc()
+            origin.parked[job_id] = job
+            return False
+
+        origin.active += 1
+        return True
+
+    def release(self, key: str) -> Optional[Any]:
+        '''
+        Free origin slot, returns parked job which took the slot
+        '''
+        origin = self._origins[key]
+        if origin.parked:
+            self._parked -= 1
+            return origin.parked.pop(next(iter(origin.parked)))
+
+        origin.active -= 1
+        return None
+
+    def started(self, key: str, wait: float):
+        '''
+        Account check start delay
+        '''
+        origin = self._origins[key]
+        origin.checks += 1
+        origin.wait_total += wait
+        origin.wait_max = max(origin.wait_max, wait)
+
+    def parked(self) -> int:
+        '''
+        Number of parked checks of all origins
+        '''
+        return self._parked
+
+    def parked_ids(self) -> set[Hashable]:
+        '''
+        Job ids of parked checks of all origins
+        '''
+        return {job_id for origin in self._origins.values() for job_id in origin.parked}
+
+    def stats(self) -> dict[str, OriginStats]:
+        '''
+        Per-origin statistics
+        '''
+        return self._origins
+
+    def backlog(self, top: int = 5) -> list[tuple[str, int, float]]:
+        '''
+        Origins with the most parked checks: key, number of parked checks, average wait
+        '''
+        return [
+            (key, len(origin.parked), origin.wait_total / max(origin.checks, 1))
+            for key, origin in sorted(self._origins.items(),
+                                      key=lambda item: len(item[1].parked),
+                                      reverse=True)[:top]
+            if origin.parked
+        ]
+
+
+class AdaptiveLimit:
+    '''
+    Concurrency limit between `floor` and `ceiling`, adjusted AIMD style by `update()`:
+    the limit is cut by `backoff` factor when event loop lag, DB pool acquire wait or
+    check latency inflation over its long-term average exceeds thresholds,
+    and is raised by `step` when all allowed workers were busy.
+    Until the first cut, the limit is doubled instead (slow start).
+    Workers over the limit wait in `admit()`.
+    '''
+    # weight of a new latency sample in the long-term average
+    BASELINE_WEIGHT = 0.05
+
+    def __init__(self, floor: int, ceiling: int, step: int = 10, backoff: float = 0.9,
+                 max_loop_lag: float = 0.05, max_pool_wait: float = 0.05,
+                 latency_tolerance: float = 2.0):
+        self.floor = max(floor, 1)
+        self.ceiling = max(ceiling, self.floor)
+        self.limit = self.floor
+        self.step = step
+        self.backoff = backoff
+        self.max_loop_lag = max_loop_lag
+        self.max_pool_wait = max_pool_wait
+        self.latency_tolerance = latency_tolerance
+        # long-term average check latency, seconds
+        self.baseline: Optional[float] = None
+        self._slow_start = True
+        self._running = 0
+        self._saturated = False
+        self._latency_total = 0.0
+        self._latency_count = 0
+        self._raised = asyncio.Event()
+        _limit.set_function(lambda: self.limit)
+        _baseline.set_function(lambda: self.baseline or 0.0)
+
+    async def admit(self, index: int):
+        '''
+        Wait until the limit allows worker of `index` to run checks
+        '''
+        while index >= self.limit:
+            await self._raised.wait()
+
+    def started(self):
+        '''
+        Account check start
+        '''
+        self._running += 1
+        if self._running >= self.limit:
+            self._saturated = True
+
+    def finished(self, latency: Optional[float]):
+        '''
+        Account check end, and its latency unless it failed
+        '''
+        self._running -= 1
+        if latency is not None:
+            self._latency_total += latency
+            self._latency_count += 1
+
+    def update(self, loop_lag: float, pool_wait: float) -> Optional[str]:
+        '''
+        Adjust the limit by measurements since the previous update,
+        returns reason of the change
+        '''
+        latency = self._latency_total / self._latency_count if self._latency_count else None
+        self._latency_total, self._latency_count = 0.0, 0
+        saturated, self._saturated = self._saturated, self._running >= self.limit
+
+        reason = None
+        if loop_lag > self.max_loop_lag:
+            reason = 'loop_lag'
+        elif pool_wait > self.max_pool_wait:
+            reason = 'pool_wait'
+        elif latency and self.baseline and latency > self.baseline * self.latency_tolerance:
+            reason = 'latency'
+        if latency is not None:
+            self.baseline = latency if self.baseline is None else \
+                self.baseline + (latency - self.baseline) * self.BASELINE_WEIGHT
+
+        if reason:
+            self._slow_start = False
+            limit = max(int(self.limit * self.backoff), self.floor)
+        elif saturated:
+            reason = 'saturated'
+            limit = min(self.limit * 2 if self._slow_start else self.limit + self.step,
+                        self.ceiling)
+        else:
+            return None
+
+        if limit == self.limit:
+            return None
+        _logger.info('Concurrency limit %d -> %d: %s (loop lag %.3fs, pool wait %.3fs, '
+                     'latency %s, baseline %s)', self.limit, limit, reason, loop_lag, pool_wait,
+                     f'{latency:.3f}s' if latency else '-',
+                     f'{self.baseline:.3f}s' if self.baseline else '-')
+        _changes[reason].inc()
+        if limit > self.limit:
+            # wake workers waiting for the limit
+            self._raised.set()
+            self._raised = asyncio.Event()
+        self.limit = limit
+        return reason
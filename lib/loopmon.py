@@ -0,0 +1,157 @@
+'''
+Event loop setup and lag monitor
+'''
+import asyncio
+import logging
+import sys
+import sysconfig
+import threading
+import traceback
+from time import monotonic
+from typing import Optional
+
+from lib.metrics import counter, histogram
+
+_logger = logging.getLogger(__name__)
+
+_lag = histogram('event_loop_lag_seconds', 'Delay of a callback scheduled by the loop monitor',
+                 buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                          1.0, 2.5))
+_slow = counter('event_loop_slow_callbacks_total', 'Callbacks holding the loop over threshold',
+                ('callback',))
+
+# frames of these paths are not application code
+_LIBRARY_PATHS = tuple({sysconfig.get_path(name)
+                        for name in ('stdlib', 'platstdlib', 'purelib', 'platlib')})
+
+
+def new_event_loop(use_uvloop: bool = False) -> asyncio.AbstractEventLoop:
+    '''
+    Create uvloop event loop if requested and installed, or the default one
+    '''
+    if use_uvloop:
+        try:
+            # optional dependency
+            import uvloop  # pylint:disable=C0415
+            return uvloop.new_event_loop()
+        except ImportError:
+            _logger.warning('uvloop is not installed, using default event loop')
+    return asyncio.new_event_loop()
+
+
+class LoopMonitor:
+    '''
+    Measures event loop lag from a thread: every `interval` seconds it schedules a callback
+    in the loop, and the time until the callback runs is the lag.
+    When it doesn't run within `slow_callback` seconds, the loop thread is sampled
+    to name the task or function holding the loop.
+    Works with any loop implementation, and costs nothing per callback.
+    '''
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = 0.1,
+                 slow_callback: float = 0.1):
+        self._loop = loop
+        self._interval = interval
+        self._slow_callback = slow_callback
+        self._loop_thread = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._max_lag = 0.0
+
+    def start(self):
+        '''
+        Start monitor thread, must be called from the loop thread
+        '''
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='loopmon', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop monitor thread
+        '''
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def take_max_lag(self) -> float:
+        '''
+        The longest lag since the previous call, seconds
+        '''
+        lag, self._max_lag = self._max_lag, 0.0
+        return lag
+
+    def _run(self):
+        responded = threading.Event()
+        while not self._stop.wait(self._interval):
+            responded.clear()
+            tm0 = monotonic()
+            try:
+                self._loop.call_soon_threadsafe(responded.set)
+            except RuntimeError:
+                # loop is closed
+                return
+
+            if not responded.wait(self._slow_callback):
+                if self._stop.is_set():
+                    # loop may wait for stop() itself
+                    return
+                self._report_slow()
+                while not responded.wait(self._interval):
+                    if self._stop.is_set():
+                        return
+
+            lag = monotonic() - tm0
+            _lag.observe(lag)
+            self._max_lag = max(self._max_lag, lag)
+
+    def _report_slow(self):
+        frame = sys._current_frames().get(self._loop_thread)  # pylint:disable=W0212
+        if frame is None:
+            return
+        stack = traceback.StackSummary.extract(traceback.walk_stack(frame), lookup_lines=False)
+        # innermost application frame, or the innermost one when loop is in a library
+        where = next((f for f in stack if not f.filename.startswith(_LIBRARY_PATHS)), stack[0])
+
+        # plain callbacks, i.e. protocol methods, are run outside of tasks
+        task = asyncio.current_task(self._loop)
+        callback = getattr(task.get_coro(), '__qualname__', task.get_name()) if task \
+            else where.name
+        _slow.labels(callback).inc()
+        _logger.warning('Event loop is held over %.3fs by %s, at %s:%s in %s',
+                        self._slow_callback, callback, where.filename, where.lineno, where.name)
+
+
+_monitor: Optional[LoopMonitor] = None
+
+
+def initialize_monitor(loop: asyncio.AbstractEventLoop, enable: bool = True,
+                       interval: float = 0.1, slow_callback: float = 0.1):
+    '''
+    Start shared loop monitor, must be called from the loop thread
+    '''
+    global _monitor  # pylint:disable=W0603
+
+    if _monitor or not enable:
+        return
+    _monitor = LoopMonitor(loop, interval, slow_callback)
+    _monitor.start()
+
+
+def get_monitor() -> Optional[LoopMonitor]:
+    '''
+    Shared loop monitor instance, if started
+    '''
+    return _monitor
+
+
+def close_monitor():
+    '''
+    Stop shared loop monitor
+    '''
+    global _monitor  # pylint:disable=W0603
+
+    if _monitor:
+        _monitor.stop()
+        _monitor = None
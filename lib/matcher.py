@@ -0,0 +1,346 @@
+'''
+Content regex search off the event loop, with a time budget
+'''
+import asyncio
+import logging
+import multiprocessing
+import re
+import signal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from time import process_time, thread_time
+from typing import Optional
+
+from lib.metrics import counter, gauge, histogram
+
+_logger = logging.getLogger(__name__)
+
+_search_time = histogram('content_search_seconds', 'Content regex search CPU time',
+                         ('where',), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                                              0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+_search_loop = _search_time.labels('loop')
+_search_pool = _search_time.labels('pool')
+_overruns = counter('content_search_overruns_total', 'Content regex searches over time budget')
+_kills = counter('content_search_worker_kills_total', 'Search worker processes killed or died')
+_quarantined = gauge('content_patterns_quarantined', 'Content regexes quarantined')
+
+# time for a worker to respond over the budget, then it's killed
+KILL_GRACE = 1.0
+# watchlist.content_rx_error of quarantined patterns
+QUARANTINE_MESSAGE = 'Quarantined: content regex search is over time budget'
+
+
+class SearchError(Exception):
+    '''
+    Content regex search failed: interrupted over time budget, quarantined or worker died
+    '''
+
+
+@dataclass
+class PatternStats:  # pylint:disable=C0115
+    searches: int = 0
+    # CPU time of searches, seconds
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    # searches over time budget
+    overruns: int = 0
+    # searches are run by workers regardless of text size
+    slow: bool = False
+
+    def add(self, seconds: float):
+        '''
+        Count a search
+        '''
+        self.searches += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class _Interrupted(Exception):
+    pass
+
+
+# search is interrupted by SIGPROF only while it's armed
+_armed = False
+
+
+def _on_budget(_signum, _frame):
+    if _armed:
+        raise _Interrupted()
+
+
+def _worker_main(conn: Connection):
+    '''
+    Search worker process entry point: searches requested patterns, interrupting them
+    when process CPU time of a search is over budget
+    '''
+    global _armed  # pylint:disable=W0603
+
+    # service shutdown is handled by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGPROF, _on_budget)
+    while True:
+        try:
+            pattern, flags, text, pos, budget = conn.recv()
+        except EOFError:
+            # parent process exited
+            return
+
+        span, interrupted = None, False
+        tm0 = process_time()
+        try:
+            # regex engine checks signals while searching
+            compiled = re.compile(pattern, flags)
+            _armed = True
+            signal.setitimer(signal.ITIMER_PROF, budget)
+            match = compiled.search(text, pos)
+            _armed = False
+            span = match.span() if match else None
+        except _Interrupted:
+            interrupted = True
+        finally:
+            _armed = False
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        conn.send((span, process_time() - tm0, interrupted))
+
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child,), name='matcher',
+                                       daemon=True)
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class Matcher:
+    '''
+    The first search of a pattern, searches of patterns which once took over `slow_search`
+    seconds, and searches of texts of `offload_chars` characters and more are run in a pool
+    of `workers` processes, so the event loop isn't held by expensive patterns or large pages.
+    Texts are sent to workers from threads, since pickling and pipe writes are blocking.
+    A search may take `budget` seconds of CPU time: then it's interrupted, and the worker
+    is killed when it doesn't respond `KILL_GRACE` seconds later. Patterns over budget
+    `quarantine_after` times are quarantined, their searches fail at once.
+    Searches run in the loop can't be interrupted, but are timed and counted the same way.
+    Statistics of `stats_size` recently used patterns are kept.
+    '''
+    def __init__(self, workers: int = 2, offload_chars: int = 32768, budget: float = 1.0,
+                 slow_search: float = 0.01, quarantine_after: int = 3,
+                 stats_size: int = 10000):
+        self._size = workers
+        self._offload_chars = offload_chars
+        self._budget = budget
+        self._slow_search = slow_search
+        self._quarantine_after = quarantine_after
+        self._stats_size = stats_size
+        self._stats: OrderedDict[str, PatternStats] = OrderedDict()
+        self._quarantine: set[str] = set()
+        self._context = multiprocessing.get_context('spawn')
+        self._workers: set[_Worker] = set()
+        self._idle: asyncio.Queue[_Worker] = asyncio.Queue()
+        self._tasks: set[asyncio.Task] = set()
+        self._executor = ThreadPoolExecutor(max(workers, 1), thread_name_prefix='matcher')
+
+    def start(self):
+        '''
+        Start worker processes in a blocking way
+        '''
+        for _ in range(self._size):
+            self._add(_Worker(self._context))
+        _quarantined.set_function(self._quarantine.__len__)
+
+    async def close(self):
+        '''
+        Stop worker processes
+        '''
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for worker in self._workers:
+            worker.kill()
+        self._workers.clear()
+        self._executor.shutdown()
+
+    def quarantined(self, pattern: str) -> bool:
+        '''
+        Pattern is quarantined
+        '''
+        return pattern in self._quarantine
+
+    def top(self, count: int) -> list[tuple[str, PatternStats]]:
+        '''
+        Patterns taking the most search time
+        '''
+        return sorted(self._stats.items(), key=lambda item: item[1].seconds,
+                      reverse=True)[:count]
+
+    async def search(self, pattern: re.Pattern, text: str,
+                     pos: int = 0) -> Optional[tuple[int, int]]:
+        '''
+        Span of the first match of pattern in text from `pos`,
+        raises `SearchError` if the search is interrupted or pattern is quarantined
+        '''
+        if pattern.pattern in self._quarantine:
+            raise SearchError(QUARANTINE_MESSAGE)
+
+        stats = self._pattern_stats(pattern.pattern)
+        if self._size and (stats.slow or not stats.searches
+                           or len(text) - pos >= self._offload_chars):
+            span, seconds, interrupted = await self._offload(pattern, text, pos)
+            _search_pool.observe(seconds)
+        else:
+            tm0 = thread_time()
+            match = pattern.search(text, pos)
+            seconds = thread_time() - tm0
+            _search_loop.observe(seconds)
+            span, interrupted = match.span() if match else None, False
+        stats.add(seconds)
+        if seconds > self._slow_search:
+            stats.slow = True
+
+        if seconds > self._budget or interrupted:
+            _overruns.inc()
+            stats.overruns += 1
+            if stats.overruns >= self._quarantine_after \
+                    and pattern.pattern not in self._quarantine:
+                self._quarantine.add(pattern.pattern)
+                _logger.warning('Content regex %r is quarantined after %d searches over %.3fs',
+                                pattern.pattern, stats.overruns, self._budget)
+        if interrupted:
+            raise SearchError(f'Content regex search is over {self._budget:.3f}s time budget')
+        return span
+
+    def _pattern_stats(self, pattern: str) -> PatternStats:
+        stats = self._stats.get(pattern)
+        if stats is None:
+            stats = self._stats[pattern] = PatternStats()
+            while len(self._stats) > self._stats_size:
+                self._stats.popitem(last=False)
+        else:
+            self._stats.move_to_end(pattern)
+        return stats
+
+    async def _offload(self, pattern: re.Pattern, text: str,
+                       pos: int) -> tuple[Optional[tuple[int, int]], float, bool]:
+        worker = await self._idle.get()
+        if pattern.pattern in self._quarantine:
+            # quarantined while waiting for a worker
+            self._idle.put_nowait(worker)
+            raise SearchError(QUARANTINE_MESSAGE)
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = worker.conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            try:
+                await loop.run_in_executor(
+                    self._executor, worker.conn.send,
+                    (pattern.pattern, pattern.flags, text, pos, self._budget)
+                )
+                async with asyncio.timeout(self._budget + KILL_GRACE):
+                    await ready
+            finally:
+                loop.remove_reader(fd)
+            response = worker.conn.recv()
+        except TimeoutError:
+            _logger.warning('Search worker %d is killed, content regex %r is over budget',
+                            worker.process.pid, pattern.pattern)
+            self._replace(worker)
+            return None, self._budget + KILL_GRACE, True
+        except (EOFError, OSError) as e:
+            self._replace(worker)
+            raise SearchError(f'Search worker failed: {e!r}') from e
+        except asyncio.CancelledError:
+            # worker is busy or its response is not read
+            self._replace(worker)
+            raise
+
+        self._idle.put_nowait(worker)
+        return response
+
+    def _add(self, worker: _Worker):
+        self._workers.add(worker)
+        self._idle.put_nowait(worker)
+
+    def _replace(self, worker: _Worker):
+        _kills.inc()
+        self._workers.discard(worker)
+        worker.kill()
+        task = asyncio.create_task(self._spawn())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _spawn(self):
+        while True:
+            try:
+                # process start is blocking
+                worker = await asyncio.get_running_loop().run_in_executor(
+                    None, _Worker, self._context
+                )
+            except OSError as e:
+                _logger.error('Failed to start search worker, retry in 1s: %r', e)
+                await asyncio.sleep(1.0)
+                continue
+            self._add(worker)
+            return
+
+
+_matcher: Optional[Matcher] = None
+
+
+def initialize_matcher(workers: int = 2, offload_chars: int = 32768, budget: float = 1.0,
+                       slow_search: float = 0.01, quarantine_after: int = 3,
+                       stats_size: int = 10000):
+    '''
+    Start shared matcher, see Matcher
+    '''
+    global _matcher  # pylint:disable=W0603
+
+    if _matcher:
+        return
+    _matcher = Matcher(workers, offload_chars, budget, slow_search, quarantine_after,
+                       stats_size)
+    _matcher.start()
+
+
+def get_matcher() -> Optional[Matcher]:
+    '''
+    Shared matcher instance, if started
+    '''
+    return _matcher
+
+
+async def close_matcher():
+    '''
+    Stop shared matcher workers
+    '''
+    global _matcher  # pylint:disable=W0603
+
+    if _matcher:
+        await _matcher.close()
+        _matcher = None
+
+
+async def search(pattern: re.Pattern, text: str, pos: int = 0) -> Optional[tuple[int, int]]:
+    '''
+    Search using shared matcher, or in the loop when it's not started
+    '''
+    if _matcher:
+        return await _matcher.search(pattern, text, pos)
+    match = pattern.search(text, pos)
+    return match.span() if match else None
+
+
+def quarantined(pattern: str) -> bool:
+    '''
+    Pattern is quarantined by shared matcher
+    '''
+    return bool(_matcher and _matcher.quarantined(pattern))
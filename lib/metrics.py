@@ -0,0 +1,271 @@
+'''
+In-process metrics registry, exposed in Prometheus text format
+'''
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable, Optional, Union
+
+_logger = logging.getLogger(__name__)
+
+# default histogram buckets, seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class CounterValue:
+    '''
+    Monotonically increasing value
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):  # pylint:disable=C0116
+        self.value += amount
+
+
+class GaugeValue:
+    '''
+    Arbitrary value, or a function evaluated on collection
+    '''
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):  # pylint:disable=C0116
+        self.value = value
+
+    def inc(self, amount: float = 1.0):  # pylint:disable=C0116
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):  # pylint:disable=C0116
+        self.value -= amount
+
+    def get(self) -> float:  # pylint:disable=C0116
+        return self.function() if self.function else self.value
+
+
+class HistogramValue:
+    '''
+    Observations counted into fixed buckets
+    '''
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        # the last one is +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):  # pylint:disable=C0116
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+Value = Union[CounterValue, GaugeValue, HistogramValue]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    '''
+    Metric family, its values are children per label values.
+    Unlabelled metric delegates to its single child.
+    NOTE: keep children returned by labels() to avoid lookups on hot paths
+    '''
+    type = ''
+
+    def __init__(self, name: str, help: str,  # pylint:disable=W0622
+                 labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._children: dict[tuple[str, ...], Value] = {}
+        self._default = None if labels else self.labels()
+
+    def _create(self) -> Value:
+        raise NotImplementedError
+
+    def labels(self, *values: str) -> Value:
+        '''
+        Child of the label values
+        '''
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._create()
+        return child
+
+    def collect(self) -> list[str]:
+        '''
+        Exposition lines
+        '''
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for values, child in self._children.items():
+            lines.extend(self._sample(_labels(self.label_names, values), values, child))
+        return lines
+
+    def _sample(self, labels: str, values: tuple[str, ...], child) -> list[str]:
+        return [f'{self.name}{labels} {child.value}']
+
+
+class Counter(Metric):  # pylint:disable=C0115
+    type = 'counter'
+
+    def _create(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1.0):  # pylint:disable=C0116
+        self._default.inc(amount)  # type:ignore
+
+
+class Gauge(Metric):  # pylint:disable=C0115
+    type = 'gauge'
+
+    def _create(self) -> GaugeValue:
+        return GaugeValue()
+
+    def set(self, value: float):  # pylint:disable=C0116
+        self._default.set(value)  # type:ignore
+
+    def inc(self, amount: float = 1.0):  # pylint:disable=C0116
+        self._default.inc(amount)  # type:ignore
+
+    def dec(self, amount: float = 1.0):  # pylint:disable=C0116
+        self._default.dec(amount)  # type:ignore
+
+    def set_function(self, function: Optional[Callable[[], float]]):
+        '''
+        Evaluate value on collection
+        '''
+        self._default.function = function  # type:ignore
+
+    def _sample(self, labels: str, values: tuple[str, ...], child) -> list[str]:
+        return [f'{self.name}{labels} {child.get()}']
+
+
+class Histogram(Metric):  # pylint:disable=C0115
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str,  # pylint:disable=W0622
+                 labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def _create(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):  # pylint:disable=C0116
+        self._default.observe(value)  # type:ignore
+
+    def _sample(self, labels: str, values: tuple[str, ...], child) -> list[str]:
+        lines = []
+        total = 0
+        for bound, count in zip((*self.buckets, '+Inf'), child.counts):
+            total += count
+            le = _labels(self.label_names, values, f'le="{bound}"')
+            lines.append(f'{self.name}_bucket{le} {total}')
+        lines.append(f'{self.name}_sum{labels} {child.sum}')
+        lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+
+class Registry:
+    '''
+    Named metrics collection
+    '''
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        '''
+        Add metric, or get already registered one of the same name
+        '''
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        '''
+        Prometheus text exposition of all metrics
+        '''
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+_registry = Registry()
+
+
+def counter(name: str, help: str,  # pylint:disable=W0622
+            labels: tuple[str, ...] = ()) -> Counter:
+    '''
+    Get or create counter in the default registry
+    '''
+    return _registry.register(Counter(name, help, labels))  # type:ignore
+
+
+def gauge(name: str, help: str,  # pylint:disable=W0622
+          labels: tuple[str, ...] = ()) -> Gauge:
+    '''
+    Get or create gauge in the default registry
+    '''
+    return _registry.register(Gauge(name, help, labels))  # type:ignore
+
+
+def histogram(name: str, help: str, labels: tuple[str, ...] = (),  # pylint:disable=W0622
+              buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+    '''
+    Get or create histogram in the default registry
+    '''
+    return _registry.register(Histogram(name, help, labels, buckets))  # type:ignore
+
+
+def render() -> str:
+    '''
+    Default registry in Prometheus text format
+    '''
+    return _registry.render()
+
+
+async def start_server(host: str = '127.0.0.1', port: int = 9100) -> asyncio.Server:
+    '''
+    Serve default registry at http://host:port/metrics
+    '''
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10.0)
+            path = request.split(b' ', 2)[1] if request.count(b' ') >= 2 else b''
+            if path.split(b'?', 1)[0] == b'/metrics':
+                status, body = b'200 OK', render().encode()
+            else:
+                status, body = b'404 Not Found', b'Not found\n'
+            writer.write(
+                b'HTTP/1.1 ' + status + b'\r\n'
+                b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                b'Connection: close\r\n\r\n' + body
+            )
+            await writer.drain()
+        except (TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    _logger.info('Metrics are served at http://%s:%d/metrics', host, port)
+    return server
@@ -0,0 +1,256 @@
+'''
+HTTP transport with cached DNS resolution, shared TLS contexts and network timings
+'''
+import asyncio
+import ssl
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from time import perf_counter_ns
+from typing import Any, Iterable, Optional, Union
+
+import httpcore
+import httpx
+
+from lib.resolver import get_resolver
+
+
+@dataclass
+class ConnectionTimings:
+    '''
+    Network timings of the current check: durations of connection phases and
+    timestamps of request phases, perf_counter_ns() nanoseconds.
+    Request phases are marked by trace() events and by TimingStream I/O.
+    '''
+    # connection phases, not measured for a reused connection
+    dns: Optional[int] = None
+    tcp: Optional[int] = None
+    tls: Optional[int] = None
+    # request phases
+    start: Optional[int] = None
+    sent: Optional[int] = None
+    first_byte: Optional[int] = None
+    headers: Optional[int] = None
+    end: Optional[int] = None
+    # the last write, response is the first read after it
+    written: Optional[int] = None
+    # TLS handshake outcome: session was resumed, peer certificate expiration (unix time)
+    tls_resumed: Optional[bool] = None
+    cert_expires: Optional[float] = None
+
+    async def trace(self, event_name: str, _info: Any):
+        '''
+        httpcore trace extension callback
+        '''
+        if event_name.endswith('.send_request_body.complete'):
+            self.sent = perf_counter_ns()
+        elif event_name.endswith('.receive_response_headers.complete'):
+            self.headers = perf_counter_ns()
+            if self.first_byte is None:
+                # HTTP/2 frames of the request were read by a concurrent request
+                self.first_byte = self.headers
+
+
+# timings of the current check, set by check_url()
+connection_timings: ContextVar[Optional[ConnectionTimings]] = ContextVar(
+    'connection_timings', default=None
+)
+
+# TLS contexts by verification settings, see ssl_context()
+_ssl_contexts: dict[Union[bool, str], ssl.SSLContext] = {}
+# TLS sessions of the last connections by context and origin, see initialize_tls()
+_tls_sessions: OrderedDict[tuple[int, str, int], ssl.SSLSession] = OrderedDict()
+_tls_session_cache_size = 0
+# session offered by the TLS handshake being started
+_offered_session: ContextVar[Optional[ssl.SSLSession]] = ContextVar(
+    'offered_session', default=None
+)
+
+
+class _ResumingSSLObject(ssl.SSLObject):
+    '''
+    SSL object offering a cached session to the server.
+    NOTE: anyio creates SSL objects by SSLContext.wrap_bio() without a session,
+    and SSLContext subclasses are created in a thread, so the object class is replaced
+    '''
+    # A session can only be set before the handshake, but anyio calls wrap_bio() and
+    # do_handshake() inside start_tls() with no hook in between to assign SSLObject.session.
+    # SSLContext.wrap_bio() passes `session` to this private constructor only, so it's
+    # the one point to inject it; covered by test_checker_tls_resumption.
+    @classmethod
+    def _create(cls, *args, session=None, **kwargs):  # pylint:disable=W0221
+        return super()._create(*args, session=session or _offered_session.get(),  # type:ignore
+                               **kwargs)
+
+
+def ssl_context(verify: Union[bool, str] = True) -> ssl.SSLContext:
+    '''
+    Shared TLS context, `verify` is either a flag or a CA bundle path.
+    Contexts are created once, since it loads CA bundle.
+    '''
+    context = _ssl_contexts.get(verify)
+    if context is None:
+        context = _ssl_contexts[verify] = httpx.create_ssl_context(
+            ssl.create_default_context(cafile=verify) if isinstance(verify, str) else verify
+        )
+        context.sslobject_class = _ResumingSSLObject
+    return context
+
+
+def initialize_tls(resumption: bool = False, session_cache_size: int = 10000):
+    '''
+    Enable TLS session resumption: a session of the last connection to an origin
+    is offered by the next one, keeping sessions of `session_cache_size` origins
+    '''
+    global _tls_session_cache_size  # pylint:disable=W0603
+
+    _tls_session_cache_size = session_cache_size if resumption else 0
+    while len(_tls_sessions) > _tls_session_cache_size:
+        _tls_sessions.popitem(last=False)
+
+
+class TimingStream(httpcore.AsyncNetworkStream):
+    '''
+    Network stream wrapper recording TLS handshake details and the first response byte
+    of the current check, until its response headers are received.
+    With TLS session resumption, sessions are cached when connections are closed,
+    i.e. after TLS 1.3 session tickets are received.
+    '''
+    def __init__(self, stream: httpcore.AsyncNetworkStream, origin: tuple[str, int],
+                 session_key: Optional[tuple[int, str, int]] = None):
+        self._stream = stream
+        self._origin = origin
+        self._session_key = session_key
+
+    async def read(self, max_bytes: int, timeout: Optional[float] = None) -> bytes:
+        data = await self._stream.read(max_bytes, timeout)
+        timings = connection_timings.get()
+        if (data and timings and timings.headers is None and timings.written
+                and timings.first_byte is None):
+            timings.first_byte = perf_counter_ns()
+        return data
+
+    async def write(self, buffer: bytes, timeout: Optional[float] = None) -> None:
+        await self._stream.write(buffer, timeout)
+        timings = connection_timings.get()
+        if timings and timings.headers is None:
+            # i.e. HTTP/2 settings acknowledged after the first read
+            timings.written = perf_counter_ns()
+            timings.first_byte = None
+
+    async def aclose(self) -> None:
+        ssl_object = self._session_key and self._stream.get_extra_info('ssl_object')
+        if ssl_object and ssl_object.session:
+            _tls_sessions[self._session_key] = ssl_object.session  # type:ignore
+            _tls_sessions.move_to_end(self._session_key)  # type:ignore
+            while len(_tls_sessions) > _tls_session_cache_size:
+                _tls_sessions.popitem(last=False)
+        await self._stream.aclose()
+
+    async def start_tls(self, ssl_context: ssl.SSLContext, server_hostname: Optional[str] = None,
+                        timeout: Optional[float] = None) -> httpcore.AsyncNetworkStream:
+        session_key = None
+        if _tls_session_cache_size:
+            # session can be resumed by the same context only
+            session_key = (id(ssl_context), *self._origin)
+        token = _offered_session.set(_tls_sessions.pop(session_key, None)  # type:ignore
+                                     if session_key else None)
+        tm0 = perf_counter_ns()
+        try:
+            stream = await self._stream.start_tls(ssl_context, server_hostname, timeout)
+        finally:
+            _offered_session.reset(token)
+
+        timings = connection_timings.get()
+        if timings:
+            timings.tls = perf_counter_ns() - tm0
+            ssl_object = stream.get_extra_info('ssl_object')
+            if ssl_object:
+                timings.tls_resumed = ssl_object.session_reused
+                # empty when certificate isn't verified
+                not_after = (ssl_object.getpeercert() or {}).get('notAfter')
+                if not_after:
+                    timings.cert_expires = float(ssl.cert_time_to_seconds(not_after))
+        return TimingStream(stream, self._origin, session_key)
+
+    def get_extra_info(self, info: str) -> Any:
+        return self._stream.get_extra_info(info)
+
+
+class ResolvingBackend(httpcore.AsyncNetworkBackend):
+    '''
+    Network backend resolving host names with the shared caching resolver
+    before connecting to the first reachable address.
+    Connections are wrapped into TimingStream.
+    '''
+    def __init__(self, backend: Optional[httpcore.AsyncNetworkBackend] = None):
+        self._backend = backend or httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                          local_address: Optional[str] = None,
+                          socket_options: Optional[Iterable] = None
+                          ) -> httpcore.AsyncNetworkStream:
+        tm0 = perf_counter_ns()
+        try:
+            # NOTE: asyncio.wait_for() of python 3.11 loses cancellation
+            # when awaitable is already done, i.e. for cached hosts
+            async with asyncio.timeout(timeout):
+                addresses = await get_resolver().resolve(host, port)
+        except TimeoutError as e:
+            raise httpcore.ConnectTimeout(f'DNS lookup of {host} timed out') from e
+        except OSError as e:
+            raise httpcore.ConnectError(str(e)) from e
+        finally:
+            timings = connection_timings.get()
+            if timings:
+                timings.dns = perf_counter_ns() - tm0
+
+        tm0 = perf_counter_ns()
+        error: Optional[Exception] = None
+        for address in addresses:
+            try:
+                stream = await self._backend.connect_tcp(address, port, timeout,
+                                                         local_address, socket_options)
+            except httpcore.ConnectError as e:
+                error = e
+                continue
+            if timings:
+                timings.tcp = perf_counter_ns() - tm0
+            return TimingStream(stream, (host, port))
+        raise error or httpcore.ConnectError(f'No addresses for {host}')
+
+    async def connect_unix_socket(self, path: str, timeout: Optional[float] = None,
+                                  socket_options: Optional[Iterable] = None
+                                  ) -> httpcore.AsyncNetworkStream:
+        return await self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+class Transport(httpx.AsyncHTTPTransport):
+    '''
+    HTTP transport using ResolvingBackend and shared TLS context, see ssl_context().
+    NOTE: httpx doesn't expose network backend option, so its connection pool is made here
+    instead of httpx.AsyncHTTPTransport.__init__(), which would also load a new TLS context
+    for each transport. Pool options are forwarded, but `cert`, `trust_env` and `proxy`
+    are not supported: TLS settings come from the shared context, and checks are made
+    directly, not through proxies.
+    '''
+    def __init__(self, http2: bool = True,  # pylint:disable=W0231
+                 limits: httpx.Limits = httpx.Limits(), verify: Union[bool, str] = True,
+                 http1: bool = True, retries: int = 0, local_address: Optional[str] = None,
+                 uds: Optional[str] = None, socket_options: Optional[Iterable] = None):
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=ssl_context(verify),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http1=http1,
+            http2=http2,
+            retries=retries,
+            local_address=local_address,
+            uds=uds,
+            socket_options=socket_options,
+            network_backend=ResolvingBackend(),
+        )
@@ -0,0 +1,157 @@
+'''
+check_log partitions maintenance
+'''
+import asyncio
+import logging
+import re
+from datetime import date, datetime, timezone
+from typing import Optional
+
+import asyncpg
+
+from lib.db import get_pool
+
+_logger = logging.getLogger(__name__)
+
+_PARTITION_RE = re.compile(r'^check_log_p(\d{4})(\d{2})$')
+# advisory lock key, so service processes don't run maintenance concurrently
+_LOCK_KEY = 0x636b6c67
+
+PARTITIONS_QUERY = '''
+SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bounds,
+    pg_total_relation_size(c.oid) AS size, c.reltuples::bigint AS rows
+FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'check_log'::regclass
+ORDER BY c.relname
+'''
+
+
+def add_months(month: date, months: int) -> date:
+    '''
+    First day of the month `months` after (or before) `month`
+    '''
+    n = month.year * 12 + month.month - 1 + months
+    return date(n // 12, n % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    '''
+    Name of the monthly partition
+    '''
+    return f'check_log_p{month:%Y%m}'
+
+
+def partition_month(name: str) -> Optional[date]:
+    '''
+    Month of the partition, None if it's not a monthly partition
+    '''
+    m = _PARTITION_RE.match(name)
+    return date(int(m[1]), int(m[2]), 1) if m else None
+
+
+def current_month() -> date:
+    '''
+    First day of the current month, UTC
+    '''
+    now = datetime.now(timezone.utc)
+    return date(now.year, now.month, 1)
+
+
+async def create_partition(conn: asyncpg.Connection, month: date) -> str:
+    '''
+    Create check_log partition of the month, returns its name
+    '''
+    name = partition_name(month)
+    await conn.execute(
+        f'CREATE TABLE {name} PARTITION OF check_log '
+        f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+    )
+    return name
+
+
+async def maintain_partitions(conn: asyncpg.Connection, premake: int = 2, retention: int = 0,
+                              detach: bool = False, brin: bool = False
+                              ) -> tuple[list[str], list[str]]:
+    '''
+    Create partitions of the current and `premake` next months,
+    drop (or detach) partitions and delete check_run runs and check_skip records
+    older than `retention` months, 0 - keep all.
+    Returns names of created and removed partitions.
+    check_log of earlier versions, which is not partitioned, is skipped until it's converted
+    by "cli.py compact".
+    '''
+    created: list[str] = []
+    removed: list[str] = []
+
+    if not await conn.fetchval(
+        "SELECT EXISTS (SELECT FROM pg_partitioned_table WHERE partrelid = 'check_log'::regclass)"
+    ):
+        _logger.warning('check_log is not partitioned, convert it by "cli.py compact"')
+        return created, removed
+
+    # session level lock, DDL statements run in separate transactions
+    if not await conn.fetchval('SELECT pg_try_advisory_lock($1)', _LOCK_KEY):
+        return created, removed
+
+    try:
+        existing = {row['name'] for row in await conn.fetch(PARTITIONS_QUERY)}
+        month = current_month()
+
+        for i in range(premake + 1):
+            start = add_months(month, i)
+            name = partition_name(start)
+            if name not in existing:
+                try:
+                    await create_partition(conn, start)
+                except asyncpg.PostgresError as e:
+                    # i.e. default partition already has rows of this month
+                    _logger.error('Failed to create partition %s: %s', name, e)
+                    continue
+                created.append(name)
+            if brin:
+                await conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS {name}_start_brin ON {name} USING brin ("start")'
+                )
+
+        if retention > 0:
+            cutoff = add_months(month, -retention)
+            for name in sorted(existing):
+                start = partition_month(name)
+                if start is None or start >= cutoff:
+                    continue
+                if detach:
+                    await conn.execute(f'ALTER TABLE check_log DETACH PARTITION {name}')
+                else:
+                    await conn.execute(f'DROP TABLE {name}')
+                removed.append(name)
+
+            await conn.execute('DELETE FROM check_log_default WHERE "start" < $1', cutoff)
+            await conn.execute('DELETE FROM check_run WHERE last_start < $1', cutoff)
+            await conn.execute('DELETE FROM check_skip WHERE run_at < $1', cutoff)
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', _LOCK_KEY)
+
+    return created, removed
+
+
+async def maintenance_loop(interval: float = 3600.0, premake: int = 2, retention: int = 0,
+                           retention_action: str = 'detach', brin: bool = False):
+    '''
+    Maintain check_log partitions every `interval` seconds
+    '''
+    while True:
+        try:
+            async with get_pool().acquire() as conn:
+                created, removed = await maintain_partitions(
+                    conn, premake, retention, retention_action == 'detach', brin
+                )
+            if created:
+                _logger.info('Created partitions: %s', ', '.join(created))
+            if removed:
+                _logger.info('%s partitions: %s',
+                             'Detached' if retention_action == 'detach' else 'Dropped',
+                             ', '.join(removed))
+        except (OSError, asyncpg.PostgresError) as e:
+            _logger.error('Partitions maintenance failed: %r', e)
+
+        await asyncio.sleep(interval)
@@ -0,0 +1,76 @@
+'''
+Compiled content regex cache
+'''
+import re
+from collections import OrderedDict
+from typing import NamedTuple
+
+CONTENT_FLAGS = re.MULTILINE | re.DOTALL
+
+
+class CacheStats(NamedTuple):  # pylint:disable=C0115
+    size: int
+    hits: int
+    misses: int
+
+
+class PatternCache:
+    '''
+    Bounded LRU cache of compiled patterns, keyed by pattern text and flags
+    '''
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._patterns: OrderedDict[tuple[str, int], re.Pattern] = OrderedDict()
+
+    def compile(self, pattern: str, flags: int = CONTENT_FLAGS) -> re.Pattern:
+        '''
+        Get compiled pattern, raises `re.error` for invalid ones
+        '''
+        key = (pattern, flags)
+        try:
+            compiled = self._patterns[key]
+        except KeyError:
+            self.misses += 1
+            compiled = re.compile(pattern, flags)
+        else:
+            self.hits += 1
+            self._patterns.move_to_end(key)
+            return compiled
+
+        self._patterns[key] = compiled
+        while len(self._patterns) > self.max_size:
+            self._patterns.popitem(last=False)
+
+        return compiled
+
+    def stats(self) -> CacheStats:
+        '''
+        Cache size and hit/miss counters
+        '''
+        return CacheStats(len(self._patterns), self.hits, self.misses)
+
+
+_cache = PatternCache()
+
+
+def set_cache_size(max_size: int):
+    '''
+    Resize shared pattern cache
+    '''
+    _cache.max_size = max_size
+
+
+def compile_pattern(pattern: str, flags: int = CONTENT_FLAGS) -> re.Pattern:
+    '''
+    Compile pattern using shared cache
+    '''
+    return _cache.compile(pattern, flags)
+
+
+def cache_stats() -> CacheStats:
+    '''
+    Shared pattern cache statistics
+    '''
+    return _cache.stats()
@@ -0,0 +1,148 @@
+'''
+Caching async DNS resolver
+'''
+import asyncio
+import ipaddress
+import logging
+import socket
+from functools import partial
+from time import monotonic
+from typing import Optional, Union
+
+_logger = logging.getLogger(__name__)
+
+
+class Resolver:
+    '''
+    Resolves host names with the system resolver in the default executor.
+    Positive and negative results are cached for `ttl` and `negative_ttl` seconds,
+    concurrent lookups of the same host share a single request.
+    '''
+    def __init__(self, ttl: float = 60.0, negative_ttl: float = 10.0, max_size: int = 10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # (host, port) -> (expiration time, addresses or lookup error)
+        self._cache: dict[tuple[str, int], tuple[float, Union[list[str], OSError]]] = {}
+        self._lookups: dict[tuple[str, int], asyncio.Future] = {}
+        self._prefetches: set[asyncio.Task] = set()
+
+    async def resolve(self, host: str, port: int) -> list[str]:
+        '''
+        Get host addresses, raises `OSError` if host can't be resolved
+        '''
+        if _is_address(host):
+            return [host]
+
+        key = (host, port)
+        cached = self._cache.get(key)
+        if cached and cached[0] > monotonic():
+            self.hits += 1
+            if isinstance(cached[1], OSError):
+                # a new instance, so tracebacks don't pile up on the cached one
+                raise type(cached[1])(*cached[1].args)
+            return cached[1]
+
+        lookup = self._lookups.get(key)
+        if lookup is None:
+            self.misses += 1
+            lookup = asyncio.ensure_future(self._lookup(host, port))
+            self._lookups[key] = lookup
+            lookup.add_done_callback(partial(self._lookup_done, key))
+
+        # shielded, so a cancelled check doesn't cancel lookup shared with others
+        return await asyncio.shield(lookup)
+
+    def cached(self, host: str, port: int) -> Optional[list[str]]:
+        '''
+        Get host addresses if they are cached
+        '''
+        if _is_address(host):
+            return [host]
+
+        cached = self._cache.get((host, port))
+        if cached and cached[0] > monotonic() and not isinstance(cached[1], OSError):
+            return cached[1]
+        return None
+
+    def prefetch(self, host: str, port: int):
+        '''
+        Resolve host in background, if it's not cached yet or about to expire
+        '''
+        if _is_address(host):
+            return
+
+        key = (host, port)
+        cached = self._cache.get(key)
+        # refresh positive results expiring within the next 10% of ttl
+        if key in self._lookups or (cached and cached[0] > monotonic() + self.ttl / 10):
+            return
+
+        task = asyncio.create_task(self.resolve(host, port))
+        self._prefetches.add(task)
+        task.add_done_callback(self._prefetched)
+
+    def _lookup_done(self, key: tuple[str, int], lookup: asyncio.Future):
+        del self._lookups[key]
+        # retrieve error, which may have no waiters left
+        if not lookup.cancelled():
+            lookup.exception()
+
+    def _prefetched(self, task: asyncio.Task):
+        self._prefetches.discard(task)
+        if not task.cancelled() and task.exception():
+            _logger.debug('Prefetch failed: %r', task.exception())
+
+    async def _lookup(self, host: str, port: int) -> list[str]:
+        try:
+            info = await asyncio.get_running_loop().getaddrinfo(
+                host, port, type=socket.SOCK_STREAM
+            )
+        except OSError as e:
+            self._store((host, port), self.negative_ttl, e)
+            raise
+
+        # unique addresses, in resolver order
+        addresses = list(dict.fromkeys(item[4][0] for item in info))
+        self._store((host, port), self.ttl, addresses)
+        return addresses
+
+    def _store(self, key: tuple[str, int], ttl: float, value: Union[list[str], OSError]):
+        if len(self._cache) >= self.max_size:
+            # drop expired entries, or the oldest one if none expired
+            now = monotonic()
+            expired = [k for k, v in self._cache.items() if v[0] <= now]
+            for k in expired or [next(iter(self._cache))]:
+                del self._cache[k]
+        self._cache[key] = (monotonic() + ttl, value)
+
+
+def _is_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+_resolver: Optional[Resolver] = None
+
+
+def initialize_resolver(ttl: float = 60.0, negative_ttl: float = 10.0, max_size: int = 10000):
+    '''
+    Initialize shared resolver
+    '''
+    global _resolver  # pylint:disable=W0603
+
+    _resolver = Resolver(ttl, negative_ttl, max_size)
+
+
+def get_resolver() -> Resolver:
+    '''
+    Shared resolver instance wrapper, initialized with defaults on the first use
+    '''
+    if _resolver is None:
+        initialize_resolver()
+    return _resolver  # type:ignore
@@ -0,0 +1,183 @@
+'''
+Check results rollups: aggregates per watchlist record and minute / hour
+'''
+import operator
+from bisect import bisect_left
+from dataclasses import astuple, dataclass, field, fields
+from datetime import datetime
+from typing import Optional
+
+# response time histogram buckets upper bounds (ms), the last bucket is unbounded
+HISTOGRAM_BOUNDS = (5, 10, 25, 50, 75, 100, 150, 200, 300, 500, 750, 1000,
+                    1500, 2000, 3000, 5000, 10000)
+
+# rollup table -> bucket width
+ROLLUP_TABLES = {'check_stat_minute': 'minute', 'check_stat_hour': 'hour'}
+
+# timings accounted by TimingStats
+TIMING_NAMES = ('connect', 'ttfb', 'response')
+
+
+def _histogram() -> list[int]:
+    return [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+
+def least(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    '''
+    Minimum of values ignoring NULLs, like SQL LEAST()
+    '''
+    return b if a is None else a if b is None else min(a, b)
+
+
+def greatest(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    '''
+    Maximum of values ignoring NULLs, like SQL GREATEST()
+    '''
+    return b if a is None else a if b is None else max(a, b)
+
+
+# combining functions of TimingStats fields by suffix
+_COMBINE = (('_min', least), ('_max', greatest), ('_sum', operator.add))
+
+
+@dataclass(kw_only=True)
+class TimingStats:  # pylint:disable=R0902
+    '''
+    Minimal, maximal and total timings (ms) of `timed` checks, shared by rollups and runs
+    '''
+    # checks having timings, use for averages
+    timed: int = 0
+    connect_min: Optional[int] = None
+    connect_max: Optional[int] = None
+    connect_sum: int = 0
+    ttfb_min: Optional[int] = None
+    ttfb_max: Optional[int] = None
+    ttfb_sum: int = 0
+    response_min: Optional[int] = None
+    response_max: Optional[int] = None
+    response_sum: int = 0
+
+    def add_timings(self, connect: Optional[int], ttfb: Optional[int], response: int):
+        '''
+        Account timings of a check, missing phases are counted as 0
+        '''
+        self.timed += 1
+        for name, value in zip(TIMING_NAMES, (connect or 0, ttfb or 0, response)):
+            for suffix, combine in _COMBINE:
+                field_name = name + suffix
+                setattr(self, field_name, combine(getattr(self, field_name), value))
+
+    def merge_timings(self, other: 'TimingStats'):
+        '''
+        Add timings of other stats to these ones
+        '''
+        self.timed += other.timed
+        for name in TIMING_NAMES:
+            for suffix, combine in _COMBINE:
+                field_name = name + suffix
+                setattr(self, field_name,
+                        combine(getattr(self, field_name), getattr(other, field_name)))
+
+    def average(self, name: str) -> Optional[float]:
+        '''
+        Average of `connect`, `ttfb` or `response` time
+        '''
+        return getattr(self, f'{name}_sum') / self.timed if self.timed else None
+
+
+@dataclass
+class Rollup(TimingStats):  # pylint:disable=C0115
+    checks: int = 0
+    # failed requests: error or HTTP status >= 400
+    failures: int = 0
+    # content regex didn't match
+    content_failures: int = 0
+    # response time histogram, see HISTOGRAM_BOUNDS
+    histogram: list[int] = field(default_factory=_histogram)
+
+    def add(self, status_code: Optional[int], content_check: Optional[bool],
+            error_message: Optional[str], connect: Optional[int], ttfb: Optional[int],
+            response: Optional[int]):
+        '''
+        Account a single check result
+        '''
+        self.checks += 1
+        if error_message is not None or status_code is None or status_code >= 400:
+            self.failures += 1
+        if content_check is False:
+            self.content_failures += 1
+        if response is None:
+            return
+
+        self.add_timings(connect, ttfb, response)
+        self.histogram[bisect_left(HISTOGRAM_BOUNDS, response)] += 1
+
+    def merge(self, other: 'Rollup'):
+        '''
+        Add other rollup to this one
+        '''
+        self.checks += other.checks
+        self.failures += other.failures
+        self.content_failures += other.content_failures
+        self.histogram = [x + y for x, y in zip(self.histogram, other.histogram)]
+        self.merge_timings(other)
+
+    def percentile(self, q: float) -> Optional[float]:
+        '''
+        Response time percentile estimated from histogram, `q` is 0..1
+        '''
+        if not self.timed:
+            return None
+
+        rank = q * self.timed
+        total = 0
+        for i, count in enumerate(self.histogram):
+            if count and total + count >= rank:
+                lower = HISTOGRAM_BOUNDS[i - 1] if i else 0
+                upper = HISTOGRAM_BOUNDS[i] if i < len(HISTOGRAM_BOUNDS) else self.response_max
+                value = lower + (upper - lower) * (rank - total) / count  # type:ignore
+                # bucket bounds are wider than actual values
+                return min(max(value, self.response_min), self.response_max)  # type:ignore
+            total += count
+        return self.response_max
+
+    def values(self) -> tuple:
+        '''
+        Field values in ROLLUP_COLUMNS order
+        '''
+        return astuple(self)
+
+
+ROLLUP_COLUMNS = tuple(f.name for f in fields(Rollup))
+
+
+def bucket_start(value: datetime, width: str) -> datetime:
+    '''
+    Start of the `minute` or `hour` bucket of the timestamp
+    '''
+    if width == 'hour':
+        return value.replace(minute=0, second=0, microsecond=0)
+    return value.replace(second=0, microsecond=0)
+
+
+def upsert_query(table: str) -> str:
+    '''
+    Query adding rollup to the stored one: $1 wl_id, $2 bucket, then ROLLUP_COLUMNS
+    '''
+    updates = []
+    for name in ROLLUP_COLUMNS:
+        if name == 'histogram':
+            updates.append(f'{name} = hist_add(t.{name}, excluded.{name})')
+        elif name.endswith('_min'):
+            updates.append(f'{name} = least(t.{name}, excluded.{name})')
+        elif name.endswith('_max'):
+            updates.append(f'{name} = greatest(t.{name}, excluded.{name})')
+        else:
+            updates.append(f'{name} = t.{name} + excluded.{name}')
+
+    placeholders = ', '.join(f'${i}' for i in range(1, len(ROLLUP_COLUMNS) + 3))
+    return (
+        f'INSERT INTO {table} AS t (wl_id, bucket, {", ".join(ROLLUP_COLUMNS)}) '
+        f'VALUES ({placeholders}) '
+        f'ON CONFLICT (wl_id, bucket) DO UPDATE SET {", ".join(updates)}'
+    )
@@ -0,0 +1,105 @@
+'''
+Run-length check log: consecutive checks of a watchlist record having the same outcome
+are merged into a run, see `runs` log mode of the writer
+'''
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from lib.rollup import TimingStats
+
+RUN_COLUMNS = ('wl_id', 'first_start', 'last_start', 'last_end', 'checks', 'status_code',
+               'content_check', 'error_message', 'timed', 'connect_min', 'connect_max',
+               'connect_sum', 'ttfb_min', 'ttfb_max', 'ttfb_sum', 'response_min',
+               'response_max', 'response_sum')
+
+# the latest run of each record, locked, records order avoids deadlocks of concurrent writers
+LATEST_RUNS_QUERY = f'''
+SELECT r.* FROM unnest($1::int[]) v(id), LATERAL (
+    SELECT {", ".join(RUN_COLUMNS)} FROM check_run WHERE wl_id = v.id
+    ORDER BY first_start DESC LIMIT 1 FOR UPDATE
+) r
+'''
+
+UPDATE_RUN_QUERY = (
+    'UPDATE check_run SET '
+    + ', '.join(f'{name} = ${i}' for i, name in enumerate(RUN_COLUMNS, 1)
+                if name not in ('wl_id', 'first_start'))
+    + ' WHERE wl_id = $1 AND first_start = $2'
+)
+
+
+@dataclass
+class Run(TimingStats):  # pylint:disable=C0115
+    wl_id: int
+    first_start: datetime
+    last_start: datetime
+    last_end: Optional[datetime] = None
+    checks: int = 0
+    # outcome shared by checks of the run
+    status_code: Optional[int] = None
+    content_check: Optional[bool] = None
+    error_message: Optional[str] = None
+
+    def outcome(self) -> tuple:
+        '''
+        Fields which are the same for all checks of the run
+        '''
+        return self.status_code, self.content_check, self.error_message
+
+    def add(self, start: datetime, end: Optional[datetime], connect: Optional[int],
+            ttfb: Optional[int], response: Optional[int]):
+        '''
+        Account a check following the run
+        '''
+        self.checks += 1
+        self.last_start = start
+        self.last_end = end
+        if response is None:
+            return
+
+        self.add_timings(connect, ttfb, response)
+
+    def extend(self, other: 'Run'):
+        '''
+        Add a run following this one
+        '''
+        self.last_start = other.last_start
+        self.last_end = other.last_end
+        self.checks += other.checks
+        self.merge_timings(other)
+
+    def follows(self, other: 'Run', max_duration: float) -> bool:
+        '''
+        This run may extend other one: it's later, has the same outcome,
+        and the merged run doesn't last longer than `max_duration` seconds
+        '''
+        return (self.wl_id == other.wl_id and self.outcome() == other.outcome()
+                and self.first_start > other.last_start
+                and (self.last_start - other.first_start).total_seconds() < max_duration)
+
+    def values(self) -> tuple:
+        '''
+        Field values in RUN_COLUMNS order
+        '''
+        return tuple(getattr(self, name) for name in RUN_COLUMNS)
+
+
+def split_runs(records: list[tuple], max_duration: float) -> list[Run]:
+    '''
+    Runs of result records, see lib.writer.RESULT_COLUMNS:
+    a run is started by an outcome change, or when it lasts `max_duration` seconds
+    '''
+    runs: list[Run] = []
+    current: dict[int, Run] = {}
+    for (wl_id, start, end, _, connect, ttfb, response, status_code, content_check,
+         error_message, *_) in sorted(records, key=lambda r: (r[0], r[1])):
+        run = current.get(wl_id)
+        if run is None or run.outcome() != (status_code, content_check, error_message) \
+                or (start - run.first_start).total_seconds() >= max_duration:
+            run = current[wl_id] = Run(wl_id, start, start, status_code=status_code,
+                                       content_check=content_check,
+                                       error_message=error_message)
+            runs.append(run)
+        run.add(start, end, connect, ttfb, response)
+    return runs
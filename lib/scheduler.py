@@ -3,92 +3,441 @@ Simple scheduler implementation
 '''
 import asyncio
 import logging
-from time import time
-from typing import Any, Optional
+import os
+import re
+import socket
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Optional
+from uuid import uuid4
 
 import asyncpg
 
 from lib.db import get_pool
-from lib.checker import check_url
+from lib.dispatcher import Dispatcher, OverloadPolicy
+from lib.limiter import AdaptiveLimit, OriginLimiter
+from lib.loopmon import get_monitor
+from lib.matcher import QUARANTINE_MESSAGE, get_matcher, quarantined
+from lib.metrics import counter, histogram
+from lib.patterns import cache_stats, compile_pattern, set_cache_size
+from lib.timer import TimerQueue
+from lib.writer import create_writer
 
 _logger = logging.getLogger(__name__)
 
+_tick_duration = histogram('scheduler_tick_seconds', 'Scheduler tick processing time')
+_tick_overruns = counter('scheduler_tick_overruns_total', 'Ticks longer than tick interval')
+# recorded by lib.writer
+_pool_acquire = histogram('db_pool_acquire_seconds', 'Writer DB pool acquire wait')
+
+
+# NOTE: fields must match Dispatcher.submit() parameters
+_WATCHLIST_FIELDS = (
+    'id, url, content_rx, reuse_connection, max_body_bytes, origin_concurrency, probe, '
+    '"interval", priority'
+)
+# watchlist changes notification channel, see db/structure.sql
+_WATCHLIST_CHANNEL = 'watchlist_changed'
+
+# records to be run within a scheduler tick ending at $1
+WATCHLIST_POLL_QUERY = (
+    f'SELECT {_WATCHLIST_FIELDS}, '
+    '("interval" + EXTRACT(EPOCH FROM last_start))::int run_at '
+    'FROM watchlist '
+    'WHERE enable AND content_rx_error IS NULL '
+    # pick never ran...
+    'AND (last_start IS NULL '
+    # ...or to be run within current scheduler tick
+    'OR (last_start < to_timestamp($1 - "interval"))) '
+    # NULLS FIRST makes sure never executed tasks will run first
+    'ORDER BY run_at NULLS FIRST'
+)
+
+# claim up to $4 records to be run within a scheduler tick ending at $1,
+# which are not leased by other instances
+WATCHLIST_CLAIM_QUERY = (
+    'UPDATE watchlist '
+    'SET lease_owner = $2, lease_until = now() + make_interval(secs => $3) '
+    'FROM ('
+    'SELECT id due_id FROM watchlist '
+    'WHERE enable AND content_rx_error IS NULL '
+    'AND (last_start IS NULL OR last_start < to_timestamp($1 - "interval")) '
+    # not leased or lease expired
+    'AND (lease_until IS NULL OR lease_until < now()) '
+    'ORDER BY ("interval" + EXTRACT(EPOCH FROM last_start)) NULLS FIRST '
+    'LIMIT $4 '
+    # records claimed by concurrent instances are skipped
+    'FOR UPDATE SKIP LOCKED'
+    ') due '
+    'WHERE id = due_id '
+    f'RETURNING {_WATCHLIST_FIELDS}, '
+    '("interval" + EXTRACT(EPOCH FROM last_start))::int run_at'
+)
+
+# runs skipped by dispatcher overload policy, of records not deleted meanwhile
+SKIP_INSERT_QUERY = (
+    'INSERT INTO check_skip (wl_id, run_at, runs, reason) '
+    'SELECT v.wl_id, to_timestamp(v.run_at)::timestamp, v.runs, v.reason '
+    'FROM unnest($1::int[], $2::float8[], $3::int[], $4::varchar[]) v(wl_id, run_at, runs, reason) '
+    'WHERE EXISTS (SELECT 1 FROM watchlist w WHERE w.id = v.wl_id)'
+)
+
+# shed checks are due again after their interval, and their leases held by $3 are released
+SHED_UPDATE_QUERY = (
+    'UPDATE watchlist '
+    'SET last_start = greatest(last_start, to_timestamp($2)::timestamp), '
+    'lease_owner = nullif(lease_owner, $3), '
+    'lease_until = CASE WHEN lease_owner = $3 THEN NULL ELSE lease_until END '
+    'WHERE id = any($1::int[])'
+)
+
+# extend leases held by $1 of records $3 to $2 seconds from now
+LEASE_RENEW_QUERY = (
+    'UPDATE watchlist SET lease_until = now() + make_interval(secs => $2) '
+    'WHERE lease_owner = $1 AND id = any($3::int[])'
+)
+
+
+def _instance_name():
+    # lease owner name, unique per main_loop() of service processes, which are forked
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+
 
 async def main_loop(config: dict[str, Any]):
     '''
     Scheduler main loop routine
     '''
-    interval = float(config['interval'])
-    semaphore = asyncio.Semaphore(int(config['max_concurrency']))
-    background_tasks = set()
-
-    async with get_pool().acquire() as conn:
-        watchlist_fetch = await conn.prepare(
-            # NOTE: fields must match execute() parameters
-            'SELECT id, url, content_rx, ("interval" + EXTRACT(EPOCH FROM last_start))::int run_at '
-            'FROM watchlist '
-            'WHERE enable '
-            # pick never ran...
-            'AND (last_start IS NULL '
-            # ...or to be run within current scheduler tick
-            'OR (last_start < to_timestamp($1 - "interval"))) '
-            # NULLS FIRST makes sure never executed tasks will run first
-            'ORDER BY 4 NULLS FIRST'
-        )
+    invalid: list[tuple[int, str]] = []
+    skipped: list[tuple[int, float, int, str]] = []
+    owner = _instance_name()
+
+    set_cache_size(int(config.get('pattern_cache_size', 10000)))
+
+    writer = create_writer(config)
+    writer.start()
+    adaptive = None
+    if config.get('adaptive_concurrency'):
+        adaptive = AdaptiveLimit(int(config.get('min_concurrency', 10)),
+                                 int(config['max_concurrency']),
+                                 int(config.get('adaptive_step', 10)),
+                                 float(config.get('adaptive_backoff', 0.9)),
+                                 float(config.get('adaptive_max_loop_lag', 0.05)),
+                                 float(config.get('adaptive_max_pool_wait', 0.05)),
+                                 float(config.get('adaptive_latency_tolerance', 2.0)))
+    overload = None
+    if config.get('overload_policy'):
+        overload = OverloadPolicy(int(config.get('shed_priority', 0)),
+                                  int(config.get('overload_backlog', 1000)),
+                                  float(config.get('overload_lag', 10.0)))
+    dispatcher = Dispatcher(writer, int(config['max_concurrency']),
+                            float(config.get('start_jitter', 0.0)),
+                            OriginLimiter(int(config.get('origin_concurrency', 0)),
+                                          float(config.get('origin_rate', 0.0))),
+                            bool(config.get('origin_per_ip', False)),
+                            adaptive, overload,
+                            lambda *skip: skipped.append(skip))
+    dispatcher.start()
+
+    def dispatch(params: dict[str, Any]):
+        if params['content_rx']:
+            if quarantined(params['content_rx']):
+                _logger.error('Content_rx of %d is quarantined (%r)',
+                              params['id'], params['content_rx'])
+                invalid.append((params['id'], QUARANTINE_MESSAGE))
+                return
+            try:
+                params['content_rx'] = compile_pattern(params['content_rx'])
+            except re.error as e:
+                _logger.error('Invalid content_rx of %d (%r): %s',
+                              params['id'], params['content_rx'], e)
+                invalid.append((params['id'], str(e)))
+                return
 
-        while True:
-            tick_start = time()
+        dispatcher.submit(params)
+
+    async def update_watchlist(conn: asyncpg.Connection):
+        if invalid:
+            # invalid records are not fetched anymore, until content_rx is updated
+            await conn.executemany(
+                'UPDATE watchlist SET content_rx_error = $2 WHERE id = $1', invalid
+            )
+            invalid.clear()
+        if skipped:
+            skips = skipped.copy()
+            skipped.clear()
             async with conn.transaction():
-                record: asyncpg.Record
-                async for record in watchlist_fetch.cursor(tick_start + interval):
-                    task = asyncio.create_task(_execute(semaphore, **dict(record.items())))
-                    # a workaround for https://github.com/python/cpython/issues/88831
-                    background_tasks.add(task)
-                    task.add_done_callback(background_tasks.discard)
+                await conn.execute(SKIP_INSERT_QUERY, *map(list, zip(*skips)))
+                shed = [wl_id for wl_id, _, _, reason in skips if reason == 'shed']
+                if shed:
+                    await conn.execute(SHED_UPDATE_QUERY, shed, time(), owner)
 
-            tick_elapsed = time() - tick_start
+    reporter = asyncio.create_task(
+        _report(dispatcher, float(config.get('report_interval', 60.0)))
+    )
+    adapter = None
+    if adaptive:
+        adapter = asyncio.create_task(
+            _adapt(adaptive, float(config.get('adaptive_interval', 1.0)))
+        )
 
-            if tick_elapsed < interval:
-                await asyncio.sleep(interval - tick_elapsed)
+    try:
+        mode = config.get('mode', 'poll')
+        if mode == 'timer':
+            # acquires connections itself, reconnecting when the listening one is lost
+            await _timer_loop(float(config['interval']), dispatch, update_watchlist)
+        else:
+            async with get_pool().acquire() as conn:
+                if mode == 'lease':
+                    await _lease_loop(conn, config, owner, dispatch, update_watchlist,
+                                      lambda: dispatcher.held() | writer.unsaved())
+                else:
+                    await _poll_loop(conn, float(config['interval']), dispatch,
+                                     update_watchlist,
+                                     float(config.get('redispatch_timeout', 60.0)))
+    finally:
+        reporter.cancel()
+        if adapter:
+            adapter.cancel()
+        await dispatcher.close()
+        await writer.close()
 
-            if tick_elapsed > interval:
-                _logger.warning(
-                    'Performance problem: iteration time exceeded by %fs', tick_elapsed - interval
+        if config.get('mode') == 'lease':
+            # release leases of the dropped pending checks
+            async with get_pool().acquire() as conn:
+                await conn.execute(
+                    'UPDATE watchlist SET lease_owner = NULL, lease_until = NULL '
+                    'WHERE lease_owner = $1', owner
                 )
 
 
-async def _execute(semaphore: asyncio.Semaphore,
-                   id: int, url: str, content_rx: Optional[str] = None, # pylint:disable=W0622
-                   run_at: Optional[int] = None):
+async def _report(dispatcher: Dispatcher, interval: float):
+    '''
+    Periodically log backlog of the origins over their limits
+    '''
+    while True:
+        await asyncio.sleep(interval)
+        for origin, parked, wait in dispatcher.limiter.backlog():
+            _logger.info('Origin %s: %d checks waiting, average wait %.3fs', origin, parked, wait)
+        _logger.debug('Pattern cache: %r', cache_stats())
+        matcher = get_matcher()
+        for pattern, stats in matcher.top(5) if matcher else ():
+            if stats.slow:
+                _logger.info('Slow content regex %r: %d searches, %.3fs total, %.3fs max, '
+                             '%d over budget', pattern, stats.searches, stats.seconds,
+                             stats.max_seconds, stats.overruns)
+
+
+async def _adapt(adaptive: AdaptiveLimit, interval: float):
     '''
-    Task coroutine.
-    Mass created from main loop and controlled by semaphore
+    Update adaptive concurrency limit every `interval` seconds,
+    with event loop lag and average writer DB pool acquire wait
     '''
-    async with semaphore:
-        start_time = time()
-        if run_at and run_at > start_time:
-            delta = run_at - start_time
-
-            await asyncio.sleep(delta)
-            start_time = run_at
-
-        result = await check_url(url, content_rx)
-
-        end_time = time()
-
-        async with get_pool().acquire() as conn:
-            # log check results
-            await conn.execute(
-                'INSERT INTO check_log (wl_id, "start", "end", connect, ttfb, response, '
-                'status_code, content_check, error_message) '
-                'VALUES ($1, to_timestamp($2), to_timestamp($3), $4, $5, $6, $7, $8, $9)',
-                id, start_time, end_time, result.connection, result.ttfb, result.response,
-                result.status_code, result.content_check, result.error_message
+    acquire = _pool_acquire.labels()
+    acquired = (acquire.sum, acquire.count)  # type:ignore
+    while True:
+        tm0 = monotonic()
+        await asyncio.sleep(interval)
+        monitor = get_monitor()
+        # the longest lag measured by monitor, or sleep overshoot
+        loop_lag = monitor.take_max_lag() if monitor else monotonic() - tm0 - interval
+
+        wait, count = acquire.sum - acquired[0], acquire.count - acquired[1]  # type:ignore
+        acquired = (acquire.sum, acquire.count)  # type:ignore
+        adaptive.update(loop_lag, wait / count if count else 0.0)
+
+
+async def _poll_loop(conn: asyncpg.Connection, interval: float,
+                     dispatch: Callable[[dict[str, Any]], None],
+                     update_watchlist: Callable[[asyncpg.Connection], Awaitable],
+                     redispatch_timeout: float = 60.0):
+    '''
+    Fetch records to be run within each scheduler tick from DB.
+    A run which result isn't saved within its interval plus `redispatch_timeout` seconds
+    (check or saving failed) is dispatched again
+    '''
+    # run_at of dispatched tasks, results of which may be not saved yet,
+    # and time after which they are dispatched again
+    dispatched: dict[int, tuple[Optional[int], float]] = {}
+
+    watchlist_fetch = await conn.prepare(WATCHLIST_POLL_QUERY)
+
+    while True:
+        tick_start = time()
+        fetched: dict[int, tuple[Optional[int], float]] = {}
+        async with conn.transaction():
+            record: asyncpg.Record
+            async for record in watchlist_fetch.cursor(tick_start + interval):
+                run = dispatched.get(record['id'])
+                # last_start is updated by writer with a delay,
+                # skip records already dispatched for the same run
+                if run and run[0] == record['run_at'] and run[1] > tick_start:
+                    fetched[record['id']] = run
+                    continue
+
+                fetched[record['id']] = (
+                    record['run_at'], tick_start + record['interval'] + redispatch_timeout
+                )
+                dispatch(dict(record.items()))
+        dispatched = fetched
+
+        await update_watchlist(conn)
+
+        tick_elapsed = time() - tick_start
+        _tick_duration.observe(tick_elapsed)
+
+        if tick_elapsed < interval:
+            await asyncio.sleep(interval - tick_elapsed)
+
+        if tick_elapsed > interval:
+            _tick_overruns.inc()
+            _logger.warning(
+                'Performance problem: iteration time exceeded by %fs', tick_elapsed - interval
             )
-            # update scheduler fields
-            await conn.execute(
-                'UPDATE watchlist '
-                'SET last_start = to_timestamp($1) '
-                'WHERE id = $2',
-                start_time, id
+
+
+async def _lease_loop(conn: asyncpg.Connection, config: dict[str, Any], owner: str,
+                      dispatch: Callable[[dict[str, Any]], None],
+                      update_watchlist: Callable[[asyncpg.Connection], Awaitable],
+                      held: Callable[[], set[int]]):
+    '''
+    Claim records to be run within each scheduler tick, so several scheduler instances
+    share the watchlist. Lease is released by writer when check result is saved.
+    Leases of records `held` by this instance, i.e. with checks pending or results
+    not saved yet, are renewed every tick, so a lease expires `lease_time` seconds
+    after this instance dies or drops the check only.
+    '''
+    interval = float(config['interval'])
+    lease_time = float(config.get('lease_time', 60.0))
+    claim_limit = int(config.get('claim_limit', 1000))
+    watchlist_claim = await conn.prepare(WATCHLIST_CLAIM_QUERY)
+    _logger.info('Scheduler instance %s', owner)
+
+    while True:
+        tick_start = time()
+        ids = held()
+        if ids:
+            await conn.execute(LEASE_RENEW_QUERY, owner, lease_time, list(ids))
+        for record in await watchlist_claim.fetch(tick_start + interval, owner,
+                                                  lease_time, claim_limit):
+            dispatch(dict(record.items()))
+
+        await update_watchlist(conn)
+
+        tick_elapsed = time() - tick_start
+        _tick_duration.observe(tick_elapsed)
+
+        if tick_elapsed < interval:
+            await asyncio.sleep(interval - tick_elapsed)
+
+        if tick_elapsed > interval:
+            _tick_overruns.inc()
+            _logger.warning(
+                'Performance problem: iteration time exceeded by %fs', tick_elapsed - interval
             )
+
+
+async def _timer_loop(interval: float,
+                      dispatch: Callable[[dict[str, Any]], None],
+                      update_watchlist: Callable[[asyncpg.Connection], Awaitable]):
+    '''
+    Load watchlist once and run checks at their exact run time.
+    Watchlist changes are received using LISTEN/NOTIFY, see db/structure.sql.
+    Notifications are lost while the listening connection is down, so the connection
+    is checked every `interval` seconds, and the whole watchlist is reloaded on reconnect.
+    '''
+    queue = TimerQueue()
+    changed: set[int] = set()
+    wakeup = asyncio.Event()
+    lost = asyncio.Event()
+
+    def on_notify(_conn, _pid, _channel, payload: str):
+        # payload is "<operation>:<id>"
+        changed.add(int(payload.split(':', 1)[1]))
+        wakeup.set()
+
+    def on_terminate(_conn):
+        lost.set()
+        wakeup.set()
+
+    def schedule(record: asyncpg.Record, now: float, run_at: Optional[float] = None):
+        params = dict(record.items())
+        last_start = params.pop('last_start')
+        period = params['interval'] = max(params['interval'], interval)
+        if run_at is None:
+            run_at = now if last_start is None else max(last_start + period, now)
+        queue.schedule(params['id'], run_at, (period, params))
+
+    fetch_query = (
+        f'SELECT {_WATCHLIST_FIELDS}, EXTRACT(EPOCH FROM last_start)::float8 last_start '
+        'FROM watchlist '
+        'WHERE enable AND content_rx_error IS NULL'
+    )
+
+    while True:
+        try:
+            async with get_pool().acquire() as conn:
+                lost.clear()
+                conn.add_termination_listener(on_terminate)
+                # subscribe first, so no change is lost while loading
+                await conn.add_listener(_WATCHLIST_CHANNEL, on_notify)
+                try:
+                    # results of dispatched runs may be not saved yet,
+                    # so run times of known records are kept on reload
+                    loaded, queue = queue, TimerQueue()
+                    changed.clear()
+                    now = time()
+                    async with conn.transaction():
+                        async for record in conn.cursor(fetch_query):
+                            entry = loaded.get(record['id'])
+                            schedule(record, now, entry[0] if entry else None)
+                    _logger.info('Timer scheduler loaded %d records', len(queue))
+
+                    checked = time()
+                    while not lost.is_set():
+                        tick_start = time()
+                        if changed:
+                            ids = list(changed)
+                            changed.clear()
+                            for id in ids:  # pylint:disable=W0622
+                                queue.remove(id)
+                            now = time()
+                            for record in await conn.fetch(
+                                    fetch_query + ' AND id = any($1::int[])', ids):
+                                schedule(record, now)
+                            checked = time()
+
+                        now = time()
+                        for _, run_at, (period, params) in queue.pop_due(now):
+                            dispatch(dict(params, run_at=run_at))
+                            # overdue runs are skipped, not repeated
+                            next_run = run_at + period
+                            if next_run <= now:
+                                next_run += (now - next_run) // period * period + period
+                            queue.schedule(params['id'], next_run, (period, params))
+
+                        # dispatch() marks records with invalid content_rx, they are notified
+                        # back, shed records are not, since last_start is not watched
+                        await update_watchlist(conn)
+
+                        if time() - checked >= interval:
+                            # a silently dropped connection is noticed by a query only
+                            await conn.execute('SELECT 1')
+                            checked = time()
+                        _tick_duration.observe(time() - tick_start)
+
+                        next_time = queue.next_time()
+                        timeout = min(interval, max(next_time - time(), 0)) \
+                            if next_time is not None else interval
+                        wakeup.clear()
+                        try:
+                            async with asyncio.timeout(timeout):
+                                await wakeup.wait()
+                        except TimeoutError:
+                            pass
+                finally:
+                    conn.remove_termination_listener(on_terminate)
+                    await conn.remove_listener(_WATCHLIST_CHANNEL, on_notify)
+        except (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, OSError) as e:
+            _logger.error('Timer scheduler connection failed: %s', e)
+
+        _logger.warning('Timer scheduler connection lost, reconnecting to reload watchlist')
+        await asyncio.sleep(interval)
@@ -0,0 +1,409 @@
+'''
+Local write-ahead spool of check results
+'''
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from time import monotonic
+from typing import Any, Callable, Optional
+
+import asyncpg
+
+from lib.checker import CheckResult
+from lib.metrics import counter, gauge, histogram
+from lib.writer import ResultSink, result_record, save_results
+
+_logger = logging.getLogger(__name__)
+
+_spool_bytes = gauge('spool_bytes', 'Spool segments size, bytes')
+_spool_records = gauge('spool_records', 'Spooled results not saved to DB yet')
+_spool_segments = gauge('spool_segments', 'Spool segment files')
+_sync_duration = histogram('spool_sync_seconds', 'Spool write and fsync time')
+_full_waits = counter('spool_full_waits_total', 'Results waited for spool space')
+_drain_errors = counter('spool_drain_errors_total', 'Failed attempts to save spooled results')
+_dropped = counter('writer_dropped_total', 'Results lost due to save errors')
+_poisoned = counter('spool_poisoned_segments_total', 'Spool segments moved aside as poisoned')
+
+# retry delay of failed batches, doubled up to the maximum
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+# DB outages are retried until saved, other errors (i.e. bugs) this number of times,
+# then the segment is moved aside
+MAX_FAILURES = 5
+_TRANSIENT_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError)
+
+
+@dataclass
+class Segment:  # pylint:disable=C0115
+    path: Path
+    size: int
+    records: int
+    # left by previous run, may be saved partially
+    recovered: bool = False
+    # number of records saved from the beginning
+    saved: int = 0
+
+
+class Spool:
+    '''
+    Append-only segment files of JSON lines in a directory, guarded by a lock file.
+    Records are appended to the current segment until it's sealed,
+    sealed segments are read and removed oldest first.
+    NOTE: methods do blocking I/O, and must be called from a single thread
+    '''
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.sealed: list[Segment] = []
+        # all segments, including the current one
+        self.size = 0
+        self.records = 0
+        self._lock = -1
+        self._seq = 0
+        self._current: Optional[Segment] = None
+        self._fd = -1
+        self._opened = 0.0
+
+    def __len__(self):
+        return len(self.sealed) + (self._current is not None)
+
+    def open(self):
+        '''
+        Lock the directory, and pick up segments left by previous run
+        '''
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = os.open(self.path / '.lock', os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError as e:
+            os.close(self._lock)
+            raise RuntimeError(f'Spool {self.path} is used by another process') from e
+
+        for path in sorted(self.path.glob('*.seg')):
+            data = path.read_bytes()
+            self.sealed.append(Segment(path, len(data), data.count(b'\n'), recovered=True))
+            self.size += len(data)
+            self.records += data.count(b'\n')
+        # numbers of poisoned segments aren't reused, so they are never overwritten
+        self._seq = 1 + max((int(path.stem) for pattern in ('*.seg', '*.poisoned')
+                             for path in self.path.glob(pattern)), default=-1)
+        if self.sealed:
+            _logger.info('Spool %s: %d results left by previous run', self.path, self.records)
+
+    def close(self):
+        '''
+        Seal the current segment and unlock the directory
+        '''
+        self.seal()
+        if self._lock >= 0:
+            os.close(self._lock)
+            self._lock = -1
+
+    def write(self, data: bytes, records: int, max_size: int, max_age: float) -> bool:
+        '''
+        Append and fsync lines of records, seal the current segment when it's over
+        `max_size` bytes or `max_age` seconds old. Returns whether a segment is sealed.
+        '''
+        if data:
+            if self._current is None:
+                self._current = Segment(self.path / f'{self._seq:016d}.seg', 0, 0)
+                self._seq += 1
+                self._fd = os.open(self._current.path,
+                                   os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+                self._opened = monotonic()
+            segment = self._current
+            view = memoryview(data)
+            try:
+                while view:
+                    view = view[os.write(self._fd, view):]
+                os.fsync(self._fd)
+            except OSError:
+                # partially written line is skipped by read()
+                self.seal()
+                raise
+            finally:
+                # counted even when failed, since they are in the file
+                segment.size += len(data) - len(view)
+                self.size += len(data) - len(view)
+            segment.records += records
+            self.records += records
+
+        if self._current and (self._current.size >= max_size
+                              or monotonic() - self._opened >= max_age):
+            self.seal()
+            return True
+        return False
+
+    def seal(self):
+        '''
+        Close the current segment, it becomes available for reading
+        '''
+        if self._current is None:
+            return
+        os.close(self._fd)
+        self._fd = -1
+        if self._current.size:
+            self.sealed.append(self._current)
+        else:
+            self._current.path.unlink()
+        self._current = None
+
+    def read(self, segment: Segment) -> list[list]:
+        '''
+        Records of a sealed segment, broken lines are skipped
+        '''
+        records = []
+        with segment.path.open('rb') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    _logger.warning('Spool %s: broken record skipped', segment.path)
+        return records
+
+    def remove(self, segment: Segment, poisoned: bool = False):
+        '''
+        Remove the oldest sealed segment, poisoned one is renamed to *.poisoned instead,
+        so it's kept for investigation but not read again
+        '''
+        if poisoned:
+            segment.path.rename(segment.path.with_suffix('.poisoned'))
+        else:
+            segment.path.unlink()
+        self.sealed.remove(segment)
+        self.size -= segment.size
+        self.records -= segment.records
+
+
+class SpoolWriter(ResultSink):
+    '''
+    Check results are appended to a local spool, and saved from it to DB by a drainer
+    coroutine in batches of `batch_size`, so DB stalls and outages don't hold workers.
+    Appended results are written and fsynced every `sync_interval` seconds, segments are
+    sealed for draining when they reach `segment_bytes` or are `segment_age` seconds old.
+    Batches failed due to DB outage are retried until saved, rows rejected by DB are isolated
+    by splitting the batch, and segments failing otherwise `MAX_FAILURES` times are moved
+    aside as poisoned. Spool size is limited by `max_bytes`,
+    `put()` callers wait when it's full. Results are saved in `log_mode`, see ResultWriter.
+    '''
+    def __init__(self, path: str, max_bytes: int = 1 << 30, segment_bytes: int = 4 << 20,
+                 segment_age: float = 1.0, sync_interval: float = 0.1,
+                 batch_size: int = 5000, rollups: bool = True, log_mode: str = 'full',
+                 run_max_duration: float = 3600.0):
+        self._spool = Spool(path)
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self._segment_age = segment_age
+        self._sync_interval = sync_interval
+        self._batch_size = batch_size
+        self._rollups = rollups
+        self._runs = run_max_duration if log_mode == 'runs' else None
+        # spool is accessed by a single thread, so fsync doesn't block event loop
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='spool')
+        self._buffer: list[bytes] = []
+        self._buffered = 0
+        # results accepted by this run by record id, until saved or dropped
+        self._unsaved: Counter[int] = Counter()
+        self._buffer_ids: list[int] = []
+        self._space = asyncio.Event()
+        self._sealed = asyncio.Event()
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def spool(self) -> Spool:  # pylint:disable=C0116
+        return self._spool
+
+    def start(self):
+        '''
+        Open spool in a blocking way, and spawn syncer and drainer coroutines
+        '''
+        self._spool.open()
+        _spool_bytes.set_function(lambda: self._spool.size + self._buffered)
+        _spool_records.set_function(lambda: self._spool.records + len(self._buffer))
+        _spool_segments.set_function(self._spool.__len__)
+        for coro in (self._syncer(), self._drainer()):
+            task = asyncio.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        '''
+        Stop coroutines, sync all accepted results, and try to save spooled ones once.
+        Results not saved are left in spool for the next run.
+        '''
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        await self._sync(max_age=0)
+        for segment in list(self._spool.sealed):
+            if not await self._drain(segment, retry=False):
+                break
+        await self._run(self._spool.close)
+        if self._spool.records:
+            _logger.warning('Spool %s: %d results left unsaved',
+                            self._spool.path, self._spool.records)
+        self._executor.shutdown()
+
+    async def put(self, wl_id: int, start: float, end: float, result: CheckResult):
+        '''
+        Append check result to spool buffer, wait if spool is full
+        '''
+        while self._spool.size + self._buffered >= self._max_bytes:
+            _full_waits.inc()
+            self._space.clear()
+            await self._space.wait()
+
+        line = json.dumps(result_record(wl_id, start, end, result),
+                          separators=(',', ':')).encode() + b'\n'
+        self._buffer.append(line)
+        self._buffered += len(line)
+        self._buffer_ids.append(wl_id)
+        self._unsaved[wl_id] += 1
+
+    def unsaved(self) -> set[int]:
+        '''
+        Ids of records which results accepted by this run are not saved yet
+        '''
+        # drop saved ones, counts are decremented only
+        self._unsaved = +self._unsaved
+        return set(self._unsaved)
+
+    async def _run(self, function: Callable, *args) -> Any:
+        # spool operation is completed even if caller is cancelled
+        return await asyncio.shield(
+            asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        )
+
+    async def _syncer(self):
+        while True:
+            await asyncio.sleep(self._sync_interval)
+            await self._sync(self._segment_age)
+
+    async def _sync(self, max_age: float):
+        data, records = b''.join(self._buffer), len(self._buffer)
+        ids = self._buffer_ids
+        self._buffer = []
+        self._buffered = 0
+        self._buffer_ids = []
+
+        tm0 = monotonic()
+        try:
+            sealed = await self._run(self._spool.write, data, records,
+                                     self._segment_bytes, max_age)
+        except OSError as e:
+            _dropped.inc(records)
+            _logger.error('Failed to spool %d check results: %r', records, e)
+            self._unsaved.subtract(ids)
+            sealed = True
+        if data:
+            _sync_duration.observe(monotonic() - tm0)
+        if sealed:
+            self._sealed.set()
+
+    async def _drainer(self):
+        while True:
+            if not self._spool.sealed:
+                self._sealed.clear()
+                await self._sealed.wait()
+                continue
+            await self._drain(self._spool.sealed[0])
+
+    async def _drain(self, segment: Segment, retry: bool = True) -> bool:
+        '''
+        Save segment records to DB and remove it, returns whether it's done
+        '''
+        records = await self._run(self._spool.read, segment)
+        # recovered segment may be saved partially
+        replay = segment.recovered
+        delay = RETRY_DELAY
+        # batch size, halved to isolate rows rejected by DB
+        size = self._batch_size
+        failures = 0
+        while segment.saved < len(records):
+            batch = records[segment.saved:segment.saved + size]
+            try:
+                await save_results(batch, self._rollups, replay, self._runs)
+            except asyncio.CancelledError:
+                raise
+            except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError) as e:
+                _drain_errors.inc()
+                if not replay:
+                    # saved or orphaned records are skipped on replay
+                    replay = True
+                    continue
+                if len(batch) > 1:
+                    size = len(batch) // 2
+                    continue
+                _dropped.inc()
+                _logger.error('Failed to save spooled check result %r: %r', batch[0], e)
+            except _TRANSIENT_ERRORS as e:
+                _drain_errors.inc()
+                if not retry:
+                    return False
+                _logger.error('Failed to save %d spooled check results, retry in %.1fs: %r',
+                              len(batch), delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                # it's unknown whether failed transaction was committed
+                replay = True
+                continue
+            except Exception as e:  # pylint:disable=W0718
+                _drain_errors.inc()
+                failures += 1
+                if failures >= MAX_FAILURES:
+                    _poisoned.inc()
+                    _dropped.inc(len(records) - segment.saved)
+                    _logger.exception('Spool %s: %d check results are not saved, segment is '
+                                      'moved aside: %r', segment.path,
+                                      len(records) - segment.saved, e)
+                    self._done(segment, records[segment.saved:])
+                    await self._run(self._spool.remove, segment, True)
+                    self._space.set()
+                    return True
+                if not retry:
+                    return False
+                _logger.error('Failed to save %d spooled check results, retry in %.1fs: %r',
+                              len(batch), delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                replay = True
+                continue
+
+            segment.saved += len(batch)
+            self._done(segment, batch)
+            replay = segment.recovered
+            delay = RETRY_DELAY
+            size = self._batch_size
+            failures = 0
+
+        await self._run(self._spool.remove, segment)
+        self._space.set()
+        return True
+
+    def _done(self, segment: Segment, records: list[list]):
+        # results left by previous run aren't counted
+        if not segment.recovered:
+            self._unsaved.subtract(record[0] for record in records)
+
+
+def create_spool_writer(config: dict) -> SpoolWriter:
+    '''
+    Create spooling writer using `scheduler` configuration section
+    '''
+    return SpoolWriter(
+        config['spool_dir'],
+        max_bytes=int(config.get('spool_max_bytes', 1 << 30)),
+        segment_bytes=int(config.get('spool_segment_bytes', 4 << 20)),
+        segment_age=float(config.get('write_batch_age', 1.0)),
+        sync_interval=float(config.get('spool_sync_interval', 0.1)),
+        batch_size=int(config.get('spool_batch_size', 5000)),
+        rollups=bool(config.get('write_rollups', True)),
+        log_mode=config.get('log_mode', 'full'),
+        run_max_duration=float(config.get('run_max_duration', 3600.0)),
+    )
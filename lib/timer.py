@@ -0,0 +1,76 @@
+'''
+In-memory timer queue
+'''
+import heapq
+from itertools import count
+from typing import Any, Hashable, Optional
+
+
+class TimerQueue:
+    '''
+    Min-heap of items keyed by their run time.
+    Rescheduled and removed items are invalidated in place and skipped when popped,
+    so every operation is O(log n) regardless of queue size.
+    '''
+    def __init__(self):
+        self._heap: list[list] = []
+        self._entries: dict[Hashable, list] = {}
+        # tie breaker, so items are never compared
+        self._seq = count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def get(self, key: Hashable) -> Optional[tuple[float, Any]]:
+        '''
+        Run time and item of a queued key
+        '''
+        entry = self._entries.get(key)
+        return (entry[0], entry[3]) if entry else None
+
+    def schedule(self, key: Hashable, run_at: float, item: Any = None):
+        '''
+        Add item or move existing one to the new run time
+        '''
+        self.remove(key)
+        entry = [run_at, next(self._seq), key, item]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, key: Hashable):
+        '''
+        Remove item if it exists
+        '''
+        entry = self._entries.pop(key, None)
+        if entry:
+            # invalidate, entry is dropped from heap when reaches its top
+            entry[2] = entry[3] = None
+
+    def next_time(self) -> Optional[float]:
+        '''
+        Run time of the earliest item
+        '''
+        self._drop_removed()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> list[tuple[Hashable, float, Any]]:
+        '''
+        Pop all items with run time not later than `now`
+        '''
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            run_at, _, key, item = heapq.heappop(self._heap)
+            if key is not None:
+                del self._entries[key]
+                due.append((key, run_at, item))
+        return due
+
+    def _drop_removed(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
@@ -0,0 +1,404 @@
+'''
+Batching check results writer
+'''
+import asyncio
+import logging
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Optional, Sequence
+
+import asyncpg
+
+from lib.db import get_pool
+from lib.checker import CheckResult
+from lib.metrics import counter, gauge, histogram
+from lib.rollup import ROLLUP_TABLES, Rollup, bucket_start, upsert_query
+from lib.runs import LATEST_RUNS_QUERY, RUN_COLUMNS, UPDATE_RUN_QUERY, Run, split_runs
+
+_logger = logging.getLogger(__name__)
+
+_batch_size = histogram('writer_batch_size', 'Saved batch size, results',
+                        buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+_flush_duration = histogram('writer_flush_seconds', 'Batch save time, including pool acquire')
+_pool_acquire = histogram('db_pool_acquire_seconds', 'Writer DB pool acquire wait')
+_dropped = counter('writer_dropped_total', 'Results lost due to save errors')
+_queue_size = gauge('writer_queue_size', 'Results waiting to be saved')
+_error_lookups = counter('writer_error_lookups_total',
+                         'Error messages missing in the writer cache, looked up in check_error')
+
+# `full` - a check_log row per check, `runs` - consecutive checks of the same outcome
+# are merged into check_run rows, see lib.runs
+LOG_MODES = ('full', 'runs')
+
+# NOTE: order must match result_record() layout, also columns of check_log_view
+RESULT_COLUMNS = ('wl_id', 'start', 'end', 'dns', 'connect', 'ttfb', 'response',
+                  'status_code', 'content_check', 'error_message', 'reused',
+                  'early_match', 'truncated', 'tcp', 'tls', 'sent', 'probe',
+                  'bytes_received', 'tls_resumed')
+
+# NOTE: order must match _check_log_row() layout
+CHECK_LOG_COLUMNS = ('start', 'wl_id', 'duration', 'ttfb', 'response', 'error_id',
+                     'bytes_received', 'status_code', 'dns', 'tcp', 'tls', 'connect', 'sent',
+                     'content_check', 'reused', 'early_match', 'truncated', 'tls_resumed',
+                     'probe')
+
+# smallint timings of check_log are saturated
+SMALLINT_MAX = 32767
+
+
+def _timestamp(value: float) -> datetime:
+    # DB session timezone is UTC, see lib.db.initialize_pool()
+    return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+
+
+def _smallint(value: Optional[int]) -> Optional[int]:
+    return value if value is None or value <= SMALLINT_MAX else SMALLINT_MAX
+
+
+def _check_log_row(record: tuple, error_ids: dict[str, int]) -> tuple:
+    (wl_id, start, end, dns, connect, ttfb, response, status_code, content_check,
+     error_message, reused, early_match, truncated, tcp, tls, sent, probe, bytes_received,
+     tls_resumed) = record
+    return (
+        start, wl_id, round((end - start).total_seconds() * 1000), ttfb, response,
+        None if error_message is None else error_ids[error_message], bytes_received,
+        status_code, _smallint(dns), _smallint(tcp), _smallint(tls), _smallint(connect),
+        _smallint(sent), content_check, reused, early_match, truncated, tls_resumed, probe
+    )
+
+
+def result_record(wl_id: int, start: float, end: float, result: CheckResult) -> tuple:
+    '''
+    Record of the result in RESULT_COLUMNS layout, with start and end as unix timestamps,
+    followed by watchlist fields: certificate expiration
+    '''
+    return (
+        wl_id, start, end, result.dns, result.connection, result.ttfb, result.response,
+        result.status_code, result.content_check, result.error_message, result.reused,
+        result.early_match, result.truncated, result.tcp, result.tls, result.sent,
+        result.probe, result.bytes_received, result.tls_resumed, result.cert_expires
+    )
+
+
+class ErrorDictionary:
+    '''
+    check_error ids of `size` recently saved error messages, so the writer looks up
+    or interns only messages missing here. Ids are cached once the batch is committed,
+    so ids of rolled back messages are never used.
+    '''
+    def __init__(self, size: int = 10000):
+        self._size = size
+        self._ids: OrderedDict[str, int] = OrderedDict()
+
+    async def lookup(self, conn: asyncpg.Connection, messages: set[str]) -> dict[str, int]:
+        '''
+        Ids of messages, missing ones are interned in the current transaction
+        '''
+        ids = {}
+        missing = []
+        for message in messages:
+            if message in self._ids:
+                ids[message] = self._ids[message]
+            else:
+                missing.append(message)
+        if missing:
+            _error_lookups.inc(len(missing))
+            # the same order for all writers, so concurrent inserts don't deadlock
+            missing.sort()
+            await conn.execute('INSERT INTO check_error (message) '
+                               'SELECT unnest($1::varchar[]) ON CONFLICT DO NOTHING', missing)
+            ids.update((r['message'], r['id']) for r in await conn.fetch(
+                'SELECT message, id FROM check_error '
+                'WHERE md5(message) IN (SELECT md5(unnest($1::varchar[])))', missing
+            ))
+        return ids
+
+    def add(self, ids: dict[str, int]):
+        '''
+        Cache committed ids
+        '''
+        for message, id in ids.items():  # pylint:disable=W0622
+            self._ids[message] = id
+            self._ids.move_to_end(message)
+        while len(self._ids) > self._size:
+            self._ids.popitem(last=False)
+
+
+_errors = ErrorDictionary()
+
+
+class ResultSink:
+    '''
+    Check results destination of the dispatcher
+    '''
+    def start(self):
+        '''
+        Spawn background coroutines
+        '''
+
+    async def close(self):
+        '''
+        Stop background coroutines, saving everything accepted
+        '''
+
+    async def put(self, wl_id: int, start: float, end: float, result: CheckResult):
+        '''
+        Accept check result, may wait for free space
+        '''
+        raise NotImplementedError
+
+    def unsaved(self) -> set[int]:
+        '''
+        Ids of records which accepted results are not saved yet, if tracked
+        '''
+        return set()
+
+
+class ResultWriter(ResultSink):
+    '''
+    Check results are queued by workers and saved in bulk by writer coroutines.
+    A batch is flushed when it reaches `batch_size` records or `batch_age` seconds.
+    Full queue blocks `put()` callers.
+    With `rollups` enabled, per-minute and per-hour aggregates are updated with each batch.
+    In `runs` log mode, runs last at most `run_max_duration` seconds.
+    '''
+    def __init__(self, queue_size: int = 10000, batch_size: int = 500,
+                 batch_age: float = 1.0, writers: int = 1, rollups: bool = True,
+                 log_mode: str = 'full', run_max_duration: float = 3600.0):
+        self._queue: asyncio.Queue[tuple] = asyncio.Queue(queue_size)
+        self._batch_size = batch_size
+        self._batch_age = batch_age
+        self._writers = writers
+        self._rollups = rollups
+        self._runs = run_max_duration if log_mode == 'runs' else None
+        self._tasks: set[asyncio.Task] = set()
+        # records collected by cancelled writers
+        self._leftover: list[tuple] = []
+        # accepted results by record id, until saved or dropped
+        self._unsaved: Counter[int] = Counter()
+
+    def start(self):
+        '''
+        Spawn writer coroutines
+        '''
+        _queue_size.set_function(self._queue.qsize)
+        for _ in range(self._writers - len(self._tasks)):
+            task = asyncio.create_task(self._writer())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        '''
+        Stop writer coroutines and save everything left in queue
+        '''
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        batch, self._leftover = self._leftover, []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+        for i in range(0, len(batch), self._batch_size):
+            await self._flush(batch[i:i + self._batch_size])
+
+    async def put(self, wl_id: int, start: float, end: float, result: CheckResult):
+        '''
+        Queue check result, wait if queue is full
+        '''
+        await self._queue.put(result_record(wl_id, start, end, result))
+        self._unsaved[wl_id] += 1
+
+    def unsaved(self) -> set[int]:
+        '''
+        Ids of records which queued results are not saved yet
+        '''
+        # drop saved ones, counts are decremented only
+        self._unsaved = +self._unsaved
+        return set(self._unsaved)
+
+    async def _writer(self):
+        batch: list[tuple] = []
+        try:
+            while True:
+                batch.append(await self._queue.get())
+                deadline = monotonic() + self._batch_age
+
+                while len(batch) < self._batch_size:
+                    if not self._queue.empty():
+                        batch.append(self._queue.get_nowait())
+                        continue
+
+                    timeout = deadline - monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        # unlike wait_for(), doesn't lose a received item on cancellation
+                        async with asyncio.timeout(timeout):
+                            batch.append(await self._queue.get())
+                    except TimeoutError:
+                        break
+
+                await self._flush(batch)
+                batch = []
+        except asyncio.CancelledError:
+            # unfinished flush is rolled back, so these records are saved by close()
+            self._leftover.extend(batch)
+            raise
+
+    async def _flush(self, batch: list[tuple]):
+        try:
+            await save_results(batch, self._rollups, runs=self._runs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # pylint:disable=W0718
+            _dropped.inc(len(batch))
+            _logger.error('Failed to save %d check results: %r', len(batch), e)
+        # not reached when cancelled: the flush is rolled back, and saved by close()
+        self._unsaved.subtract(record[0] for record in batch)
+
+
+async def save_results(batch: Sequence[Sequence], rollups: bool = True, replay: bool = False,
+                       runs: Optional[float] = None):
+    '''
+    Save result records in a single transaction: append them to check_log
+    with error messages interned to check_error,
+    set watchlist last_start and certificate expiration, and update rollups.
+    With `replay`, records already saved or of deleted watchlist records are skipped,
+    e.g. when saving again after a failure with unknown outcome.
+    With `runs` set, records are merged into check_run runs of at most `runs` seconds instead.
+    '''
+    records = []
+    # single UPDATE can't set the same row twice, keep the latest start only
+    last_start: dict[int, datetime] = {}
+    cert_expires: dict[int, Optional[datetime]] = {}
+    for wl_id, start, end, *values, expires in batch:
+        start = _timestamp(start)
+        records.append((wl_id, start, _timestamp(end), *values))
+        if wl_id not in last_start or start > last_start[wl_id]:
+            last_start[wl_id] = start
+        if expires is not None:
+            cert_expires[wl_id] = _timestamp(expires)
+
+    _batch_size.observe(len(batch))
+    tm0 = monotonic()
+    async with get_pool().acquire() as conn:
+        _pool_acquire.observe(monotonic() - tm0)
+        error_ids: dict[str, int] = {}
+        async with conn.transaction():
+            if runs is not None:
+                records = await _save_runs(conn, records, runs, replay)
+            else:
+                error_ids = await _errors.lookup(
+                    conn, {r[9] for r in records if r[9] is not None}
+                )
+                log_rows = [_check_log_row(r, error_ids) for r in records]
+                if replay:
+                    records = await _insert_new(conn, records, log_rows)
+                else:
+                    await conn.copy_records_to_table(
+                        'check_log', records=log_rows, columns=CHECK_LOG_COLUMNS
+                    )
+            await conn.execute(
+                'UPDATE watchlist '
+                # release lease, see lib.scheduler._lease_loop()
+                'SET last_start = v.last_start, lease_owner = NULL, lease_until = NULL, '
+                # checks on reused connections don't see certificate
+                'cert_expires = coalesce(v.cert_expires, watchlist.cert_expires) '
+                'FROM unnest($1::int[], $2::timestamp[], $3::timestamp[]) '
+                'v(id, last_start, cert_expires) '
+                'WHERE watchlist.id = v.id',
+                list(last_start.keys()), list(last_start.values()),
+                [cert_expires.get(wl_id) for wl_id in last_start]
+            )
+            if rollups:
+                for table, rows in _rollups(records).items():
+                    await conn.executemany(upsert_query(table), rows)
+        _errors.add(error_ids)
+    _flush_duration.observe(monotonic() - tm0)
+
+
+async def _insert_new(conn: asyncpg.Connection, records: list[tuple], rows: list[tuple]
+                      ) -> list[tuple]:
+    # records inserted actually, so rollups don't count skipped ones
+    columns = ', '.join(f'"{c}"' for c in CHECK_LOG_COLUMNS)
+    await conn.execute('CREATE TEMP TABLE check_log_replay (LIKE check_log) ON COMMIT DROP')
+    await conn.copy_records_to_table('check_log_replay', records=rows,
+                                     columns=CHECK_LOG_COLUMNS)
+    inserted = {tuple(r) for r in await conn.fetch(
+        f'INSERT INTO check_log ({columns}) SELECT {columns} FROM check_log_replay r '
+        'WHERE EXISTS (SELECT 1 FROM watchlist w WHERE w.id = r.wl_id) '
+        'ON CONFLICT DO NOTHING RETURNING wl_id, "start"'
+    )}
+    return [r for r in records if (r[0], r[1]) in inserted]
+
+
+async def _save_runs(conn: asyncpg.Connection, records: list[tuple], max_duration: float,
+                     replay: bool) -> list[tuple]:
+    # records saved actually, so rollups don't count skipped ones
+    ids = sorted({r[0] for r in records})
+    latest = {r['wl_id']: Run(**r) for r in await conn.fetch(LATEST_RUNS_QUERY, ids)}
+    if replay:
+        existing = {r['id'] for r in await conn.fetch(
+            'SELECT id FROM watchlist WHERE id = any($1::int[])', ids
+        )}
+        # checks of a record are saved in start order
+        records = [r for r in records if r[0] in existing
+                   and (r[0] not in latest or r[1] > latest[r[0]].last_start)]
+
+    new: list[tuple] = []
+    updated: list[tuple] = []
+    for run in split_runs(records, max_duration):
+        # only the first run of a record in the batch may continue the stored one
+        previous = latest.pop(run.wl_id, None)
+        if previous and run.follows(previous, max_duration):
+            previous.extend(run)
+            updated.append(previous.values())
+        else:
+            new.append(run.values())
+
+    if updated:
+        await conn.executemany(UPDATE_RUN_QUERY, updated)
+    if new:
+        await conn.copy_records_to_table('check_run', records=new, columns=RUN_COLUMNS)
+    return records
+
+
+def _rollups(records: list[tuple]) -> dict[str, list[tuple]]:
+    rollups: dict[tuple[str, int, datetime], Rollup] = {}
+    for (wl_id, start, _, _, connect, ttfb, response, status_code, content_check,
+         error_message, *_) in records:
+        for table, width in ROLLUP_TABLES.items():
+            key = (table, wl_id, bucket_start(start, width))
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = rollups[key] = Rollup()
+            rollup.add(status_code, content_check, error_message, connect, ttfb, response)
+
+    rows: dict[str, list[tuple]] = {table: [] for table in ROLLUP_TABLES}
+    # same rows order for all writers, so concurrent upserts don't deadlock
+    for (table, wl_id, bucket), rollup in sorted(rollups.items(), key=lambda item: item[0]):
+        rows[table].append((wl_id, bucket, *rollup.values()))
+    return rows
+
+
+def create_writer(config: dict) -> ResultSink:
+    '''
+    Create writer using `scheduler` configuration section,
+    spooling one if `spool_dir` is set
+    '''
+    if config.get('spool_dir'):
+        # spool module depends on this one
+        from lib.spool import create_spool_writer  # pylint:disable=C0415
+        return create_spool_writer(config)
+
+    return ResultWriter(
+        queue_size=int(config.get('write_queue_size', 10000)),
+        batch_size=int(config.get('write_batch_size', 500)),
+        batch_age=float(config.get('write_batch_age', 1.0)),
+        writers=int(config.get('writers', 1)),
+        rollups=bool(config.get('write_rollups', True)),
+        log_mode=config.get('log_mode', 'full'),
+        run_max_duration=float(config.get('run_max_duration', 3600.0)),
+    )
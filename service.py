@@ -3,10 +3,20 @@
 
 import asyncio
 import logging
+import multiprocessing
+import os
+import sys
+import time
 from typing import Any
 
+from lib.checker import initialize_client, close_client
 from lib.config import load_config
-from lib.db import initialize_pool
+from lib.db import get_pool, initialize_pool
+from lib.loopmon import close_monitor, initialize_monitor, new_event_loop
+from lib.matcher import close_matcher, initialize_matcher
+from lib.metrics import start_server
+from lib.partitions import maintenance_loop
+from lib.resolver import initialize_resolver
 from lib.scheduler import main_loop
 
 
@@ -21,11 +31,81 @@ def _task_exception_handler(_, context: dict[str, Any]):
                        context.pop('message'), context)
 
 
+def _run(config: dict[str, Any], worker: int = 0):
+    monitor = dict(config.get('loop', {}))
+    loop = new_event_loop(monitor.pop('uvloop', False))
+    asyncio.set_event_loop(loop)
+    loop.set_exception_handler(_task_exception_handler)
+    initialize_monitor(loop, **monitor)
+    loop.run_until_complete(initialize_pool(**config['db']))
+
+    metrics = config.get('metrics', {})
+    server = None
+    if metrics.get('enable'):
+        # each process serves its own metrics on the next port
+        server = loop.run_until_complete(start_server(metrics.get('host', '127.0.0.1'),
+                                                      int(metrics.get('port', 9100)) + worker))
+    initialize_client(**config.get('http', {}))
+    initialize_matcher(**config.get('match', {}))
+    initialize_resolver(**config.get('dns', {}))
+
+    scheduler = dict(config['scheduler'])
+    if scheduler.get('spool_dir'):
+        # each process has its own spool
+        scheduler['spool_dir'] = os.path.join(scheduler['spool_dir'], str(worker))
+
+    partitions = dict(config.get('partitions', {}))
+    maintenance = None
+    if partitions.pop('enable', True):
+        maintenance = loop.create_task(maintenance_loop(**partitions))
+    try:
+        loop.run_until_complete(main_loop(scheduler))
+    finally:
+        if maintenance:
+            maintenance.cancel()
+        loop.run_until_complete(close_client())
+        loop.run_until_complete(close_matcher())
+        if server:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(get_pool().close())
+        close_monitor()
+
+
+def _run_processes(config: dict[str, Any], processes: int):
+    '''
+    Run scheduler in several processes, restarting failed ones
+    '''
+    workers: list[multiprocessing.Process] = []
+    try:
+        while True:
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logging.error('Worker %d exited with code %s, restarting', i, worker.exitcode)
+                    workers[i] = multiprocessing.Process(target=_run, args=(config, i))
+                    workers[i].start()
+
+            while len(workers) < processes:
+                workers.append(multiprocessing.Process(target=_run,
+                                                       args=(config, len(workers))))
+                workers[-1].start()
+
+            time.sleep(1)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
 if __name__ == '__main__':
     config = load_config()
     logging.basicConfig()
 
-    loop = asyncio.get_event_loop()
-    loop.set_exception_handler(_task_exception_handler)
-    loop.run_until_complete(initialize_pool(**config['db']))
-    loop.run_until_complete(main_loop(config['scheduler']))
+    processes = int(config.get('service', {}).get('processes', 1))
+    if processes > 1:
+        if config['scheduler'].get('mode') != 'lease':
+            sys.exit('Multiple processes require scheduler.mode = "lease"')
+        _run_processes(config, processes)
+    else:
+        _run(config)
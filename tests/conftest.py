@@ -9,7 +9,7 @@ from threading import Thread
 
 import pytest
 import pytest_asyncio
-from tests.lib.http_server import DelayingHTTPServer
+from tests.lib.http_server import CERT_FILE, DelayingHTTPServer
 from lib.config import load_config
 from lib.db import get_pool, initialize_pool
 
@@ -17,12 +17,14 @@ from lib.db import get_pool, initialize_pool
 @pytest.fixture
 def http_server():
     @contextmanager
-    def server(ttfb=0, response=0):
+    def server(ttfb=0, response=0, keep_alive=False, tls=False):
         """Delaying HTTP Server fixture
 
         Args:
             ttfb (int, optional): Time To First Byte delay, in milliseconds. Defaults to 0.
             response (int, optional): Response delay, in milliseconds. Defaults to 0.
+            keep_alive (bool, optional): Keep connections alive (HTTP/1.1). Defaults to False.
+            tls (bool, optional): Serve HTTPS with the certificate of CERT_FILE. Defaults to False.
 
         Yields:
             int: server port number
@@ -30,7 +32,8 @@ def http_server():
         while True:
             try:
                 port = randrange(10240, 65535)
-                server = DelayingHTTPServer('127.0.0.1', port, ttfb, response)
+                server = DelayingHTTPServer('127.0.0.1', port, ttfb, response, keep_alive,
+                                            str(CERT_FILE) if tls else None)
                 break
             except OSError:
                 # port is in use, try another
@@ -67,5 +70,11 @@ async def test_database():
 
         yield
 
+        await conn.execute('DROP VIEW IF EXISTS check_log_view')
         await conn.execute('DROP TABLE IF EXISTS check_log')
+        await conn.execute('DROP TABLE IF EXISTS check_error')
+        await conn.execute('DROP TABLE IF EXISTS check_run')
+        await conn.execute('DROP TABLE IF EXISTS check_skip')
+        await conn.execute('DROP TABLE IF EXISTS check_stat_minute')
+        await conn.execute('DROP TABLE IF EXISTS check_stat_hour')
         await conn.execute('DROP TABLE IF EXISTS watchlist')
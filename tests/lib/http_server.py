@@ -3,23 +3,44 @@
     A simple implementation inspired by httpbin.org
 """
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 from socket import socket
+import ssl
 import time
 from typing import Any
 from urllib.parse import urlparse
 
+# self-signed certificate of 127.0.0.1 and its key, valid until 2126
+CERT_FILE = Path(__file__).parent / 'localhost.pem'
+
 
 # pylint:disable=C0115,C0116
 class DelayingRequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):  # pylint:disable=C0103
+    # validator of all responses
+    etag = '"v1"'
+
+    def do_HEAD(self):  # pylint:disable=C0103
+        if urlparse(self.path).path.startswith('/nohead/'):
+            # unlike send_error(), keeps connection alive
+            self.send_response(HTTPStatus.METHOD_NOT_ALLOWED)
+            if not self.server.keep_alive:  # type:ignore
+                self.send_header('Connection', 'close')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):  # pylint:disable=C0103
         path: str = urlparse(self.path).path
         code = 200
-        if path.startswith('/status/'):
+        if path.startswith(('/status/', '/nohead/')):
             try:
                 code = int(path[8:])  # skip /status/
             except ValueError:
                 pass
+        if code == 200 and self.headers.get('If-None-Match') == self.etag:
+            code = HTTPStatus.NOT_MODIFIED
 
         try:
             message, explain = self.responses[code]
@@ -28,7 +49,9 @@ class DelayingRequestHandler(BaseHTTPRequestHandler):
 
         self.log_error("code %d, message %s", code, message)
         self.send_response(code, message)
-        self.send_header('Connection', 'close')
+        if not self.server.keep_alive:  # type:ignore
+            self.send_header('Connection', 'close')
+        self.send_header('ETag', self.etag)
 
         # Message body is omitted for cases described in:
         #  - RFC7230: 3.3. 1xx, 204(No Content), 304(Not Modified)
@@ -53,16 +76,32 @@ class DelayingRequestHandler(BaseHTTPRequestHandler):
         if self.server.response_delay:  # type:ignore
             time.sleep(self.server.response_delay / 1000)  # type:ignore
 
-        if body:
+        if body and not head:
             self.wfile.write(body)
 
 
-class DelayingHTTPServer(HTTPServer):
+class KeepAliveRequestHandler(DelayingRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+class DelayingHTTPServer(ThreadingHTTPServer):
+    # kept-alive connections are served by threads, which don't block shutdown
+    daemon_threads = True
+    block_on_close = False
+
     def __init__(self, host: str, port: int,
-                 ttfb_delay: int = 0, response_delay: int = 0) -> None:
-        super().__init__((host, port), DelayingRequestHandler, True)
+                 ttfb_delay: int = 0, response_delay: int = 0, keep_alive: bool = False,
+                 certfile: str | None = None) -> None:
+        super().__init__((host, port),
+                         KeepAliveRequestHandler if keep_alive else DelayingRequestHandler, True)
+        if certfile:
+            # handshake is made by accept(), issuing session tickets for resumption
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(certfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
         self.ttfb_delay = ttfb_delay
         self.response_delay = response_delay
+        self.keep_alive = keep_alive
 
     def process_request(self, request: socket | tuple[bytes, socket], client_address: Any) -> None:
         if self.ttfb_delay:
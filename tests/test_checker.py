@@ -1,7 +1,10 @@
 # pylint:disable=C0114,C0115,C0116
+from unittest.mock import patch
 import pytest
 
-from lib.checker import check_url
+from lib.checker import check_url, close_client, initialize_client
+from lib.network import initialize_tls, ssl_context
+from tests.lib.http_server import CERT_FILE
 
 
 @pytest.mark.asyncio
@@ -12,10 +15,12 @@ async def test_checker_delays(http_server, ttfb, content, code):
         res = await check_url(f'http://127.0.0.1:{port}/status/{code}')
 
     assert res.status_code == code
-    assert None not in (res.connection, res.ttfb, res.response) and \
-        res.connection <= res.ttfb <= res.response  # type:ignore
-    # BUG: due to httpcore limitation, no way to determine actual first byte timestamp
-    # assert res.ttfb >= ttfb
+    assert None not in (res.connection, res.sent, res.ttfb, res.response) and \
+        res.connection <= res.sent <= res.ttfb <= res.response  # type:ignore
+    assert res.tcp is not None and res.tls is None
+    assert res.ttfb >= ttfb  # type:ignore
+    # response body is delayed after headers
+    assert res.response - res.ttfb >= content  # type:ignore
     assert res.response >= content + ttfb
 
 
@@ -41,3 +46,153 @@ async def test_checker_unreachable():
 
     assert res.status_code is None
     assert res.error_message
+
+
+@pytest.mark.asyncio
+async def test_checker_reuse_connection(http_server):
+    initialize_client()
+    try:
+        with http_server(keep_alive=True) as port:
+            res = await check_url(f'http://127.0.0.1:{port}/status/200', reuse_connection=True)
+            assert res.status_code == 200
+            # the first check makes a connection for the shared client
+            assert res.reused is False and res.connection is not None
+
+            res = await check_url(f'http://127.0.0.1:{port}/status/200', reuse_connection=True)
+            assert res.status_code == 200
+            assert res.reused is True and res.connection == 0
+
+            # a new connection is made when reuse is not enabled
+            res = await check_url(f'http://127.0.0.1:{port}/status/200')
+            assert res.reused is False and res.connection is not None
+    finally:
+        await close_client()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('regex,limit,expect,early,truncated', [
+    ('Request fulfilled', None, True, True, False),
+    ('</html>\n$', None, True, False, False),
+    ('</html>', 100, False, False, True),
+    (None, 100, None, None, True),
+])
+async def test_checker_streaming(http_server, regex, limit, expect, early, truncated):
+
+    with http_server() as port:
+        res = await check_url(f'http://127.0.0.1:{port}/status/200', regex, max_body_bytes=limit)
+
+    assert res.status_code == 200
+    assert res.content_check == expect
+    assert res.early_match == early
+    assert res.truncated == truncated
+    assert res.response is not None
+
+
+@pytest.mark.asyncio
+async def test_checker_dns(http_server):
+
+    with http_server() as port:
+        res = await check_url(f'http://localhost:{port}/status/200')
+        assert res.status_code == 200
+        assert res.dns is not None
+
+        res = await check_url(f'http://127.0.0.1:{port}/status/200')
+        assert res.dns == 0
+
+
+@pytest.mark.asyncio
+async def test_checker_probe_head(http_server):
+
+    with http_server() as port:
+        res = await check_url(f'http://127.0.0.1:{port}/status/200', probe='head')
+        assert (res.status_code, res.probe, res.bytes_received) == (200, 'head', 0)
+
+        # content can't be checked with HEAD
+        res = await check_url(f'http://127.0.0.1:{port}/status/200', 'Request', probe='head')
+        assert (res.probe, res.content_check) == ('get', True)
+
+        # HEAD not allowed, checked with GET at once and later on
+        for _ in range(2):
+            res = await check_url(f'http://127.0.0.1:{port}/nohead/200', probe='head')
+            assert (res.status_code, res.probe) == (200, 'get')
+            assert res.bytes_received and res.response is not None
+
+
+@pytest.mark.asyncio
+async def test_checker_probe_head_fallback(http_server):
+
+    # GET reuses the connection opened by HEAD of the same check
+    with http_server(keep_alive=True) as port:
+        res = await check_url(f'http://127.0.0.1:{port}/nohead/200', probe='head')
+
+    assert (res.status_code, res.probe, res.reused) == (200, 'get', False)
+    assert res.tcp is not None and res.connection is not None
+
+
+@pytest.mark.asyncio
+async def test_checker_probe_range(http_server):
+    initialize_client(range_bytes=100)
+    try:
+        with http_server() as port:
+            res = await check_url(f'http://127.0.0.1:{port}/status/200', '</html>',
+                                  probe='range')
+    finally:
+        await close_client()
+        # module settings are kept by close_client()
+        initialize_client()
+        await close_client()
+
+    # test server ignores Range, the body is read up to range size anyway
+    assert (res.status_code, res.probe, res.truncated) == (200, 'range', True)
+    assert res.content_check is False
+
+
+@pytest.mark.asyncio
+async def test_checker_probe_conditional(http_server):
+
+    with http_server() as port:
+        url = f'http://127.0.0.1:{port}/status/200'
+        res = await check_url(url, 'Request', probe='conditional')
+        assert (res.status_code, res.content_check) == (200, True)
+        assert res.bytes_received
+
+        # not modified, previous content check is reused
+        res = await check_url(url, 'Request', probe='conditional')
+        assert (res.status_code, res.content_check, res.bytes_received) == (304, True, 0)
+
+        # validators are not sent for another regex
+        res = await check_url(url, 'no match', probe='conditional')
+        assert (res.status_code, res.content_check) == (200, False)
+
+
+@pytest.mark.asyncio
+async def test_checker_tls_context(http_server):
+    # contexts are shared by clients and connections
+    assert ssl_context() is ssl_context()
+    assert ssl_context(False) is not ssl_context()
+
+    with http_server() as port:
+        res = await check_url(f'http://127.0.0.1:{port}/status/200')
+        assert (res.tls, res.tls_resumed, res.cert_expires) == (None, None, None)
+
+
+@pytest.mark.asyncio
+async def test_checker_tls_resumption(http_server):
+    initialize_tls(True)
+    try:
+        # shared contexts are restored, so the test certificate is trusted by this test only
+        with patch.dict('lib.network._ssl_contexts', clear=True):
+            # certificate is verified, so its expiration is reported
+            ssl_context().load_verify_locations(CERT_FILE)
+            with http_server(tls=True) as port:
+                url = f'https://127.0.0.1:{port}/status/200'
+                first = await check_url(url)
+                second = await check_url(url)
+    finally:
+        initialize_tls(False)
+
+    assert (first.status_code, second.status_code) == (200, 200)
+    assert first.tls is not None and second.tls is not None
+    # the session of the first connection is offered by the second one
+    assert (first.tls_resumed, second.tls_resumed) == (False, True)
+    assert first.cert_expires and first.cert_expires > 4102444800  # after 2100
@@ -0,0 +1,59 @@
+# pylint:disable=C0114,C0115,C0116
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+from lib.compact import compact_check_log
+from lib.db import get_pool
+
+
+@pytest.mark.asyncio(scope='module')
+async def test_compact_check_log(test_database):
+    script = (Path(__file__).parent.parent / 'db/structure.sql').read_text()
+    start = datetime(2024, 1, 1)
+    async with get_pool().acquire() as conn:
+        await conn.execute('CREATE SCHEMA compact_test; SET search_path = compact_test')
+        try:
+            # legacy layout, without columns added later
+            await conn.execute(
+                'CREATE TABLE check_log (wl_id int, "start" timestamp not null, "end" timestamp, '
+                'dns int, "connect" int, ttfb int, response int, status_code int, '
+                'content_check boolean, error_message varchar, '
+                'constraint pk_check_log primary key (wl_id, "start")) '
+                'partition by range ("start"); '
+                'CREATE TABLE check_log_p202401 PARTITION OF check_log '
+                "FOR VALUES FROM ('2024-01-01') TO ('2024-02-01'); "
+                'CREATE TABLE check_log_default PARTITION OF check_log DEFAULT'
+            )
+            await conn.executemany(
+                'INSERT INTO check_log (wl_id, "start", "end", "connect", status_code, '
+                'error_message) VALUES ($1, $2, $3, $4, $5, $6)',
+                [
+                    (1, start, start + timedelta(seconds=0.25), 40000, 200, None),
+                    (1, start + timedelta(seconds=1), start + timedelta(seconds=6), None, None,
+                     'timeout'),
+                    # default partition
+                    (1, datetime(2023, 6, 1), datetime(2023, 6, 1, 0, 0, 1), 10, 200, None),
+                ]
+            )
+
+            report = await compact_check_log(conn, script)
+            assert (report.rows, report.errors) == (3, 1)  # type:ignore
+            assert report.table_before and report.table_after  # type:ignore
+
+            data = await conn.fetch('SELECT "end" - "start" AS duration, "connect", '
+                                    'error_message FROM check_log_view ORDER BY "start"')
+            assert [tuple(r) for r in data] == [
+                (timedelta(seconds=1), 10, None),
+                # saturated
+                (timedelta(seconds=0.25), 32767, None),
+                (timedelta(seconds=5), None, 'timeout'),
+            ]
+            assert await conn.fetchval('SELECT count(*) FROM check_log_p202401') == 2
+            assert await conn.fetchval('SELECT count(*) FROM check_log_legacy') == 3
+
+            # converted already
+            assert await compact_check_log(conn, script) is None
+        finally:
+            await conn.execute('RESET search_path; DROP SCHEMA compact_test CASCADE')
@@ -0,0 +1,183 @@
+# pylint:disable=C0114,C0115,C0116
+import asyncio
+from time import time
+from unittest.mock import patch
+import pytest
+
+from lib.checker import CheckResult
+from lib.dispatcher import Dispatcher, OverloadPolicy
+from lib.limiter import AdaptiveLimit, OriginLimiter
+
+
+class ListWriter:
+    def __init__(self):
+        self.results = []
+
+    async def put(self, wl_id, start, end, result):
+        self.results.append((wl_id, start, end, result))
+
+
+@pytest.mark.asyncio
+async def test_dispatcher():
+    running = 0
+    max_running = 0
+
+    async def check_url(*_, **__):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(running, max_running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return CheckResult(status_code=200)
+
+    writer = ListWriter()
+    dispatcher = Dispatcher(writer, 2)  # type:ignore
+    dispatcher.start()
+
+    run_at = time() + 0.1
+    with patch('lib.dispatcher.check_url', check_url):
+        for id in range(5):  # pylint:disable=W0622
+            dispatcher.submit({'id': id, 'url': 'http://localhost/', 'content_rx': None,
+                               'run_at': run_at})
+        # replaces pending check
+        dispatcher.submit({'id': 4, 'url': 'http://localhost/', 'content_rx': None,
+                           'run_at': run_at})
+        assert len(dispatcher) == 5
+
+        await asyncio.sleep(0.5)
+    await dispatcher.close()
+
+    assert sorted(r[0] for r in writer.results) == list(range(5))
+    assert min(r[1] for r in writer.results) >= run_at
+    assert max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_jitter():
+    dispatcher = Dispatcher(None, 1, jitter=10)  # type:ignore
+
+    now = time()
+    for id in range(10):  # pylint:disable=W0622
+        dispatcher.submit({'id': id, 'url': 'http://localhost/', 'run_at': None})
+
+    # never ran records are spread over jitter interval
+    next_time = dispatcher._pending.next_time()  # pylint:disable=W0212
+    assert next_time is not None and now <= next_time <= now + 10
+    assert len(dispatcher._pending.pop_due(now + 10)) == 10  # pylint:disable=W0212
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_rate_resubmit():
+    dispatcher = Dispatcher(None, 1, limiter=OriginLimiter(rate=1))  # type:ignore
+
+    run_at = time() + 10
+    for id in (0, 0, 1):  # pylint:disable=W0622
+        dispatcher.submit({'id': id, 'url': 'http://localhost/', 'run_at': run_at})
+
+    # replacing check keeps the reserved rate slot
+    pending = dispatcher._pending  # pylint:disable=W0212
+    assert [pending.get(id)[0] for id in (0, 1)] == [run_at, run_at + 1]  # type:ignore
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_origin_limit():
+    running: dict[str, int] = {}
+    max_running: dict[str, int] = {}
+
+    async def check_url(url, *_, **__):
+        running[url] = running.get(url, 0) + 1
+        max_running[url] = max(running[url], max_running.get(url, 0))
+        await asyncio.sleep(0.05)
+        running[url] -= 1
+        return CheckResult(status_code=200)
+
+    writer = ListWriter()
+    dispatcher = Dispatcher(writer, 4, limiter=OriginLimiter(concurrency=1))  # type:ignore
+    dispatcher.start()
+
+    with patch('lib.dispatcher.check_url', check_url):
+        for id in range(6):  # pylint:disable=W0622
+            dispatcher.submit({'id': id, 'url': f'http://host{id % 2}.test/', 'content_rx': None,
+                               'run_at': None})
+        await asyncio.sleep(0.02)
+        # running and parked checks are held until their results are queued
+        assert dispatcher.held() == set(range(6))
+        await asyncio.sleep(0.5)
+        assert dispatcher.held() == set()
+    await dispatcher.close()
+
+    assert len(writer.results) == 6
+    assert max_running == {'http://host0.test/': 1, 'http://host1.test/': 1}
+    assert dispatcher.limiter.stats()['http://host0.test:80'].checks == 3
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_adaptive_limit():
+    running = 0
+    max_running = 0
+
+    async def check_url(*_, **__):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(running, max_running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return CheckResult(status_code=200)
+
+    writer = ListWriter()
+    adaptive = AdaptiveLimit(2, 4)
+    dispatcher = Dispatcher(writer, 4, adaptive=adaptive)  # type:ignore
+    dispatcher.start()
+
+    with patch('lib.dispatcher.check_url', check_url):
+        for id in range(8):  # pylint:disable=W0622
+            dispatcher.submit({'id': id, 'url': f'http://host{id}.test/', 'content_rx': None,
+                               'run_at': None})
+        await asyncio.sleep(0.02)
+        assert adaptive.update(0.0, 0.0) == 'saturated'
+        await asyncio.sleep(0.3)
+    await dispatcher.close()
+
+    assert len(writer.results) == 8
+    assert max_running == 4
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_overload():
+    async def check_url(*_, **__):
+        await asyncio.sleep(0.1)
+        return CheckResult(status_code=200)
+
+    writer = ListWriter()
+    skips = []
+    dispatcher = Dispatcher(writer, 1,  # type:ignore
+                            overload=OverloadPolicy(shed_priority=0, backlog=4, lag=0),
+                            on_skip=lambda *skip: skips.append(skip))
+    dispatcher.start()
+
+    def submit(id, interval, priority):  # pylint:disable=W0622
+        dispatcher.submit({'id': id, 'url': f'http://host{id}.test/', 'content_rx': None,
+                           'run_at': None, 'interval': interval, 'priority': priority})
+
+    with patch('lib.dispatcher.check_url', check_url):
+        # busy worker
+        submit(0, 60, 0)
+        await asyncio.sleep(0.02)
+        submit(1, 60, 0)
+        submit(2, 1, 0)
+        submit(3, 60, 1)
+        submit(4, 60, -1)
+        await asyncio.sleep(0.02)
+        # merged into the run waiting for a worker
+        submit(1, 60, 0)
+        await asyncio.sleep(0.02)
+        assert len(dispatcher) == 4
+
+        await asyncio.sleep(0.5)
+    await dispatcher.close()
+
+    # higher priority first, then more overdue relative to interval, low priority is shed
+    assert [r[0] for r in writer.results] == [0, 3, 2, 1]
+    assert [(id, runs, reason) for id, _, runs, reason in skips] == [
+        (1, 1, 'coalesced'), (4, 1, 'shed')
+    ]
@@ -0,0 +1,77 @@
+# pylint:disable=C0114,C0115,C0116
+import json
+from datetime import datetime
+from io import BytesIO
+
+import pytest
+
+from lib.db import get_pool
+from lib.export import CountingOutput, export_csv, export_jsonl, export_query
+
+
+def test_export_query():
+    query, args = export_query()
+    assert 'WHERE' not in query
+    assert args == []
+
+    query, args = export_query([1, 2], datetime(2024, 1, 1), None, True)
+    assert 'wl_id = any($1::int[])' in query
+    assert '"start" >= $2' in query
+    assert 'content_check IS false' in query
+    assert args == [[1, 2], datetime(2024, 1, 1)]
+    # runs are selected by their time range
+    assert 'last_start >= $2' in query
+
+    query, _ = export_query(until=datetime(2024, 1, 1), runs='summarize')
+    assert 'first_start < $1' in query
+    assert query.endswith('ORDER BY wl_id, first_start')
+
+
+@pytest.mark.asyncio(scope='module')
+async def test_export(test_database):
+    async with get_pool().acquire() as conn:
+        error_id = await conn.fetchval(
+            "INSERT INTO check_error (message) VALUES ('timeout') RETURNING id"
+        )
+        await conn.executemany(
+            'INSERT INTO check_log (wl_id, "start", duration, status_code, error_id) '
+            'VALUES ($1, $2, $3, $4, $5)',
+            [
+                (1, datetime(2024, 1, 1, 0, 0, 1), 500, 200, None),
+                (1, datetime(2024, 1, 1, 0, 0, 2), 5000, None, error_id),
+                (2, datetime(2024, 1, 1, 0, 0, 1), 20, 503, None),
+            ]
+        )
+
+        output = CountingOutput(BytesIO())
+        assert await export_csv(conn, output, *export_query([1])) == 2  # type:ignore
+        lines = output.output.getvalue().splitlines()  # type:ignore
+        assert len(lines) == 3
+        assert lines[0].startswith(b'wl_id,start,end,')
+        assert output.size == len(output.output.getvalue())  # type:ignore
+
+        output = BytesIO()
+        assert await export_jsonl(conn, output, *export_query(failures=True)) == 2
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert [(r['wl_id'], r['error_message']) for r in rows] == [(1, 'timeout'), (2, None)]
+        assert rows[0]['start'] == '2024-01-01T00:00:02'
+        assert rows[0]['end'] == '2024-01-01T00:00:07'
+
+        await conn.execute(
+            'INSERT INTO check_run (wl_id, first_start, last_start, checks, status_code, timed, '
+            'connect_sum, ttfb_sum, response_sum) VALUES (3, $1, $2, 3, 200, 3, 3, 6, 30)',
+            datetime(2024, 1, 1), datetime(2024, 1, 1, 0, 0, 10)
+        )
+        output = BytesIO()
+        assert await export_jsonl(conn, output, *export_query([3])) == 3
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        # expanded checks are spread over the run
+        assert [r['start'][-2:] for r in rows] == ['00', '05', '10']
+        assert (rows[0]['ttfb'], rows[0]['response'], rows[0]['dns']) == (2, 10, None)
+
+        output = BytesIO()
+        assert await export_jsonl(conn, output, *export_query(runs='summarize')) == 4
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert [(r['wl_id'], r['checks']) for r in rows] == [(1, 1), (1, 1), (2, 1), (3, 3)]
+
+        await conn.execute('TRUNCATE check_log, check_run')
@@ -0,0 +1,52 @@
+# pylint:disable=C0114,C0115,C0116
+import pytest
+
+from lib.db import get_pool
+from lib.importer import ImportSummary, apply_import
+
+
+pytestmark = pytest.mark.asyncio(scope="module")
+
+
+async def test_import_sync(test_database):
+    async with get_pool().acquire() as conn:
+        summary = await apply_import(conn, ['url', 'interval', 'content_rx'], [
+            ('https://httpbin.org/status/200', 1, None),  # unchanged
+            ('https://httpbin.org/status/201', 5, 'ok'),
+            ('https://example.com/', 10, None),
+        ])
+        assert summary == ImportSummary(inserted=1, updated=1)
+
+        summary = await apply_import(conn, ['url', 'interval'], [
+            ('https://httpbin.org/status/201', 5),
+            ('https://example.org/', 10),
+        ], sync=True)
+        # status/200, status/202 and example.com are disabled
+        assert summary == ImportSummary(inserted=1, updated=0, disabled=3)
+
+        data = await conn.fetch('SELECT url, enable, content_rx FROM watchlist ORDER BY id')
+        assert [tuple(r.values()) for r in data] == [
+            ('https://httpbin.org/status/200', False, None),
+            ('https://httpbin.org/status/201', True, 'ok'),
+            ('https://httpbin.org/status/202', False, None),
+            ('https://example.com/', False, None),
+            ('https://example.org/', True, None),
+        ]
+
+
+async def test_import_ambiguous(test_database):
+    async with get_pool().acquire() as conn:
+        await conn.execute(
+            "INSERT INTO watchlist (url, interval, content_rx) VALUES "
+            "('https://example.net/', 10, 'a'), ('https://example.net/', 10, 'b')"
+        )
+        summary = await apply_import(conn, ['url', 'interval'], [
+            ('https://example.net/', 20),
+        ], sync=True)
+        assert summary.ambiguous == ['https://example.net/']
+        assert summary.updated == summary.inserted == 0
+
+        data = await conn.fetch(
+            "SELECT interval, enable FROM watchlist WHERE url = 'https://example.net/'"
+        )
+        assert [tuple(r.values()) for r in data] == [(10, True), (10, True)]
@@ -0,0 +1,82 @@
+# pylint:disable=C0114,C0115,C0116
+from lib.limiter import AdaptiveLimit, OriginLimiter
+
+
+def test_limiter_concurrency():
+    limiter = OriginLimiter(concurrency=2)
+
+    assert limiter.acquire('a', 1)
+    assert limiter.acquire('a', 2)
+    assert not limiter.acquire('a', 3)
+    assert not limiter.acquire('a', 4)
+    # other origin is not affected, override
+    assert limiter.acquire('b', 5, limit=1)
+    assert not limiter.acquire('b', 6, limit=1)
+
+    assert limiter.backlog() == [('a', 2, 0.0), ('b', 1, 0.0)]
+
+    # parked jobs take released slots in order
+    assert limiter.release('a') == 3
+    assert limiter.release('a') == 4
+    assert limiter.release('a') is None
+    assert limiter.release('a') is None
+    assert limiter.stats()['a'].active == 0
+
+    # parked job of the same id is replaced in place
+    assert limiter.acquire('c', 7, limit=1, job_id='x')
+    assert not limiter.acquire('c', 8, limit=1, job_id='y')
+    assert not limiter.acquire('c', 9, limit=1, job_id='z')
+    assert not limiter.acquire('c', 10, limit=1, job_id='y')
+    assert len(limiter.stats()['c'].parked) == 2
+    assert limiter.release('c') == 10
+    assert limiter.release('c') == 9
+
+
+def test_limiter_rate():
+    limiter = OriginLimiter(rate=2)
+
+    assert [limiter.reserve('a', 10.0) for _ in range(3)] == [10.0, 10.5, 11.0]
+    assert limiter.reserve('a', 20.0) == 20.0
+    assert limiter.reserve('b', 10.0) == 10.0
+
+
+def test_adaptive_limit():
+    limit = AdaptiveLimit(2, 20, step=3, backoff=0.5, latency_tolerance=2.0)
+
+    def run(checks, latency):
+        for _ in range(checks):
+            limit.started()
+        for _ in range(checks):
+            limit.finished(latency)
+
+    # not saturated
+    run(1, 0.1)
+    assert limit.update(0.0, 0.0) is None
+    assert limit.limit == 2
+
+    # slow start
+    run(2, 0.1)
+    assert limit.update(0.0, 0.0) == 'saturated'
+    assert limit.limit == 4
+    run(4, 0.1)
+    assert limit.update(0.0, 0.0) == 'saturated'
+    assert limit.limit == 8
+
+    run(8, 0.1)
+    assert limit.update(0.1, 0.0) == 'loop_lag'
+    assert limit.limit == 4
+    # additive increase after the first cut
+    run(4, 0.1)
+    assert limit.update(0.0, 0.0) == 'saturated'
+    assert limit.limit == 7
+
+    run(7, 0.1)
+    assert limit.update(0.0, 0.1) == 'pool_wait'
+    assert limit.limit == 3
+    run(3, 0.5)
+    assert limit.update(0.0, 0.0) == 'latency'
+    assert limit.limit == 2
+    # not below floor
+    run(2, 0.1)
+    assert limit.update(1.0, 0.0) is None
+    assert limit.limit == 2
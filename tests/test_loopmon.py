@@ -0,0 +1,37 @@
+# pylint:disable=C0114,C0115,C0116
+import asyncio
+import time
+import pytest
+
+from lib.loopmon import LoopMonitor, new_event_loop
+from lib.metrics import counter
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor():
+    slow = counter('event_loop_slow_callbacks_total', 'Callbacks holding the loop over threshold',
+                   ('callback',))
+
+    async def blocking():
+        time.sleep(0.2)
+
+    monitor = LoopMonitor(asyncio.get_running_loop(), interval=0.01, slow_callback=0.05)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        assert monitor.take_max_lag() < 0.05
+
+        await asyncio.create_task(blocking())
+        await asyncio.sleep(0.05)
+        assert monitor.take_max_lag() >= 0.15
+        assert slow.labels('test_loop_monitor.<locals>.blocking').value == 1
+    finally:
+        monitor.stop()
+
+
+def test_new_event_loop():
+    loop = new_event_loop()
+    try:
+        assert loop.run_until_complete(asyncio.sleep(0, 'ok')) == 'ok'
+    finally:
+        loop.close()
@@ -0,0 +1,62 @@
+# pylint:disable=C0114,C0115,C0116
+import re
+from unittest.mock import patch
+import pytest
+
+from lib.matcher import QUARANTINE_MESSAGE, Matcher, SearchError
+
+# catastrophic backtracking
+_SLOW = re.compile('(a+)+$')
+_SLOW_TEXT = 'a' * 40 + 'b'
+
+
+@pytest.mark.asyncio
+async def test_matcher_inline():
+    matcher = Matcher(workers=0, slow_search=10.0)
+
+    assert await matcher.search(re.compile('b+'), 'aabbc') == (2, 4)
+    assert await matcher.search(re.compile('b+'), 'aabbc', 4) is None
+    stats = dict(matcher.top(1))['b+']
+    assert stats.searches == 2 and not stats.slow
+
+
+@pytest.mark.asyncio
+async def test_matcher_budget():
+    matcher = Matcher(workers=1, offload_chars=1000, budget=0.2, quarantine_after=2)
+    matcher.start()
+    try:
+        # the first search is run by worker, the next one of small text in the loop
+        for _ in range(2):
+            assert await matcher.search(re.compile('b+'), 'aabbc') == (2, 4)
+        # large text is searched by worker
+        assert await matcher.search(re.compile('b+$'), 'a' * 2000 + 'b') == (2000, 2001)
+
+        for _ in range(2):
+            with pytest.raises(SearchError, match='budget'):
+                await matcher.search(_SLOW, _SLOW_TEXT * 30)
+        assert matcher.quarantined(_SLOW.pattern)
+        with pytest.raises(SearchError, match=QUARANTINE_MESSAGE):
+            await matcher.search(_SLOW, 'a')
+
+        # worker survived interrupted searches
+        assert await matcher.search(re.compile('b+$'), 'a' * 2000 + 'b') == (2000, 2001)
+        stats = dict(matcher.top(3))[_SLOW.pattern]
+        assert (stats.searches, stats.overruns, stats.slow) == (2, 2, True)
+    finally:
+        await matcher.close()
+
+
+@pytest.mark.asyncio
+async def test_matcher_kill():
+    matcher = Matcher(workers=1, offload_chars=0, budget=0.5)
+    matcher.start()
+    try:
+        # worker doesn't respond in time
+        with patch('lib.matcher.KILL_GRACE', -0.4):
+            with pytest.raises(SearchError, match='budget'):
+                await matcher.search(_SLOW, _SLOW_TEXT)
+
+        # replaced by a new one
+        assert await matcher.search(re.compile('b+'), 'aabbc') == (2, 4)
+    finally:
+        await matcher.close()
@@ -0,0 +1,54 @@
+# pylint:disable=C0114,C0115,C0116
+import asyncio
+
+import pytest
+
+from lib.metrics import Counter, Gauge, Histogram, Registry, counter, start_server
+
+
+def test_metrics_render():
+    registry = Registry()
+    checks = registry.register(Counter('checks_total', 'Checks', ('outcome',)))
+    checks.labels('ok').inc()
+    checks.labels('ok').inc(2)
+    checks.labels('say "hi"').inc()
+    depth = registry.register(Gauge('depth', 'Depth'))
+    depth.set_function(lambda: 42)
+    latency = registry.register(Histogram('latency_seconds', 'Latency', buckets=(0.1, 1)))
+    for value in (0.05, 0.1, 0.5, 5):
+        latency.observe(value)
+
+    # same name returns registered metric
+    assert registry.register(Counter('checks_total', 'Checks', ('outcome',))) is checks
+
+    lines = registry.render().splitlines()
+    assert '# TYPE checks_total counter' in lines
+    assert 'checks_total{outcome="ok"} 3.0' in lines
+    assert 'checks_total{outcome="say \\"hi\\""} 1.0' in lines
+    assert 'depth 42' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{le="1"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'latency_seconds_count 4' in lines
+
+
+@pytest.mark.asyncio
+async def test_metrics_server():
+    counter('test_requests_total', 'Test').inc()
+    server = await start_server('127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def get(path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+        response = await reader.read()
+        writer.close()
+        return response
+
+    response = await get('/metrics')
+    assert response.startswith(b'HTTP/1.1 200 OK')
+    assert b'\ntest_requests_total 1.0\n' in response
+    assert (await get('/')).startswith(b'HTTP/1.1 404')
+
+    server.close()
+    await server.wait_closed()
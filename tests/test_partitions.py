@@ -0,0 +1,50 @@
+# pylint:disable=C0114,C0115,C0116
+from datetime import date
+
+import pytest
+
+from lib.db import get_pool
+from lib.partitions import (
+    add_months, current_month, maintain_partitions, partition_month, partition_name
+)
+
+
+def test_months():
+    assert add_months(date(2024, 11, 1), 1) == date(2024, 12, 1)
+    assert add_months(date(2024, 11, 1), 2) == date(2025, 1, 1)
+    assert add_months(date(2024, 1, 1), -13) == date(2022, 12, 1)
+
+    assert partition_name(date(2024, 2, 1)) == 'check_log_p202402'
+    assert partition_month('check_log_p202402') == date(2024, 2, 1)
+    assert partition_month('check_log_default') is None
+
+
+@pytest.mark.asyncio(scope='module')
+async def test_maintain_partitions(test_database):
+    month = current_month()
+    old = partition_name(add_months(month, -3))
+
+    async with get_pool().acquire() as conn:
+        await conn.execute(
+            f'CREATE TABLE {old} PARTITION OF check_log '
+            f"FOR VALUES FROM ('{add_months(month, -3)}') TO ('{add_months(month, -2)}')"
+        )
+
+        created, removed = await maintain_partitions(conn, premake=1, retention=2, brin=True)
+        assert created == [partition_name(month), partition_name(add_months(month, 1))]
+        assert removed == [old]
+
+        # nothing to do
+        assert await maintain_partitions(conn, premake=1, retention=2) == ([], [])
+
+
+@pytest.mark.asyncio(scope='module')
+async def test_maintain_not_partitioned(test_database):
+    async with get_pool().acquire() as conn:
+        await conn.execute('CREATE SCHEMA partitions_test; SET search_path = partitions_test; '
+                           'CREATE TABLE check_log ("start" timestamp)')
+        try:
+            # skipped until converted by cli.py compact
+            assert await maintain_partitions(conn, premake=1, retention=1) == ([], [])
+        finally:
+            await conn.execute('RESET search_path; DROP SCHEMA partitions_test CASCADE')
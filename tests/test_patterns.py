@@ -0,0 +1,31 @@
+# pylint:disable=C0114,C0115,C0116
+import re
+import pytest
+
+from lib.patterns import PatternCache
+
+
+def test_pattern_cache():
+    cache = PatternCache(max_size=2)
+
+    first = cache.compile('a+')
+    assert cache.compile('a+') is first
+    assert first.flags & re.DOTALL
+
+    cache.compile('b+')
+    cache.compile('a+')
+    # least recently used 'b+' is evicted
+    cache.compile('c+')
+    assert cache.stats() == (2, 2, 3)
+
+    cache.compile('b+')
+    assert cache.stats() == (2, 2, 4)
+
+
+def test_pattern_cache_invalid():
+    cache = PatternCache()
+
+    with pytest.raises(re.error):
+        cache.compile('[bad regex')
+
+    assert cache.stats().size == 0
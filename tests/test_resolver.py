@@ -0,0 +1,58 @@
+# pylint:disable=C0114,C0115,C0116
+import asyncio
+import socket
+from unittest.mock import patch
+import httpcore
+import pytest
+
+from lib.network import ResolvingBackend
+from lib.resolver import Resolver
+
+
+@pytest.mark.asyncio
+async def test_resolver_cache():
+    calls = 0
+
+    async def getaddrinfo(host, port, **_):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        if host == 'bad.test':
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', port)),
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', port)),
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.2', port))]
+
+    resolver = Resolver()
+    loop = asyncio.get_running_loop()
+    with patch.object(loop, 'getaddrinfo', getaddrinfo):
+        # concurrent lookups are coalesced
+        res = await asyncio.gather(*(resolver.resolve('good.test', 80) for _ in range(5)))
+        assert res == [['10.0.0.1', '10.0.0.2']] * 5
+        assert calls == 1
+
+        # cached
+        assert await resolver.resolve('good.test', 80) == ['10.0.0.1', '10.0.0.2']
+        assert calls == 1
+
+        # negative cache
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                await resolver.resolve('bad.test', 80)
+        assert calls == 2
+
+        # addresses are not resolved
+        assert await resolver.resolve('127.0.0.1', 80) == ['127.0.0.1']
+        assert calls == 2
+
+    assert (resolver.hits, resolver.misses) == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_resolving_backend_no_addresses():
+    async def resolve(*_):
+        return []
+
+    with patch('lib.resolver.Resolver.resolve', resolve):
+        with pytest.raises(httpcore.ConnectError, match='No addresses for empty.test'):
+            await ResolvingBackend().connect_tcp('empty.test', 80)
@@ -0,0 +1,41 @@
+# pylint:disable=C0114,C0115,C0116
+from datetime import datetime
+
+from lib.rollup import Rollup, bucket_start, upsert_query
+
+
+def test_rollup():
+    rollup = Rollup()
+    for response in range(1, 101):
+        rollup.add(200, True, None, 1, response // 2, response)
+    rollup.add(500, None, None, 2, 5, 300)
+    rollup.add(200, False, None, 0, 1, 2)
+    rollup.add(None, None, 'timeout', None, None, None)
+
+    assert (rollup.checks, rollup.failures, rollup.content_failures, rollup.timed) \
+        == (103, 2, 1, 102)
+    assert (rollup.connect_min, rollup.connect_max) == (0, 2)
+    assert (rollup.response_min, rollup.response_max) == (1, 300)
+    assert rollup.response_sum == 5050 + 302
+    assert sum(rollup.histogram) == 102
+
+    assert 45 <= rollup.percentile(0.5) <= 55  # type:ignore
+    assert rollup.percentile(1) == 300
+
+    other = Rollup()
+    other.add(200, None, None, 10, 20, 20000)
+    rollup.merge(other)
+    assert (rollup.checks, rollup.connect_max, rollup.response_max) == (104, 10, 20000)
+    assert rollup.histogram[-1] == 1
+    assert Rollup().percentile(0.5) is None
+
+
+def test_rollup_helpers():
+    ts = datetime(2024, 5, 6, 7, 8, 9, 10)
+    assert bucket_start(ts, 'minute') == datetime(2024, 5, 6, 7, 8)
+    assert bucket_start(ts, 'hour') == datetime(2024, 5, 6, 7)
+
+    query = upsert_query('check_stat_hour')
+    assert 'histogram = hist_add(t.histogram, excluded.histogram)' in query
+    assert 'response_min = least(t.response_min, excluded.response_min)' in query
+    assert '$16)' in query
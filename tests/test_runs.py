@@ -0,0 +1,52 @@
+# pylint:disable=C0114,C0115,C0116
+from datetime import datetime, timedelta
+
+from lib.runs import RUN_COLUMNS, UPDATE_RUN_QUERY, Run, split_runs
+
+
+def _record(wl_id, second, status_code=200, error_message=None, response=10):
+    start = datetime(2024, 1, 1) + timedelta(seconds=second)
+    return (wl_id, start, start + timedelta(milliseconds=response or 0), None, 1, 5, response,
+            status_code, None, error_message)
+
+
+def test_split_runs():
+    records = [_record(1, i) for i in range(5)] + [
+        _record(1, 5, None, 'timeout', None),
+        _record(1, 6, None, 'timeout', None),
+        _record(1, 7, response=30),
+        # another record, out of order
+        _record(2, 1),
+        _record(2, 0),
+    ]
+    runs = split_runs(records, max_duration=3600)
+
+    assert [(r.wl_id, r.checks, r.timed, r.first_start.second, r.last_start.second)
+            for r in runs] == [(1, 5, 5, 0, 4), (1, 2, 0, 5, 6), (1, 1, 1, 7, 7), (2, 2, 2, 0, 1)]
+    assert runs[1].outcome() == (None, None, 'timeout')
+    assert (runs[0].response_min, runs[0].response_max, runs[0].response_sum) == (10, 10, 50)
+    assert runs[0].last_end == runs[0].last_start + timedelta(milliseconds=10)
+    assert len(runs[0].values()) == len(RUN_COLUMNS)
+
+    # runs are split by duration
+    assert [r.checks for r in split_runs(records[:5], max_duration=2)] == [2, 2, 1]
+
+
+def test_run_extend():
+    stored, = split_runs([_record(1, i) for i in range(3)], 3600)
+    new, other = split_runs([_record(1, 3, response=20), _record(1, 4, 500)], 3600)
+
+    assert new.follows(stored, 3600)
+    assert not new.follows(stored, 3)
+    assert not other.follows(stored, 3600)
+    # not later than the stored run
+    assert not stored.follows(stored, 3600)
+
+    stored.extend(new)
+    assert (stored.checks, stored.timed, stored.first_start.second, stored.last_start.second) \
+        == (4, 4, 0, 3)
+    assert (stored.response_max, stored.response_sum) == (20, 50)
+
+    assert Run(1, stored.first_start, stored.last_start).values()[:3] == stored.values()[:3]
+    assert UPDATE_RUN_QUERY.endswith('WHERE wl_id = $1 AND first_start = $2')
+    assert 'last_start = $3' in UPDATE_RUN_QUERY
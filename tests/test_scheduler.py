@@ -1,5 +1,6 @@
 # pylint:disable=C0114,C0115,C0116
 import asyncio
+from collections import Counter
 from unittest.mock import patch
 import pytest
 
@@ -23,7 +24,7 @@ async def test_clean_db(test_database):
 
 
 async def test_scheduler(test_database):
-    with patch('lib.checker.check_url', return_value=CheckResult(status_code=200)) as p:
+    with patch('lib.dispatcher.check_url', return_value=CheckResult(status_code=200)):
         scheduler = asyncio.create_task(main_loop({'interval': 1, 'max_concurrency': 3}))
 
         with pytest.raises(TimeoutError):
@@ -40,3 +41,89 @@ async def test_scheduler(test_database):
             expect = 5 // item['interval']
             assert item['cnt'] >= expect, \
                 f"{item['url']} executed only {item['cnt']}/{expect} times"
+
+
+async def test_scheduler_failed_flush(test_database):
+    checks: Counter = Counter()
+
+    async def check_url(url, *_, **__):
+        checks[url] += 1
+        return CheckResult(status_code=200)
+
+    async with get_pool().acquire() as conn:
+        await conn.execute('UPDATE watchlist SET last_start = NULL')
+
+    # results are never saved, so runs are dispatched again after their interval
+    with patch('lib.dispatcher.check_url', check_url), \
+            patch('lib.writer.save_results', side_effect=RuntimeError('DB is down')):
+        scheduler = asyncio.create_task(
+            main_loop({'interval': 1, 'max_concurrency': 3, 'redispatch_timeout': 0})
+        )
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(scheduler, 5)
+
+    assert len(checks) == 3
+    assert min(checks.values()) >= 2
+
+
+async def test_scheduler_timer(test_database):
+    with patch('lib.dispatcher.check_url', return_value=CheckResult(status_code=200)):
+        scheduler = asyncio.create_task(
+            main_loop({'interval': 1, 'max_concurrency': 3, 'mode': 'timer'})
+        )
+        await asyncio.sleep(1)
+
+        # picked up from notification
+        async with get_pool().acquire() as conn:
+            new_id = await conn.fetchval(
+                'INSERT INTO watchlist (url, interval) VALUES ($1, $2) RETURNING id',
+                'https://httpbin.org/status/203', 1
+            )
+
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(scheduler, 3)
+
+    async with get_pool().acquire() as conn:
+        cnt = await conn.fetchval('select count(*) from check_log where wl_id = $1', new_id)
+
+    assert cnt >= 2
+
+
+async def test_scheduler_lease(test_database):
+    running: Counter = Counter()
+    overlaps: Counter = Counter()
+
+    async def check_url(url, *_, **__):
+        # longer than lease_time, so the lease is kept by renewals only
+        running[url] += 1
+        if running[url] > 1:
+            overlaps[url] += 1
+        await asyncio.sleep(3)
+        running[url] -= 1
+        return CheckResult(status_code=200)
+
+    async with get_pool().acquire() as conn:
+        await conn.execute('UPDATE watchlist SET last_start = NULL')
+        since = await conn.fetchval('select localtimestamp')
+
+    # two instances share the watchlist
+    config = {'interval': 1, 'max_concurrency': 3, 'mode': 'lease', 'lease_time': 2}
+    with patch('lib.dispatcher.check_url', check_url):
+        schedulers = asyncio.gather(main_loop(dict(config)), main_loop(dict(config)))
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(schedulers, 8)
+
+    async with get_pool().acquire() as conn:
+        doubled = await conn.fetch('select wl_id, date_trunc(\'second\', "start") s '
+                                   'from check_log where "start" >= $1 '
+                                   'group by 1, 2 having count(*) > 1', since)
+        checked = await conn.fetchval('select count(*) from check_log where "start" >= $1',
+                                      since)
+        leased = await conn.fetchval('select count(*) from watchlist where lease_owner is not null')
+
+    assert checked >= 3
+    # no record is checked by both instances
+    assert not overlaps
+    assert not doubled
+    # all leases are released by writers on exit
+    assert leased == 0
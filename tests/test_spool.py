@@ -0,0 +1,158 @@
+# pylint:disable=C0114,C0115,C0116
+import asyncio
+import json
+from unittest.mock import patch
+import asyncpg
+import pytest
+
+from lib.checker import CheckResult
+from lib.spool import Spool, SpoolWriter
+
+
+def test_spool_segments(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.open()
+
+    assert not spool.write(b'[1]\n[2]\n', 2, max_size=100, max_age=60)
+    assert spool.write(b'[3]\n', 1, max_size=10, max_age=60)
+    assert spool.write(b'[4]\n', 1, max_size=100, max_age=0)
+    assert len(spool.sealed) == 2
+    assert (spool.size, spool.records) == (16, 4)
+    assert spool.read(spool.sealed[0]) == [[1], [2], [3]]
+
+    spool.remove(spool.sealed[0])
+    assert (spool.size, spool.records) == (4, 1)
+    spool.close()
+
+
+def test_spool_recovery(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.open()
+    spool.write(b'[1]\n[2', 1, max_size=100, max_age=60)
+
+    # directory is locked until closed
+    with pytest.raises(RuntimeError):
+        Spool(str(tmp_path)).open()
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    spool.open()
+    segment = spool.sealed[0]
+    assert segment.recovered
+    # torn record is skipped
+    assert spool.read(segment) == [[1]]
+
+    # new segments follow recovered ones
+    spool.write(b'[3]\n', 1, max_size=100, max_age=0)
+    assert [s.path.name for s in spool.sealed] == [f'{i:016d}.seg' for i in range(2)]
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_writer(tmp_path):
+    saved = []
+    failures = 2
+
+    async def save_results(batch, rollups, replay, runs):
+        nonlocal failures
+        if failures:
+            failures -= 1
+            raise ConnectionError('DB is down')
+        saved.append((len(batch), replay))
+
+    writer = SpoolWriter(str(tmp_path), segment_age=0.05, sync_interval=0.01, batch_size=3)
+    with patch('lib.spool.save_results', save_results), patch('lib.spool.RETRY_DELAY', 0.01):
+        writer.start()
+        for i in range(5):
+            await writer.put(1, i, i + 0.5, CheckResult(status_code=200))
+
+        await asyncio.sleep(0.3)
+        await writer.close()
+
+    # failed batch is retried skipping already saved records
+    assert saved == [(3, True), (2, False)]
+    assert writer.spool.records == 0
+    assert not list(tmp_path.glob('*.seg'))
+
+
+@pytest.mark.asyncio
+async def test_spool_writer_full(tmp_path):
+    writer = SpoolWriter(str(tmp_path), max_bytes=100, sync_interval=0.01)
+
+    async def save_results(*_):
+        raise ConnectionError('DB is down')
+
+    with patch('lib.spool.save_results', save_results):
+        writer.start()
+        put = asyncio.create_task(asyncio.wait_for(
+            asyncio.gather(*[writer.put(1, i, i, CheckResult()) for i in range(10)]), 0.3
+        ))
+        with pytest.raises(TimeoutError):
+            await put
+        await writer.close()
+
+    # accepted results are kept for the next run
+    spool = Spool(str(tmp_path))
+    spool.open()
+    assert 0 < spool.records < 10
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_writer_bad_rows(tmp_path):
+    saved = []
+
+    async def save_results(batch, rollups, replay, runs):
+        if any(record[0] == 2 for record in batch):
+            raise asyncpg.DataError('value out of range')
+        saved.extend(record[0] for record in batch)
+
+    writer = SpoolWriter(str(tmp_path), segment_age=0.05, sync_interval=0.01, batch_size=4)
+    with patch('lib.spool.save_results', save_results):
+        writer.start()
+        for i in range(6):
+            await writer.put(i, i, i + 0.5, CheckResult(status_code=200))
+
+        await asyncio.sleep(0.3)
+        await writer.close()
+
+    # rejected row is isolated, others are saved
+    assert sorted(saved) == [0, 1, 3, 4, 5]
+    assert writer.spool.records == 0
+
+
+@pytest.mark.asyncio
+async def test_spool_writer_poisoned(tmp_path):
+    async def save_results(*_):
+        raise ValueError('a bug')
+
+    writer = SpoolWriter(str(tmp_path), segment_age=0.05, sync_interval=0.01)
+    with patch('lib.spool.save_results', save_results), patch('lib.spool.RETRY_DELAY', 0.01):
+        writer.start()
+        await writer.put(1, 0, 0.5, CheckResult(status_code=200))
+
+        await asyncio.sleep(0.5)
+        await writer.close()
+
+    # segment is moved aside, so spool isn't blocked
+    assert writer.spool.records == 0
+    assert not list(tmp_path.glob('*.seg'))
+    assert len(list(tmp_path.glob('*.poisoned'))) == 1
+
+
+@pytest.mark.asyncio
+async def test_spool_writer_poisoned_again(tmp_path):
+    async def save_results(*_):
+        raise ValueError('a bug')
+
+    with patch('lib.spool.save_results', save_results), patch('lib.spool.RETRY_DELAY', 0.01):
+        for wl_id in (1, 2):
+            # reopened spool doesn't reuse number of the poisoned segment
+            writer = SpoolWriter(str(tmp_path), segment_age=0.05, sync_interval=0.01)
+            writer.start()
+            await writer.put(wl_id, 0, 0.5, CheckResult(status_code=200))
+            await asyncio.sleep(0.5)
+            await writer.close()
+
+    poisoned = sorted(tmp_path.glob('*.poisoned'))
+    assert [json.loads(path.read_text())[0] for path in poisoned] == [1, 2]
@@ -0,0 +1,25 @@
+# pylint:disable=C0114,C0115,C0116
+from lib.timer import TimerQueue
+
+
+def test_timer_queue():
+    queue = TimerQueue()
+    queue.schedule(1, 10.0, 'a')
+    queue.schedule(2, 5.0, 'b')
+    queue.schedule(3, 7.0, 'c')
+
+    assert len(queue) == 3
+    assert queue.next_time() == 5.0
+
+    # reschedule and remove
+    queue.schedule(2, 20.0, 'b')
+    queue.remove(3)
+    assert len(queue) == 2
+    assert 3 not in queue
+    assert queue.next_time() == 10.0
+
+    assert queue.pop_due(9.0) == []
+    assert queue.pop_due(15.0) == [(1, 10.0, 'a')]
+    assert queue.pop_due(20.0) == [(2, 20.0, 'b')]
+    assert len(queue) == 0
+    assert queue.next_time() is None
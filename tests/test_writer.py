@@ -0,0 +1,113 @@
+# pylint:disable=C0114,C0115,C0116
+from time import time
+from unittest.mock import patch
+import pytest
+
+from lib.checker import CheckResult
+from lib.db import get_pool
+from lib.writer import ResultWriter, result_record, save_results
+
+
+pytestmark = pytest.mark.asyncio(scope="module")
+
+
+async def test_writer_batch(test_database):
+    writer = ResultWriter(queue_size=10, batch_size=4, batch_age=0.1)
+    writer.start()
+
+    start = int(time())
+    for i in range(10):
+        # 3 records in watchlist
+        # certificate is seen by the first check only
+        await writer.put(i % 3 + 1, start + i, start + i + 0.5,
+                         CheckResult(status_code=200, cert_expires=start + 86400 if not i else None))
+
+    await writer.close()
+
+    async with get_pool().acquire() as conn:
+        assert await conn.fetchval('select count(*) from check_log') == 10
+
+        data = await conn.fetch('select id, extract(epoch from last_start)::int ts, '
+                                'extract(epoch from cert_expires)::int cert_expires '
+                                'from watchlist order by id')
+        # latest start wins
+        assert [r['ts'] for r in data] == [start + 9, start + 7, start + 8]
+        # certificate expiration is kept when it's not seen
+        assert [r['cert_expires'] for r in data] == [start + 86400, None, None]
+
+        # every result is accounted once per rollup table
+        for table in ('check_stat_minute', 'check_stat_hour'):
+            assert await conn.fetchval(f'select sum(checks) from {table}') == 10
+
+
+async def test_save_replay(test_database):
+    # a day ago, apart from other tests records
+    start = int(time()) - 86400
+    records = [result_record(1, start, start + 0.5, CheckResult(status_code=200))]
+    await save_results(records)
+    # saved again along with a record of deleted watchlist item
+    await save_results(records + [result_record(1000, start, start + 0.5, CheckResult())],
+                       replay=True)
+
+    async with get_pool().acquire() as conn:
+        assert await conn.fetchval(
+            'select count(*) from check_log where "start" = to_timestamp($1)::timestamp',
+            start
+        ) == 1
+        assert await conn.fetchval(
+            'select checks from check_stat_minute '
+            "where bucket = date_trunc('minute', to_timestamp($1)::timestamp)", start
+        ) == 1
+
+
+async def test_save_runs(test_database):
+    # two days ago, apart from other tests records
+    start = int(time()) - 2 * 86400
+    result = CheckResult(status_code=200, connection=1, ttfb=2, response=3)
+    records = [result_record(2, start + i, start + i + 0.5, result) for i in range(3)]
+    await save_results(records, runs=3600)
+    # the stored run is continued until outcome changes
+    await save_results([result_record(2, start + 3, start + 3.5, result),
+                        result_record(2, start + 4, start + 4.5,
+                                      CheckResult(error_message='timeout'))], runs=3600)
+    await save_results(records, replay=True, runs=3600)
+
+    async with get_pool().acquire() as conn:
+        data = await conn.fetch('select checks, timed, response_sum, error_message '
+                                'from check_run where wl_id = 2 order by first_start')
+        assert [tuple(r) for r in data] == [(4, 4, 12, None), (1, 0, 0, 'timeout')]
+        assert await conn.fetchval(
+            'select count(*) from check_log where wl_id = 2 and "start" < to_timestamp($1)',
+            start + 86400
+        ) == 0
+        # replayed records are not counted again
+        assert await conn.fetchval(
+            'select sum(checks) from check_stat_hour where wl_id = 2 and bucket < to_timestamp($1)',
+            start + 86400
+        ) == 5
+
+
+async def test_save_errors(test_database):
+    # three days ago, apart from other tests records
+    start = int(time()) - 3 * 86400
+    records = [result_record(3, start + i, start + i + 40,
+                             CheckResult(error_message=message, connection=40000))
+               for i, message in enumerate(('timeout', 'refused', 'timeout'))]
+    await save_results(records[:2])
+    # interned message id is cached
+    with patch('lib.writer._error_lookups') as lookups:
+        await save_results(records[2:])
+    assert not lookups.inc.called
+
+    async with get_pool().acquire() as conn:
+        assert await conn.fetchval('select count(*) from check_error') == 2
+        data = await conn.fetch(
+            'select l.duration, l."connect", v.error_message, '
+            'extract(epoch from v."end" - v."start")::int seconds '
+            'from check_log l join check_log_view v using (wl_id, "start") '
+            'where wl_id = 3 and "start" < to_timestamp($1) order by "start"', start + 86400
+        )
+    # connection time is saturated
+    assert [tuple(r) for r in data] == [(40000, 32767, 'timeout', 40),
+                                       (40000, 32767, 'refused', 40),
+                                       (40000, 32767, 'timeout', 40)]